@@ -1,19 +1,196 @@
+import asyncio
+import logging
 import os
-from fastapi import FastAPI, HTTPException
+import time
+from contextlib import asynccontextmanager
+from datetime import date, datetime
+from fastapi import Depends, FastAPI, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from typing import Optional
+from typing import Callable, Optional
 import uvicorn
 import sys
 from pprint import  pprint
 
 # Helper modules (imported from existing files)
+from db_pool import DB_PATH, check_for_swap, on_swap
+from departure_board import departure_board, PRELOAD_ALL
 from map_data import handle_map_update_request, initialize_db
-from search import search_stations as search_stations_func
-from station_info import get_station_info
-from station_to_path import get_routes_for_stop
+from search import search_stations as search_stations_func, short_query_cache
+from station_info import RESPONSE_BUCKET_SECONDS, get_station_info, static_stop_cache, station_response_cache
+from station_to_path import (ROUTES_PAGE_SIZE, get_routes_for_stop, get_routes_for_stop_page, routes_response_cache,
+                             static_patterns_cache, static_routes_cache)
+from static_changes import static_changes
+from timetable_snapshot import SNAPSHOT_ENABLED, ensure_snapshot, timetable_snapshots
+from live_delays import VERSION_CHECK_INTERVAL, live_delays
+from live_vehicles import LIVE_VEHICLES_FEED_NAME, LIVE_VEHICLES_LIMIT, get_live_vehicles, live_vehicle_tracker
+from service_calendar import service_calendar
+from response_cache import cache_stats, clear_all
+from serialization import ROW_FORMAT, check_format, json_response
+from http_cache import conditional_json_response, make_etag
+from fetch_other_vehicle_data import VEHICLE_FEED_NAME
+from tiles import get_stop_tile, get_vehicle_tile, stop_tile_cache
+from realtime_scheduler import RealtimeScheduler, default_scheduler
+from query_executor import QueueFull, query_executor
+from writer_lock import FileLock
+from metrics import REQUEST_LATENCY, RESPONSE_BYTES, mark_worker_exit, render_metrics
 
-app = FastAPI(title="GTFS Map API")
+# Poll the realtime feeds from inside the API process (set to 0 to run them elsewhere)
+RUN_REALTIME_SCHEDULER = os.getenv("REALTIME_SCHEDULER", "1") == "1"
+# Uvicorn worker processes when started via __main__ (each imports this module)
+WORKERS = int(os.getenv("WORKERS", "1"))
+# How often a reader worker checks whether the writer is gone and it should take over
+WRITER_RETRY_SECONDS = float(os.getenv("WRITER_RETRY_SECONDS", "30"))
+# How often every worker looks for a swapped database or an incremental static import
+STATIC_CHECK_SECONDS = float(os.getenv("STATIC_CHECK_SECONDS", "5"))
+# Worker lifecycle and cache invalidation go to logging, not stdout; every worker
+# logs them, so only warnings are shown unless LOG_LEVEL=INFO
+LOG_LEVEL = os.getenv("LOG_LEVEL", "WARNING")
+
+logging.basicConfig(level=LOG_LEVEL, format="%(asctime)s %(levelname)s [%(process)d] %(name)s: %(message)s")
+logger = logging.getLogger(__name__)
+
+# Exactly one worker writes: it initializes the database and runs the realtime
+# scheduler. The others only ever open read-only connections.
+init_lock = FileLock(DB_PATH + ".init.lock")
+writer_lock = FileLock(DB_PATH + ".writer.lock")
+realtime_scheduler: Optional[RealtimeScheduler] = None
+
+
+def _startup() -> bool:
+    """
+    Elects the writer and prepares this worker. The first worker through the init
+    lock takes the writer lock and initializes the database while the others
+    wait, so readers never start against a half-created schema.
+    :return: True if this worker is the writer
+    """
+    with init_lock:
+        is_writer = writer_lock.acquire(blocking=False)
+        if is_writer:
+            try:
+                initialize_db(DB_PATH)
+                logger.info("Database initialized at %s", DB_PATH)
+            except Exception as e:
+                logger.warning("Database warning: %s", e)
+    if PRELOAD_ALL and timetable_snapshots.current() is None:
+        try:
+            departure_board.preload()
+            logger.info("Departure board preloaded")
+        except Exception as e:
+            logger.warning("Departure board preload failed: %s", e)
+    return is_writer
+
+
+def _ensure_snapshot():
+    # Only for databases imported without one (e.g. by hand); the refresh writes it
+    try:
+        if ensure_snapshot(DB_PATH):
+            timetable_snapshots.clear()
+    except Exception as e:
+        logger.warning("Timetable snapshot not written: %s", e)
+
+
+@on_swap
+def _reset_static_state():
+    # Everything loaded from the previous database; reloaded lazily from the new one
+    departure_board.clear()
+    service_calendar.clear()
+    live_delays.clear()
+    live_vehicle_tracker.clear()
+    static_changes.reset()
+    timetable_snapshots.clear()
+    clear_all()
+
+
+@static_changes.on_change
+def _invalidate_static_changes(changes):
+    # An incremental import changed some rows in place; drop only what depends on them
+    if changes is None:
+        _reset_static_state()
+        return
+    stops = changes["departures"] | changes["stop"]
+    # The incremental import rewrites the snapshot after its commit
+    timetable_snapshots.clear()
+    departure_board.invalidate(stops)
+    if changes["trip"] or changes["service"]:
+        service_calendar.clear()
+    if changes["trip"] or changes["stop"] or changes["route"] or changes["departures"]:
+        live_vehicle_tracker.clear()
+    static_stop_cache.discard_where(lambda key: key[1] in stops)
+    station_response_cache.discard_where(lambda key: key[1] in stops)
+    stop_keys = {str(stop_id) for stop_id in stops}
+    for cache in (static_routes_cache, static_patterns_cache, routes_response_cache):
+        cache.discard_where(lambda key: key[1] in stop_keys)
+    if changes["stop"]:
+        stop_tile_cache.clear()
+        short_query_cache.clear()
+    logger.info("Dropped cached data of %d stops", len(stops))
+
+
+async def _watch_static_data():
+    # Readers notice swaps on their own; this also covers idle workers and in-place imports
+    while True:
+        await asyncio.sleep(STATIC_CHECK_SECONDS)
+        try:
+            await asyncio.to_thread(check_for_swap)
+            await asyncio.to_thread(static_changes.poll)
+        except Exception as e:
+            logger.warning("Static data check failed: %s", e)
+
+
+async def _watch_live_delays():
+    # Delay snapshots are built here, never inside a request; the writer also
+    # refreshes right after each ingest
+    while True:
+        try:
+            await asyncio.to_thread(live_delays.refresh)
+        except Exception as e:
+            logger.warning("Live delay refresh failed: %s", e)
+        await asyncio.sleep(VERSION_CHECK_INTERVAL)
+
+
+def _start_scheduler():
+    global realtime_scheduler
+    realtime_scheduler = default_scheduler()
+    realtime_scheduler.start()
+    logger.info("Realtime scheduler started")
+
+
+async def _standby():
+    # Takes over the realtime feeds if the writer worker exits
+    while not writer_lock.acquire(blocking=False):
+        await asyncio.sleep(WRITER_RETRY_SECONDS)
+    _start_scheduler()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    is_writer = await asyncio.to_thread(_startup)
+    watcher = asyncio.create_task(_watch_static_data())
+    delay_watcher = asyncio.create_task(_watch_live_delays())
+    snapshot_writer = None
+    if is_writer and SNAPSHOT_ENABLED:
+        # Referenced until shutdown, the event loop only holds tasks weakly
+        snapshot_writer = asyncio.create_task(asyncio.to_thread(_ensure_snapshot))
+    standby = None
+    if RUN_REALTIME_SCHEDULER:
+        if is_writer:
+            _start_scheduler()
+        else:
+            standby = asyncio.create_task(_standby())
+    yield
+    watcher.cancel()
+    delay_watcher.cancel()
+    if standby is not None:
+        standby.cancel()
+    if realtime_scheduler is not None:
+        await realtime_scheduler.stop()
+    writer_lock.release()
+    query_executor.shutdown()
+    mark_worker_exit()
+
+
+app = FastAPI(title="GTFS Map API", lifespan=lifespan)
 
 # -------------------------------
 # 1. CORS SETTINGS (Crucial!)
@@ -27,26 +204,24 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Database path
-
-DB_FILE_NAME = "/database.db"
-
-def getDBPath() -> str:
-    db_env: Optional[str] = os.getenv("DB_DIR")
-    if db_env is None:
-        print("Did not find ENV VAR")
-        return "tomfoolery-rs-main/database.db"
-    else:
-        print("Found ENV VAR")
-        return db_env + DB_FILE_NAME
+# Latency and body size per route template (e.g. /tiles/{z}/{x}/{y}), see /metrics
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    start = time.perf_counter()
+    try:
+        response = await call_next(request)
+    except Exception:
+        _observe_request(request, 500, start, None)
+        raise
+    _observe_request(request, response.status_code, start, response.headers.get("content-length"))
+    return response
 
-DB_PATH = getDBPath() # Path to the DB created by Rust
-# Attempt to initialize DB if it doesn't exist
-try:
-    initialize_db(DB_PATH)
-    print(f"✅ Database initialized at: {DB_PATH}")
-except Exception as e:
-    print(f"⚠️ Database warning: {e}")
+def _observe_request(request: Request, status: int, start: float, content_length: Optional[str]):
+    route = request.scope.get("route")
+    endpoint = route.path if route is not None else "unmatched"
+    REQUEST_LATENCY.labels(endpoint, request.method, status).observe(time.perf_counter() - start)
+    if content_length is not None:
+        RESPONSE_BYTES.labels(endpoint).observe(int(content_length))
 
 # -------------------------------
 # Request Models
@@ -58,68 +233,196 @@ class MapRequest(BaseModel):
     west: float
     buffer_meters: Optional[float] = 0
     max_stops: Optional[int] = 150
+    include_stops: Optional[bool] = True
+    include_routes: Optional[bool] = False
+    max_routes: Optional[int] = 100
+    format: Optional[str] = ROW_FORMAT  # "rows" or "columns"
 
 # -------------------------------
 # API Endpoints
 # -------------------------------
+# Handlers are async; their SQLite work runs in query_executor's bounded thread
+# pool under a per-endpoint concurrency limit, so slow queries never block the
+# event loop and one endpoint cannot starve the others.
+
+async def _run_query(endpoint: str, fn: Callable, *args):
+    try:
+        return await query_executor.run(endpoint, fn, *args)
+    except QueueFull as e:
+        logger.warning("Rejected request, queue full: %s", e)
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
 
 # Root endpoint
 @app.get("/")
-def read_root():
+async def read_root():
     return {"message": "Beep Beep Backend is Running! 🚌💨"}
 
 # Map Data (Stops within bounds)
 @app.post("/map_data")
-def get_map_data(request: MapRequest):
-    print(f"📥 Map Data Request: N={request.north}, S={request.south}")
+async def get_map_data(request: MapRequest, http_request: Request):
+    return await _run_query("map_data", _map_data_response, request, http_request)
+
+# Same as POST /map_data with the bounds as query parameters, so browsers and
+# proxies can revalidate it with If-None-Match
+@app.get("/map_data")
+async def get_map_data_query(http_request: Request, request: MapRequest = Depends()):
+    return await _run_query("map_data", _map_data_response, request, http_request)
+
+def _map_data_response(request: MapRequest, http_request: Request):
     try:
-        response = handle_map_update_request(
-            DB_PATH,
-            bounds=request.dict(),
-            max_stops=request.max_stops
-        )
-        return response
+        check_format(request.format or ROW_FORMAT)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    try:
+        bounds = request.dict()
+        # Stops and routes follow the static DB (part of every ETag), e-scooters
+        # the vehicle feed; trip delays are not in the payload
+        etag = make_etag("map_data", sorted(bounds.items()), live_delays.feed_version(VEHICLE_FEED_NAME))
+        return conditional_json_response(http_request, etag, lambda: handle_map_update_request(
+            bounds=bounds,
+            max_stops=request.max_stops,
+            max_routes=request.max_routes
+        ))
     except Exception as e:
         print(f"❌ Error in /map_data: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+# Slippy-map tiles: stops (revalidated on every use, incremental imports change
+# them under the same URL; the strong ETag keeps that a 304) or e-scooters
+@app.get("/tiles/{z}/{x}/{y}")
+async def tile_endpoint(z: int, x: int, y: int, request: Request, layer: str = "stops"):
+    return await _run_query("tiles", _tile_response, z, x, y, request, layer)
+
+def _tile_response(z: int, x: int, y: int, request: Request, layer: str):
+    try:
+        if layer == "stops":
+            body, etag = get_stop_tile(z, x, y)
+            cache_control = "public, no-cache"
+        elif layer == "escooters":
+            body, etag = get_vehicle_tile(z, x, y)
+            cache_control = "public, max-age=60"
+        else:
+            raise HTTPException(status_code=400, detail=f"unknown layer {layer}")
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+    headers = {"ETag": etag, "Cache-Control": cache_control}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+# Estimated positions of the running trains and buses in a bounding box,
+# recomputed by the writer every LIVE_VEHICLES_INTERVAL seconds
+@app.get("/live_vehicles")
+async def live_vehicles_api(request: Request, north: float, south: float, east: float, west: float,
+                            limit: int = LIVE_VEHICLES_LIMIT, format: str = ROW_FORMAT):
+    try:
+        check_format(format)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return await _run_query("live_vehicles", _live_vehicles_response, request, north, south, east, west,
+                            min(limit, LIVE_VEHICLES_LIMIT), format)
+
+def _live_vehicles_response(request: Request, north: float, south: float, east: float, west: float, limit: int,
+                            fmt: str):
+    try:
+        version = live_delays.feed_version(LIVE_VEHICLES_FEED_NAME)
+        etag = make_etag("live_vehicles", north, south, east, west, limit, fmt, version)
+        return conditional_json_response(
+            request, etag, lambda: get_live_vehicles(south, north, west, east, limit, fmt),
+            {"X-Live-Vehicles-Version": str(version)}
+        )
+    except Exception as e:
+        print(f"❌ Error in /live_vehicles: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
 # Search Stations
 @app.get("/search_stations")
-def search_stations_api(query: str, limit: int = 20):
-    print(f"🔍 Search Request: {query}")
-    return search_stations_func(query, limit)
+async def search_stations_api(query: str, limit: int = 20, format: str = ROW_FORMAT):
+    try:
+        check_format(format)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return json_response(await _run_query("search_stations", search_stations_func, query, limit, format))
 
 # Station Detail Info (Next Trips) - For Sidebar
 @app.get("/station_info")
-def station_info_endpoint(stop_id: int):
-    print(f"🚏 Station Info Request for ID: {stop_id}")
+async def station_info_endpoint(stop_id: int, request: Request):
+    return await _run_query("station_info", _station_info_response, stop_id, request)
+
+def _station_info_response(stop_id: int, request: Request):
     try:
-        data = get_station_info(stop_id, DB_PATH)
-        return data
+        # Boards change with the realtime version and every RESPONSE_BUCKET_SECONDS
+        now = datetime.now()
+        version = live_delays.current().version
+        bucket = (now.hour * 3600 + now.minute * 60 + now.second) // RESPONSE_BUCKET_SECONDS
+        etag = make_etag("station_info", stop_id, version, now.date(), bucket)
+        return conditional_json_response(
+            request, etag, lambda: get_station_info(stop_id), {"X-Realtime-Version": str(version)}
+        )
     except Exception as e:
         print(f"❌ Error in /station_info: {e}")
         return {"error": str(e), "next_trips": []}
 
 # Full Route Path for a specific Trip
+# mode=patterns sends each distinct stop list once and pages the trips
 @app.get("/routes_for_stop")
-def routes_for_stop_api(stop_id: str):
+async def routes_for_stop_api(stop_id: str, request: Request, mode: str = "trips", cursor: Optional[str] = None,
+                              limit: int = ROUTES_PAGE_SIZE, start: Optional[str] = None, end: Optional[str] = None):
     # print(f"🛣️ Route Request for stop_id={stop_id}")
+    if mode not in ("trips", "patterns"):
+        raise HTTPException(status_code=400, detail=f"unknown mode {mode!r}")
+    return await _run_query("routes_for_stop", _routes_for_stop_response, stop_id, request, mode, cursor, limit, start, end)
+
+def _routes_for_stop_response(stop_id: str, request: Request, mode: str, cursor: Optional[str], limit: int,
+                              start: Optional[str], end: Optional[str]):
     try:
-        data = get_routes_for_stop(stop_id)
+        snapshot = live_delays.current()
+        etag = make_etag("routes_for_stop", stop_id, mode, cursor, limit, start, end, snapshot.version, date.today())
+        if mode == "patterns":
+            build = lambda: get_routes_for_stop_page(stop_id, snapshot, cursor=cursor, limit=limit, start=start, end=end)
+        else:
+            build = lambda: get_routes_for_stop(stop_id, snapshot)
         # pprint(data[:100])
-        return data
+        return conditional_json_response(request, etag, build, {"X-Realtime-Version": str(snapshot.version)})
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         print(f"❌ Error in /routes_for_stop: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 # Health Check
 @app.get("/health")
-def health_check():
+async def health_check():
     return {"status": "ok"}
 
+# Hit/miss counters of the response caches, for sizing them
+@app.get("/cache_stats")
+async def cache_stats_endpoint():
+    return cache_stats()
+
+# Running and queued queries per endpoint
+@app.get("/executor_stats")
+async def executor_stats_endpoint():
+    return query_executor.stats()
+
+# Prometheus metrics: request, SQL and ingest histograms of all workers
+@app.get("/metrics")
+async def metrics_endpoint():
+    body, content_type = render_metrics()
+    return Response(content=body, media_type=content_type)
+
+# Realtime feed freshness (last successful fetch and lag per feed)
+@app.get("/realtime_status")
+async def realtime_status():
+    if realtime_scheduler is None:
+        return {"enabled": False, "writer": writer_lock.held, "jobs": {}}
+    return {"enabled": True, "writer": writer_lock.held, "jobs": realtime_scheduler.status()}
+
 # -------------------------------
 # Execution
 # -------------------------------
 if __name__ == "__main__":
-    print("🚀 Starting Backend Server on port 8000...")
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    print(f"🚀 Starting Backend Server on port 8000 with {WORKERS} worker(s)...")
+    # Several workers need the app as an import string; each process imports it
+    uvicorn.run("backend:app" if WORKERS > 1 else app, host="0.0.0.0", port=8000, workers=WORKERS)
@@ -0,0 +1,176 @@
+import math
+import sqlite3
+from typing import Iterable, List, Set, Tuple
+
+from metrics import SQLTimer
+from spatial_index import stops_in_bbox
+
+# Grid cell edge in degrees per zoom band, finest first. Each band roughly
+# doubles the previous one, matching one slippy-map zoom level.
+CLUSTER_BANDS: Tuple[float, ...] = (0.0025, 0.005, 0.01, 0.02, 0.04, 0.08, 0.16, 0.32, 0.64, 1.28, 2.56)
+# Fields of a cluster in map payloads
+CLUSTER_COLUMNS = ("count", "latitude", "longitude")
+
+
+def create_cluster_tables(cur: sqlite3.Cursor):
+    """
+    Creates the per-band stop cluster table and its R*Tree (band x lat x lon).
+    Tables from before the cells kept their stops' extent are dropped, so
+    initialize_db rebuilds them.
+    """
+    columns = [row[1] for row in cur.execute("PRAGMA table_info(stop_clusters)")]
+    if columns and "min_lat" not in columns:
+        cur.execute("DROP TABLE stop_clusters")
+        cur.execute("DROP TABLE IF EXISTS stop_clusters_rtree")
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS stop_clusters(
+            band INTEGER,
+            cell_x INTEGER,
+            cell_y INTEGER,
+            stop_count INTEGER,
+            latitude REAL,
+            longitude REAL,
+            stop_id INTEGER,
+            min_lat REAL,
+            max_lat REAL,
+            min_lon REAL,
+            max_lon REAL
+        )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_stop_clusters_cell ON stop_clusters(band, cell_x, cell_y)")
+    cur.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS stop_clusters_rtree USING rtree(
+            id, min_band, max_band, min_lat, max_lat, min_lon, max_lon
+        )
+    """)
+
+
+def _insert_cells(cur: sqlite3.Cursor, band: int, where: str = "", params: tuple = ()):
+    # Offsetting by 180/90 keeps the values positive, so CAST truncation is floor
+    size = CLUSTER_BANDS[band]
+    cur.execute(f"""
+        INSERT INTO stop_clusters(band, cell_x, cell_y, stop_count, latitude, longitude, stop_id,
+                                  min_lat, max_lat, min_lon, max_lon)
+        SELECT ?, CAST((longitude + 180.0) / ? AS INTEGER) AS cx, CAST((latitude + 90.0) / ? AS INTEGER) AS cy,
+               COUNT(*), AVG(latitude), AVG(longitude), MIN(stop_id),
+               MIN(latitude), MAX(latitude), MIN(longitude), MAX(longitude)
+        FROM stops
+        WHERE latitude IS NOT NULL AND longitude IS NOT NULL {where}
+        GROUP BY cx, cy
+    """, (band, size, size) + params)
+
+
+def _index_cells(cur: sqlite3.Cursor, after_rowid: int = 0):
+    # Cells are indexed by the extent of their stops, not their centroid, so a
+    # cell shows up as soon as any of its stops is in the viewport
+    cur.execute("""
+        INSERT INTO stop_clusters_rtree(id, min_band, max_band, min_lat, max_lat, min_lon, max_lon)
+        SELECT rowid, band, band, min_lat, max_lat, min_lon, max_lon
+        FROM stop_clusters
+        WHERE rowid > ?
+    """, (after_rowid,))
+
+
+def rebuild_stop_clusters(cur: sqlite3.Cursor, force: bool = False) -> bool:
+    """
+    Aggregates stops into grid cells for every band: count, centroid, extent and
+    one representative stop_id (the stop itself for single-stop cells). Skipped
+    when clusters exist, unless force is set.
+    :return: True if the clusters were rebuilt
+    """
+    if not force and cur.execute("SELECT 1 FROM stop_clusters LIMIT 1").fetchone():
+        return False
+
+    cur.execute("DELETE FROM stop_clusters")
+    cur.execute("DELETE FROM stop_clusters_rtree")
+    for band in range(len(CLUSTER_BANDS)):
+        _insert_cells(cur, band)
+    _index_cells(cur)
+    return True
+
+
+def stop_cells(cur: sqlite3.Cursor, stop_ids: Iterable[int]) -> Set[Tuple[int, int, int]]:
+    """
+    (band, cell_x, cell_y) of every cell the given stops are in right now. Taken
+    before and after stops move, the union is what refresh_stop_clusters needs.
+    """
+    cells = set()
+    for stop_id in stop_ids:
+        for lat, lon in cur.execute("SELECT latitude, longitude FROM stops WHERE stop_id = ?", (stop_id,)).fetchall():
+            if lat is None or lon is None:
+                continue
+            for band, size in enumerate(CLUSTER_BANDS):
+                cells.add((band, int((lon + 180.0) / size), int((lat + 90.0) / size)))
+    return cells
+
+
+def refresh_stop_clusters(cur: sqlite3.Cursor, cells: Iterable[Tuple[int, int, int]]):
+    """
+    Recomputes single cells from the stops inside them, e.g. after an incremental
+    import moved, added or removed a few stops. The rest of the table is not read.
+    """
+    for band, cell_x, cell_y in cells:
+        size = CLUSTER_BANDS[band]
+        key = (band, cell_x, cell_y)
+        cur.execute("""
+            DELETE FROM stop_clusters_rtree
+            WHERE id IN (SELECT rowid FROM stop_clusters WHERE band = ? AND cell_x = ? AND cell_y = ?)
+        """, key)
+        cur.execute("DELETE FROM stop_clusters WHERE band = ? AND cell_x = ? AND cell_y = ?", key)
+        after_rowid = cur.execute("SELECT COALESCE(MAX(rowid), 0) FROM stop_clusters").fetchone()[0]
+        # The widened range lets idx_stops_lat_lon find the stops, the casts pick the exact cell
+        south, west = cell_y * size - 90.0, cell_x * size - 180.0
+        _insert_cells(cur, band, """
+            AND latitude BETWEEN ? AND ? AND longitude BETWEEN ? AND ?
+            AND CAST((longitude + 180.0) / ? AS INTEGER) = ? AND CAST((latitude + 90.0) / ? AS INTEGER) = ?
+        """, (south - size, south + 2 * size, west - size, west + 2 * size, size, cell_x, size, cell_y))
+        _index_cells(cur, after_rowid)
+
+
+def pick_band(south: float, north: float, west: float, east: float, max_items: int) -> int:
+    """
+    Finest band whose grid puts at most max_items cells into the viewport.
+    """
+    for band, size in enumerate(CLUSTER_BANDS):
+        cells = (math.floor((north - south) / size) + 2) * (math.floor((east - west) / size) + 2)
+        if cells <= max_items:
+            return band
+    return len(CLUSTER_BANDS) - 1
+
+
+def clustered_stops(cur: sqlite3.Cursor, south: float, north: float, west: float, east: float,
+                    max_items: int) -> Tuple[List[dict], List[dict]]:
+    """
+    Stops in a viewport, at most max_items items in total. If the viewport holds
+    few enough stops they are returned as they are; otherwise the precomputed
+    clusters of the matching band are returned, single-stop cells as stops.
+    :return: (stops, clusters)
+    """
+    max_items = max(1, max_items)
+    band = pick_band(south, north, west, east, max_items)
+    with SQLTimer("clustered_stops_cells", cur) as timer:
+        cur.execute("""
+            SELECT c.stop_count, c.latitude, c.longitude, c.stop_id, s.stop_name
+            FROM stop_clusters_rtree r
+            JOIN stop_clusters c ON c.rowid = r.id
+            LEFT JOIN stops s ON s.stop_id = c.stop_id AND c.stop_count = 1
+            WHERE r.min_band = ? AND r.max_band = ?
+              AND r.max_lat >= ? AND r.min_lat <= ?
+              AND r.max_lon >= ? AND r.min_lon <= ?
+            ORDER BY c.stop_count DESC, c.rowid
+            LIMIT ?
+        """, (band, band, south, north, west, east, max_items * 4))
+        cells = cur.fetchall()
+        timer.rows = len(cells)
+
+    if sum(cell[0] for cell in cells) <= max_items:
+        return stops_in_bbox(cur, south, north, west, east)[:max_items], []
+
+    stops, clusters = [], []
+    # Biggest clusters first, so truncation drops the least significant cells
+    for count, lat, lon, stop_id, stop_name in sorted(cells, key=lambda c: -c[0])[:max_items]:
+        if count == 1:
+            stops.append({"stop_id": stop_id, "stop_name": stop_name, "latitude": lat, "longitude": lon})
+        else:
+            clusters.append({"count": count, "latitude": lat, "longitude": lon})
+    return stops, clusters
@@ -1,51 +1,387 @@
-import sqlite3
-import os
+"""
+Streaming static GTFS importer, a Python alternative to the Rust importer in
+rust/src/main.rs for hosts without cargo. Produces the same tables (service,
+trip, stoptime, stops, routes) with the same column meanings, reading each file
+row by row so memory stays flat no matter how large stop_times.txt is.
+
+    python database.py --data "$DB_DIR/data" --db "$DB_DIR/database.db"
+
+Run map_data.initialize_db afterwards (the backend does on startup) for the
+realtime tables and the derived indexes.
+"""
+import argparse
 import csv
+import io
+import os
+import sqlite3
+import time
+from itertools import islice
+from typing import Callable, Dict, Iterator, Optional, Sequence
+
+from db_pool import DB_PATH
+
+# Rows per executemany call; also how often progress is printed
+CHUNK_SIZE: int = 100_000
+# Page cache for the import connection (negative pragma value = KiB)
+IMPORT_CACHE_KIB: int = 512 * 1024
+# PRAGMA user_version of the static tables: 2 stores stop times as seconds in a
+# stoptime table clustered by stop, 0/1 is the old text-time layout
+SCHEMA_VERSION: int = 2
+
+
+def create_static_tables(cur: sqlite3.Cursor):
+    """
+    Creates the tables filled from the static GTFS feed if missing. Column order
+    matches the Rust importer, so either importer's database works.
+    """
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS stops(
+            stop_name TEXT,
+            longitude REAL,
+            latitude REAL,
+            stop_id INTEGER PRIMARY KEY,
+            location_type INTEGER
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS trip(
+            route_id INTEGER,
+            service_id INTEGER,
+            trip_id INTEGER PRIMARY KEY
+        )
+    """)
+    # Clustered by stop and departure, so the calls of a stop are one range of
+    # the primary key and need no separate index
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS stoptime(
+            stop_id INTEGER NOT NULL,
+            departure_secs INTEGER NOT NULL,
+            trip_id INTEGER NOT NULL,
+            stop_sequence INTEGER NOT NULL,
+            arrival_secs INTEGER,
+            PRIMARY KEY (stop_id, departure_secs, trip_id, stop_sequence)
+        ) WITHOUT ROWID
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS routes(
+            route_short_name TEXT,
+            route_type INTEGER,
+            route_id INTEGER
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS service(
+            mon INTEGER, tue INTEGER, wed INTEGER, thur INTEGER, fri INTEGER,
+            sat INTEGER, sun INTEGER, start_date INTEGER, end_date INTEGER, service_id INTEGER PRIMARY KEY
+        )
+    """)
+
+
+def create_static_indexes(cur: sqlite3.Cursor):
+    """
+    Indexes on the static tables. The importer creates them after loading,
+    which is much faster than keeping them up to date row by row.
+    """
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_stops_lat_lon ON stops(latitude, longitude)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_stops_stop_id ON stops(stop_id)")
+    # Also carries stop_id and departure_secs (the rest of the primary key), so
+    # walking a trip's stops never touches the table
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_stoptime_trip_sequence ON stoptime(trip_id, stop_sequence)")
+    # Covering the trip -> route -> name joins of the departure lookups
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_trip_trip_route ON trip(trip_id, route_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_trip_route_id ON trip(route_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_routes_route_id ON routes(route_id, route_short_name)")
+
+
+def _hhmmss_secs_sql(column: str) -> str:
+    return (f"CAST(substr({column}, 1, length({column}) - 4) AS INTEGER) * 3600"
+            f" + CAST(substr({column}, -4, 2) AS INTEGER) * 60 + CAST(substr({column}, -2) AS INTEGER)")
+
+
+def migrate_static_schema(cur: sqlite3.Cursor) -> bool:
+    """
+    Upgrades a database of the text-time layout (HHMMSS arrival_time and
+    departure_time in a rowid stoptime table) to SCHEMA_VERSION in place, in one
+    transaction. A stoptime_text table left by an interrupted earlier upgrade
+    is migrated again. Calls without any time are dropped, like the importers do.
+    :return: True if the database was migrated
+    :raises ValueError: if both stoptime_text and a filled new stoptime exist
+    """
+    columns = [row[1] for row in cur.execute("PRAGMA table_info(stoptime)")]
+    leftover = cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'stoptime_text'").fetchone()
+    if "departure_time" not in columns and not leftover:
+        if columns and cur.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+            cur.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        return False
+    if leftover and columns and "departure_time" not in columns \
+            and cur.execute("SELECT 1 FROM stoptime LIMIT 1").fetchone():
+        raise ValueError("stoptime_text is left over next to a filled stoptime; check which one is current")
+
+    start = time.time()
+    conn = cur.connection
+    if conn.in_transaction:
+        conn.commit()
+    # Explicit BEGIN/COMMIT: with the default isolation level the rename would
+    # commit on its own, and a crash before the copy would leave an empty stoptime
+    isolation_level, conn.isolation_level = conn.isolation_level, None
+    try:
+        cur.execute("BEGIN IMMEDIATE")
+        if leftover:
+            # The empty new table create_static_tables made next to the leftover
+            cur.execute("DROP TABLE IF EXISTS stoptime")
+            print("🗂️ resuming the stop time migration from stoptime_text")
+        else:
+            cur.execute("ALTER TABLE stoptime RENAME TO stoptime_text")
+        for (index,) in cur.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'stoptime_text' AND sql IS NOT NULL"
+        ).fetchall():
+            cur.execute(f"DROP INDEX {index}")
+        cur.execute("DROP INDEX IF EXISTS idx_trip_trip_id")
+        create_static_tables(cur)
+        cur.execute(f"""
+            INSERT OR REPLACE INTO stoptime(stop_id, departure_secs, trip_id, stop_sequence, arrival_secs)
+            SELECT stop_id, {_hhmmss_secs_sql("COALESCE(NULLIF(departure_time, ''), arrival_time)")},
+                   trip_id, stop_sequence, {_hhmmss_secs_sql("COALESCE(NULLIF(arrival_time, ''), departure_time)")}
+            FROM stoptime_text
+            WHERE COALESCE(NULLIF(departure_time, ''), NULLIF(arrival_time, '')) IS NOT NULL
+            ORDER BY 1, 2, 3, 4
+        """)
+        rows = cur.rowcount
+        cur.execute("DROP TABLE stoptime_text")
+        if cur.execute("SELECT 1 FROM sqlite_master WHERE name = 'static_hashes'").fetchone():
+            # Stop time hashes of the incremental import were taken over the text
+            # times; without them its next run takes a new baseline from the table
+            cur.execute("DELETE FROM static_hashes WHERE kind = 'trip_stops'")
+        cur.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        cur.execute("COMMIT")
+    except BaseException:
+        cur.execute("ROLLBACK")
+        raise
+    finally:
+        conn.isolation_level = isolation_level
+    print(f"🗂️ migrated {rows:,} stop times to schema {SCHEMA_VERSION} in {time.time() - start:.1f}s")
+    return True
+
+
+def gtfs_secs(value: str) -> Optional[int]:
+    """
+    Converts a GTFS H:MM:SS time to seconds since the start of the service day.
+    Hours past 23 are kept. Empty times of non-timepoint stops become None.
+    """
+    if not value:
+        return None
+    h, m, s = value.strip().split(":")
+    return int(h) * 3600 + int(m) * 60 + int(s)
+
+
+def fill_stop_times(rows: Iterator[tuple]) -> Iterator[tuple]:
+    """
+    Fills the missing times of (trip_id, arrival_secs, departure_secs, ...) rows:
+    a call with one time uses it for both, a non-timepoint call without any
+    takes the departure of the previous call of its trip. Calls that still have
+    no time are dropped, the stoptime key needs a departure.
+    """
+    previous_trip, previous_departure = None, None
+    for row in rows:
+        trip_id, arrival, departure = row[0], row[1], row[2]
+        if arrival is None or departure is None:
+            if departure is None:
+                departure = arrival
+            if departure is None and trip_id == previous_trip:
+                departure = previous_departure
+            if departure is None:
+                continue
+            row = (trip_id, departure if arrival is None else arrival, departure) + row[3:]
+        previous_trip, previous_departure = trip_id, departure
+        yield row
+
+
+def gtfs_real(value: str) -> Optional[float]:
+    """
+    Parses coordinates in Python: SQLite's own text to real conversion can be
+    off in the last bit.
+    """
+    return float(value) if value else None
+
+
+class GTFSFile:
+    """
+    One GTFS text file read row by row as tuples of the requested columns.
+    Values stay strings; column affinity turns them into integers and reals on
+    insert, which is much cheaper than converting in Python.
+    """
+
+    def __init__(self, path: str, columns: Sequence[str], defaults: Optional[Dict[str, str]] = None,
+                 converters: Optional[Dict[str, Callable]] = None):
+        """
+        :param columns: output columns, in table order
+        :param defaults: values for optional columns missing from the file or empty
+        :param converters: per column functions applied to the raw value
+        """
+        self.path = path
+        self.columns = columns
+        self.defaults = defaults or {}
+        self.converters = converters or {}
+        self.size = os.path.getsize(path)
+        self._raw: Optional[io.BufferedReader] = None
+
+    @property
+    def position(self) -> int:
+        """
+        Bytes read so far, ahead of the rows returned by at most one buffer.
+        """
+        return self._raw.tell() if self._raw is not None and not self._raw.closed else self.size
+
+    def rows(self) -> Iterator[tuple]:
+        with open(self.path, "rb") as raw:
+            self._raw = raw
+            reader = csv.reader(io.TextIOWrapper(raw, encoding="utf-8-sig", newline=""))
+            header = [name.strip() for name in next(reader)]
+            missing = [c for c in self.columns if c not in header and c not in self.defaults]
+            if missing:
+                raise ValueError(f"{self.path} lacks columns {', '.join(missing)}")
+
+            getters = []
+            for column in self.columns:
+                index = header.index(column) if column in header else None
+                default = self.defaults.get(column)
+                convert = self.converters.get(column)
+                getters.append((index, default, convert))
+
+            if all(default is None and convert is None for _, default, convert in getters):
+                # Fast path: plain column picks
+                indexes = [index for index, _, _ in getters]
+                for record in reader:
+                    if record:
+                        yield tuple(record[i] for i in indexes)
+                return
+
+            for record in reader:
+                if not record:
+                    continue
+                values = []
+                for index, default, convert in getters:
+                    value = record[index] if index is not None and index < len(record) else ""
+                    if value == "" and default is not None:
+                        value = default
+                    values.append(convert(value) if convert else value)
+                yield tuple(values)
+
+
+def _load(cur: sqlite3.Cursor, table: str, source: GTFSFile, insert_columns: Sequence[str], chunk_size: int,
+          transform: Optional[Callable[[Iterator[tuple]], Iterator[tuple]]] = None) -> int:
+    """
+    Streams one file into a table in chunks of chunk_size rows and prints progress.
+    :param transform: applied to the stream of file rows before inserting
+    :return: rows inserted
+    """
+    sql = (f"INSERT OR REPLACE INTO {table}({', '.join(insert_columns)}) "
+           f"VALUES ({', '.join('?' * len(insert_columns))})")
+    name = os.path.basename(source.path)
+    rows = source.rows() if transform is None else transform(source.rows())
+    total, start = 0, time.time()
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+        cur.executemany(sql, chunk)
+        total += len(chunk)
+        elapsed = max(time.time() - start, 1e-6)
+        print(f"\r📥 {name}: {total:,} rows, {100 * source.position / max(source.size, 1):5.1f}%, "
+              f"{total / elapsed:,.0f} rows/s", end="", flush=True)
+    print(f"\r📥 {name}: {total:,} rows in {time.time() - start:.1f}s" + " " * 30)
+    return total
+
+
+def import_gtfs(data_dir: str, db_path: str, chunk_size: int = CHUNK_SIZE) -> Dict[str, int]:
+    """
+    Builds a fresh static database from the GTFS text files in data_dir,
+    replacing db_path if it exists.
+    :return: rows inserted per table
+    """
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(db_path + suffix):
+            os.remove(db_path + suffix)
+    os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+
+    conn = sqlite3.connect(db_path)
+    cur = conn.cursor()
+    # Bulk load settings: a crash mid-import leaves a broken file anyway, so no journal or fsync
+    cur.execute("PRAGMA journal_mode = OFF")
+    cur.execute("PRAGMA synchronous = OFF")
+    cur.execute("PRAGMA locking_mode = EXCLUSIVE")
+    # The stop time sort below is an external merge sort; its runs go to temp files, not RAM
+    cur.execute("PRAGMA temp_store = FILE")
+    cur.execute(f"PRAGMA cache_size = -{IMPORT_CACHE_KIB}")
+    create_static_tables(cur)
+
+    def path(name: str) -> str:
+        return os.path.join(data_dir, name)
+
+    days = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
+    sources = [
+        ("routes", GTFSFile(path("routes.txt"), ["route_short_name", "route_type", "route_id"],
+                            defaults={"route_short_name": ""}),
+         ["route_short_name", "route_type", "route_id"]),
+        ("service", GTFSFile(path("calendar.txt"), days + ["start_date", "end_date", "service_id"]),
+         ["mon", "tue", "wed", "thur", "fri", "sat", "sun", "start_date", "end_date", "service_id"]),
+        ("trip", GTFSFile(path("trips.txt"), ["route_id", "service_id", "trip_id"]),
+         ["route_id", "service_id", "trip_id"]),
+        ("stoptime_load", GTFSFile(path("stop_times.txt"),
+                              ["trip_id", "arrival_time", "departure_time", "stop_id", "stop_sequence"],
+                              converters={"arrival_time": gtfs_secs, "departure_time": gtfs_secs}),
+         ["trip_id", "arrival_secs", "departure_secs", "stop_id", "stop_sequence"]),
+        ("stops", GTFSFile(path("stops.txt"), ["stop_name", "stop_lon", "stop_lat", "stop_id", "location_type"],
+                           defaults={"location_type": "0"},
+                           converters={"stop_lon": gtfs_real, "stop_lat": gtfs_real}),
+         ["stop_name", "longitude", "latitude", "stop_id", "location_type"]),
+    ]
+
+    counts = {}
+    start = time.time()
+    # Stop times are staged in file order and then inserted sorted by the
+    # stoptime key: appending to the clustered table beats inserting at random
+    # positions once it outgrows the page cache
+    cur.execute("CREATE TABLE stoptime_load(trip_id, arrival_secs, departure_secs, stop_id, stop_sequence)")
+    cur.execute("BEGIN")
+    for table, source, insert_columns in sources:
+        counts[table] = _load(cur, table, source, insert_columns, chunk_size,
+                              fill_stop_times if table == "stoptime_load" else None)
+    sort_start = time.time()
+    cur.execute("""
+        INSERT OR REPLACE INTO stoptime(stop_id, departure_secs, trip_id, stop_sequence, arrival_secs)
+        SELECT stop_id, departure_secs, trip_id, stop_sequence, arrival_secs FROM stoptime_load
+        ORDER BY stop_id, departure_secs, trip_id, stop_sequence
+    """)
+    counts["stoptime"] = counts.pop("stoptime_load")
+    cur.execute("DROP TABLE stoptime_load")
+    conn.commit()
+    print(f"🗂️ stop times sorted by stop in {time.time() - sort_start:.1f}s")
+
+    index_start = time.time()
+    print("🗂️ building indexes")
+    create_static_indexes(cur)
+    cur.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    cur.execute("ANALYZE")
+    conn.commit()
+    print(f"🗂️ indexes built in {time.time() - index_start:.1f}s")
+
+    cur.execute("PRAGMA locking_mode = NORMAL")
+    cur.execute("PRAGMA journal_mode = WAL")
+    conn.close()
+    print(f"✅ imported {counts} in {time.time() - start:.1f}s")
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import a static GTFS feed into the backend database")
+    parser.add_argument("--data", default=os.path.join(os.getenv("DB_DIR", "."), "data"),
+                        help="directory with the GTFS text files")
+    parser.add_argument("--db", default=DB_PATH, help="database file to create (replaced if it exists)")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    args = parser.parse_args()
+    import_gtfs(args.data, args.db, args.chunk_size)
+
 
-#declare paths
-DATABASE_PATH = "data/database.db"
-DE_FULL_PATH = "latest/"
-
-#Create Database
-directory = os.path.dirname(DATABASE_PATH)
-os.makedirs(directory, exist_ok=True)
-open(DATABASE_PATH, "w").close()
-
-con = sqlite3.connect(DATABASE_PATH)
-cur = con.cursor()
-
-#initialise Data from txt files
-
-calendar_data = []
-with open(DE_FULL_PATH + "calendar.txt", newline="") as csvfile:
-    spamreader = csv.reader(csvfile, delimiter=",")
-    for row in spamreader:
-        calendar_data.append(row)
-print("parsed calendar")
-
-trips_data = []
-with open(DE_FULL_PATH + "trips.txt", newline="") as csvfile:
-    spamreader = csv.reader(csvfile, delimiter=",")
-    for row in spamreader:
-        trips_data.append(row)
-print("parsed trips")
-stop_times = []
-with open(DE_FULL_PATH + "stop_times.txt", newline="") as csvfile:
-    spamreader = csv.reader(csvfile, delimiter=",")
-    for row in spamreader:
-        stop_times.append(row)
-print("parsed stop_times")
-#initialize tables
-cur.execute("CREATE TABLE service(mon int, tue int, wed int, thur int, fri int, sat int, sun int, start_date int, end_date int, service_id int)")
-cur.execute("CREATE TABLE route(route_id int, service_id int, trip_id int)")
-cur.execute("CREATE TABLE trip(trip_id int, arrival_time int, departure_time int, stop_id int, stop_sequence int)")
-#add data to tables
-cur.executemany("INSERT INTO service VALUES (?,?,?,?,?,?,?,?,?,?)", calendar_data[1:])
-con.commit()
-print("commit 1")
-cur.executemany("INSERT INTO route VALUES(?,?,?)", trips_data[1:])
-con.commit()
-print("commit 2")
-cur.executemany("INSERT INTO trip VALUE(?,?,?,?,?)", stop_times[1:])
-con.commit()
-con.close()
\ No newline at end of file
+if __name__ == "__main__":
+    main()
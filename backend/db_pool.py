@@ -0,0 +1,157 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Callable, List, Optional, Tuple
+
+DB_FILE_NAME: str = "/database.db"
+
+# Reader tuning, applied to every pooled connection
+MMAP_SIZE: int = 256 * 1024 * 1024       # bytes of the db file mapped into memory
+CACHE_SIZE_KIB: int = 64 * 1024          # page cache per connection (negative pragma value = KiB)
+BUSY_TIMEOUT_MS: int = 5000              # wait instead of failing while the writer checkpoints
+STATEMENT_CACHE_SIZE: int = 256          # prepared statements kept per connection
+# How often a process checks whether DB_PATH now points at a new database (see swap_database.py)
+SWAP_CHECK_INTERVAL: float = float(os.getenv("DB_SWAP_CHECK_SECONDS", "1"))
+
+
+def getDBPath() -> str:
+    db_env: Optional[str] = os.getenv("DB_DIR")
+    if db_env is None:
+        return "tomfoolery-rs-main/database.db"
+    else:
+        return db_env + DB_FILE_NAME
+
+
+DB_PATH: str = getDBPath()  # Path to the DB created by Rust
+
+_local = threading.local()
+# Bumped whenever the static database is replaced; part of every static cache key
+_generation: int = 0
+# (device, inode) of the file DB_PATH resolved to when the generation started
+_db_identity: Optional[Tuple[int, int]] = None
+_swap_checked_at: float = 0.0
+_swap_lock = threading.Lock()
+_swap_listeners: List[Callable[[], None]] = []
+
+logger = logging.getLogger(__name__)
+
+
+def generation() -> int:
+    return _generation
+
+
+def bump_generation() -> int:
+    global _generation
+    _generation += 1
+    return _generation
+
+
+def _identity(db_path: str) -> Optional[Tuple[int, int]]:
+    # stat follows the DB_PATH symlink, so a swap shows up as a new inode
+    try:
+        st = os.stat(db_path)
+    except FileNotFoundError:
+        return None
+    return st.st_dev, st.st_ino
+
+
+def on_swap(listener: Callable[[], None]) -> Callable[[], None]:
+    """
+    Registers a function called once per process after the database was swapped,
+    e.g. to drop in-memory state loaded from the old one. Usable as a decorator.
+    """
+    _swap_listeners.append(listener)
+    return listener
+
+
+def check_for_swap(force: bool = False) -> bool:
+    """
+    Detects that DB_PATH was repointed to a new database file, at most every
+    SWAP_CHECK_INTERVAL seconds. On a swap the generation is bumped, so pooled
+    connections reopen on next use and generation-keyed caches miss, and the
+    on_swap listeners run.
+    :return: True if a swap was detected by this call
+    """
+    global _db_identity, _swap_checked_at
+    now = time.monotonic()
+    if not force and now - _swap_checked_at < SWAP_CHECK_INTERVAL:
+        return False
+    with _swap_lock:
+        _swap_checked_at = now
+        identity = _identity(DB_PATH)
+        if identity is None or identity == _db_identity:
+            return False
+        first_check = _db_identity is None
+        _db_identity = identity
+        if first_check:
+            return False
+        bump_generation()
+    logger.info("Database swapped, now at generation %d", _generation)
+    for listener in _swap_listeners:
+        try:
+            listener()
+        except Exception as e:
+            logger.warning("Swap listener %s failed: %s", getattr(listener, "__name__", listener), e)
+    return True
+
+
+def _open_read_only(db_path: str) -> sqlite3.Connection:
+    """
+    Opens a read-only connection tuned for the API's point and range lookups.
+    """
+    conn = sqlite3.connect(
+        f"file:{db_path}?mode=ro",
+        uri=True,
+        cached_statements=STATEMENT_CACHE_SIZE,
+    )
+    cur = conn.cursor()
+    # journal_mode is persistent and set by initialize_db; readers only confirm it
+    cur.execute("PRAGMA journal_mode")
+    cur.execute(f"PRAGMA mmap_size = {MMAP_SIZE}")
+    cur.execute(f"PRAGMA cache_size = -{CACHE_SIZE_KIB}")
+    cur.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+    cur.execute("PRAGMA query_only = ON")
+    cur.execute("PRAGMA temp_store = MEMORY")
+    cur.close()
+    return conn
+
+
+def get_connection() -> sqlite3.Connection:
+    """
+    Returns the calling thread's read-only connection, opening it on first use.
+    The connection stays open for the lifetime of the thread so its page cache
+    and prepared statements are reused across requests, until the database is
+    swapped.
+    """
+    check_for_swap()
+    conn = getattr(_local, "conn", None)
+    if conn is None or _local.generation != _generation:
+        # A connection of the previous generation is not closed here: cursors
+        # still reading from it keep it alive and it closes once they are done
+        conn = _open_read_only(DB_PATH)
+        _local.conn = conn
+        _local.generation = _generation
+    return conn
+
+
+def get_cursor(row_factory=None) -> sqlite3.Cursor:
+    """
+    Returns a fresh cursor on the pooled connection.
+    :param row_factory: optional row factory (e.g. sqlite3.Row) for this cursor only
+    """
+    cur = get_connection().cursor()
+    if row_factory is not None:
+        cur.row_factory = row_factory
+    return cur
+
+
+def close_connection():
+    """
+    Closes the calling thread's pooled connection, if any.
+    """
+    conn = getattr(_local, "conn", None)
+    if conn is not None:
+        conn.close()
+        _local.conn = None
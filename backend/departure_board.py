@@ -0,0 +1,199 @@
+import os
+import threading
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from typing import Container, Iterable, List, Optional
+
+from db_pool import get_cursor
+from metrics import SQLTimer
+from timetable_snapshot import timetable_snapshots
+
+# Stops kept in memory when loading lazily (a busy hub holds a few thousand rows)
+MAX_CACHED_STOPS: int = int(os.getenv("DEPARTURE_CACHE_STOPS", "4096"))
+# Load every stop at startup instead of on first request
+PRELOAD_ALL: bool = os.getenv("DEPARTURE_PRELOAD", "0") == "1"
+
+
+def parse_hhmmss(value) -> int:
+    """
+    Converts an HHMMSS (or HH:MM:SS) time to seconds since the start of the service
+    day. Hours past 23 are kept, so 251000 becomes 90600.
+    """
+    text = str(value).replace(":", "").zfill(6)
+    return int(text[:-4]) * 3600 + int(text[-4:-2]) * 60 + int(text[-2:])
+
+
+def format_hhmmss(seconds: int) -> str:
+    """
+    Converts seconds since service day start to HHMMSS on a 24h clock.
+    """
+    seconds %= 86400
+    return f"{seconds // 3600:02d}{(seconds % 3600) // 60:02d}{seconds % 60:02d}"
+
+
+class StopDepartures:
+    """
+    All scheduled calls at one stop as parallel arrays sorted by departure time.
+    """
+    __slots__ = ("departure_secs", "arrival_secs", "trip_ids", "route_names")
+
+    def __init__(self, rows):
+        # Linear for rows read from stoptime, which come in departure order
+        rows = sorted(rows, key=lambda r: r[2])
+        self.trip_ids = array("q", (r[0] for r in rows))
+        self.arrival_secs = array("i", (r[1] for r in rows))
+        self.departure_secs = array("i", (r[2] for r in rows))
+        self.route_names: List[Optional[str]] = [r[3] for r in rows]
+
+    @classmethod
+    def view(cls, trip_ids, arrival_secs, departure_secs, route_names) -> "StopDepartures":
+        """
+        Wraps sequences already in departure order, e.g. views into the timetable snapshot.
+        """
+        entry = cls.__new__(cls)
+        entry.trip_ids, entry.arrival_secs, entry.departure_secs = trip_ids, arrival_secs, departure_secs
+        entry.route_names = route_names
+        return entry
+
+    def __len__(self) -> int:
+        return len(self.trip_ids)
+
+    def index_at(self, seconds: int) -> int:
+        """
+        Position of the first call departing at or after `seconds`.
+        """
+        return bisect_left(self.departure_secs, seconds)
+
+
+def _row_from_db(trip_id, arrival_secs, departure_secs, route_short_name, names: dict):
+    # Interning keeps one string per route name instead of one per call
+    name = names.setdefault(route_short_name, route_short_name)
+    return trip_id, arrival_secs, departure_secs, name
+
+
+class DepartureBoard:
+    """
+    Per-stop departure index. Read in place from the timetable snapshot when one
+    matches the database; otherwise stops are loaded with one indexed query on
+    first use and kept in a bounded LRU, or all at once via preload().
+    """
+
+    def __init__(self, max_stops: int = MAX_CACHED_STOPS):
+        self.max_stops = max_stops
+        self._stops: "OrderedDict[int, StopDepartures]" = OrderedDict()
+        self._names: dict = {}
+        self._lock = threading.Lock()
+        self._preloaded = False
+        # Stops missing from a preloaded board that must be loaded again, not read as empty
+        self._stale: set = set()
+
+    def clear(self):
+        with self._lock:
+            self._stops.clear()
+            self._names.clear()
+            self._stale.clear()
+            self._preloaded = False
+
+    def invalidate(self, stop_ids: Iterable[int]):
+        """
+        Drops the departures of these stops; they are reloaded on next use.
+        """
+        with self._lock:
+            for stop_id in stop_ids:
+                self._stops.pop(stop_id, None)
+                if self._preloaded:
+                    self._stale.add(stop_id)
+
+    def preload(self):
+        """
+        Loads every stop in one pass over stoptime. Intended for startup.
+        """
+        cur = get_cursor()
+        cur.execute("""
+            SELECT st.stop_id, st.trip_id, st.arrival_secs, st.departure_secs, r.route_short_name
+            FROM stoptime st
+            LEFT JOIN trip t ON t.trip_id = st.trip_id
+            LEFT JOIN routes r ON r.route_id = t.route_id
+            ORDER BY st.stop_id, st.departure_secs
+        """)
+        stops = OrderedDict()
+        names: dict = {}
+        current_stop, rows = None, []
+        for stop_id, trip_id, arrival, departure, route_name in cur:
+            if stop_id != current_stop:
+                if rows:
+                    stops[current_stop] = StopDepartures(rows)
+                current_stop, rows = stop_id, []
+            rows.append(_row_from_db(trip_id, arrival, departure, route_name, names))
+        if rows:
+            stops[current_stop] = StopDepartures(rows)
+
+        with self._lock:
+            self._stops = stops
+            self._names = names
+            self._preloaded = True
+
+    def _load(self, stop_id: int) -> StopDepartures:
+        cur = get_cursor()
+        with SQLTimer("departure_board_stop", cur) as timer:
+            cur.execute("""
+                SELECT st.trip_id, st.arrival_secs, st.departure_secs, r.route_short_name
+                FROM stoptime st
+                LEFT JOIN trip t ON t.trip_id = st.trip_id
+                LEFT JOIN routes r ON r.route_id = t.route_id
+                WHERE st.stop_id = ?
+                ORDER BY st.departure_secs
+            """, (stop_id,))
+            rows = cur.fetchall()
+            timer.rows = len(rows)
+        with self._lock:
+            names = self._names
+        return StopDepartures([_row_from_db(*row, names) for row in rows])
+
+    def get(self, stop_id: int) -> StopDepartures:
+        snapshot = timetable_snapshots.current()
+        if snapshot is not None:
+            return StopDepartures.view(*snapshot.departures(stop_id))
+
+        with self._lock:
+            entry = self._stops.get(stop_id)
+            if entry is not None:
+                if not self._preloaded:
+                    self._stops.move_to_end(stop_id)
+                return entry
+            if self._preloaded and stop_id not in self._stale:
+                # Preloaded boards hold every stop that has calls
+                return StopDepartures([])
+
+        entry = self._load(stop_id)
+        with self._lock:
+            self._stops[stop_id] = entry
+            self._stale.discard(stop_id)
+            while not self._preloaded and len(self._stops) > self.max_stops:
+                self._stops.popitem(last=False)
+        return entry
+
+    def window(self, stop_id: int, start_secs: int, end_secs: int, limit: int,
+               trips: Optional[Container[int]] = None) -> List[int]:
+        """
+        Returns indices of calls departing in [start_secs, end_secs) plus up to
+        `limit` further calls, one per trip (the first call of a looping trip wins).
+        :param trips: if given, only calls of these trips are picked
+        """
+        board = self.get(stop_id)
+        i = board.index_at(start_secs)
+        end = board.index_at(end_secs)
+        seen, picked, extra = set(), [], 0
+        while i < len(board) and (i < end or extra < limit):
+            trip_id = board.trip_ids[i]
+            if trip_id not in seen and (trips is None or trip_id in trips):
+                seen.add(trip_id)
+                picked.append(i)
+                if i >= end:
+                    extra += 1
+            i += 1
+        return picked
+
+
+departure_board = DepartureBoard()
@@ -1,63 +1,186 @@
+import io
+from typing import BinaryIO, Container, Iterator, Optional
+
 import requests
 from google.transit import gtfs_realtime_pb2
 
-def download_rt_gtfs_data(url: str="https://realtime.gtfs.de/realtime-free.pb"):
+GTFS_RT_URL: str = "https://realtime.gtfs.de/realtime-free.pb"
+
+# FeedMessage field numbers and protobuf wire types
+_FEED_HEADER = 1
+_FEED_ENTITY = 2
+_VARINT, _FIXED64, _LENGTH_DELIMITED, _FIXED32 = 0, 1, 2, 5
+
+
+def download_rt_gtfs_data(url: str=GTFS_RT_URL, known_trip_ids: Optional[Container] = None):
     """
     fetches real-time gtfs updates from url
     :param url: the url of datastream
-    :return: [[vehicles], [trip_updates], [alerts]]
-    """
-    raw = requests.get(url).content
-
-    feed = gtfs_realtime_pb2.FeedMessage()
-    feed.ParseFromString(raw)
-
-    vehicles = []
-
-    for entity in feed.entity:
-        if entity.HasField("vehicle"):
-            v = entity.vehicle
-
-            vehicles.append({
-                "trip_id": v.trip.trip_id,
-                "route_id": v.trip.route_id,
-                "lat": v.position.latitude,
-                "lon": v.position.longitude,
-                "bearing": v.position.bearing,
-                "speed": v.position.speed,
-                "timestamp": v.timestamp,
-                "vehicle_id": v.vehicle.id
-            })
-
-    trip_updates = []
-
-    for entity in feed.entity:
-        if entity.HasField("trip_update"):
-            tu = entity.trip_update
-            for stu in tu.stop_time_update:
-                trip_updates.append([
-                    tu.trip.trip_id,
-                    stu.stop_id,
-                    stu.arrival.delay if stu.HasField("arrival") else None,
-                    stu.departure.delay if stu.HasField("departure") else None,
-                ])
+    :param known_trip_ids: if given, trip updates for other trips are dropped
+    :return: [[vehicles], [trip_updates], [alerts], header_timestamp]
+    """
+    with requests.get(url, stream=True) as response:
+        response.raise_for_status()
+        response.raw.decode_content = True
+        response.raw.auto_close = False  # let BufferedReader see EOF instead of a closed file
+        return RealtimeFeed(io.BufferedReader(response.raw), known_trip_ids).as_list()
+
+
+def parse_rt_gtfs_data(raw: bytes, known_trip_ids: Optional[Container] = None):
+    """
+    parses a serialized gtfs-rt FeedMessage
+    :param raw: protobuf bytes as served by the feed
+    :param known_trip_ids: if given, trip updates for other trips are dropped
+    :return: [[vehicles], [trip_updates], [alerts], header_timestamp]
+    """
+    return RealtimeFeed(io.BytesIO(raw), known_trip_ids).as_list()
+
+
+def _read_varint(stream: BinaryIO) -> Optional[int]:
+    result, shift = 0, 0
+    while True:
+        byte = stream.read(1)
+        if not byte:
+            if shift:
+                raise ValueError("truncated varint in gtfs-rt feed")
+            return None
+        result |= (byte[0] & 0x7F) << shift
+        if not byte[0] & 0x80:
+            return result
+        shift += 7
+
 
-    alerts = []
+def _read_exact(stream: BinaryIO, size: int) -> bytes:
+    data = stream.read(size)
+    if len(data) != size:
+        raise ValueError("truncated message in gtfs-rt feed")
+    return data
 
-    for entity in feed.entity:
-        if entity.HasField("alert"):
-            a = entity.alert
-            alerts.append([
-                a.header_text.translation[0].text if a.header_text.translation else None,
-                a.description_text.translation[0].text if a.description_text.translation else None,
-                a.cause,
-                a.effect,
-            ])
 
-    # print(len(vehicles), "\n", len(trip_updates), "\n", len(alerts), "\n")
-    # print(trip_updates[:10])
+def iter_feed_fields(stream: BinaryIO) -> Iterator[tuple]:
+    """
+    Walks the top level of a FeedMessage without parsing it as a whole.
+    :return: (field_number, payload bytes) for the header and each entity
+    """
+    while True:
+        key = _read_varint(stream)
+        if key is None:
+            return
+        field, wire_type = key >> 3, key & 7
+        if wire_type == _LENGTH_DELIMITED:
+            payload = _read_exact(stream, _read_varint(stream))
+            if field in (_FEED_HEADER, _FEED_ENTITY):
+                yield field, payload
+        elif wire_type == _VARINT:
+            _read_varint(stream)
+        elif wire_type == _FIXED64:
+            _read_exact(stream, 8)
+        elif wire_type == _FIXED32:
+            _read_exact(stream, 4)
+        else:
+            raise ValueError(f"unsupported wire type {wire_type} in gtfs-rt feed")
+
+
+class RealtimeFeed:
+    """
+    Single pass over a serialized FeedMessage. Entities are decoded one at a time
+    while trip_update_rows() is consumed, so peak memory is one entity plus the
+    rows kept. Alerts and vehicles are collected on the way.
+    """
+
+    def __init__(self, stream: BinaryIO, known_trip_ids: Optional[Container] = None):
+        self.known_trip_ids = known_trip_ids
+        self.vehicles = []
+        self.alerts = []
+        self.entities = 0
+        self.dropped_trip_updates = 0
 
-    # Apparently no vehicle positions in german data
+        self._fields = iter_feed_fields(stream)
+        self._pending = None
+        self.header = gtfs_realtime_pb2.FeedHeader()
+        # Serializers write fields in number order, so the header comes first
+        for field, payload in self._fields:
+            if field == _FEED_HEADER:
+                self.header.ParseFromString(payload)
+            else:
+                self._pending = payload
+            break
+        self.header_timestamp = self.header.timestamp
+
+    def _entities(self) -> Iterator[gtfs_realtime_pb2.FeedEntity]:
+        # One message object is reused; ParseFromString clears it first
+        entity = gtfs_realtime_pb2.FeedEntity()
+        if self._pending is not None:
+            pending, self._pending = self._pending, None
+            entity.ParseFromString(pending)
+            yield entity
+        for field, payload in self._fields:
+            if field == _FEED_ENTITY:
+                entity.ParseFromString(payload)
+                yield entity
+
+    def _is_known(self, trip_id: str) -> bool:
+        if self.known_trip_ids is None:
+            return True
+        try:
+            return int(trip_id) in self.known_trip_ids
+        except ValueError:
+            return False
+
+    def trip_update_rows(self) -> Iterator[list]:
+        """
+        Yields [trip_id, stop_id, arrival_delay, departure_delay] per stop time
+        update of a known trip. Can only be consumed once.
+        """
+        for entity in self._entities():
+            self.entities += 1
+            if entity.HasField("trip_update"):
+                tu = entity.trip_update
+                if not self._is_known(tu.trip.trip_id):
+                    self.dropped_trip_updates += 1
+                    continue
+                for stu in tu.stop_time_update:
+                    yield [
+                        tu.trip.trip_id,
+                        stu.stop_id,
+                        stu.arrival.delay if stu.HasField("arrival") else None,
+                        stu.departure.delay if stu.HasField("departure") else None,
+                    ]
+
+            if entity.HasField("vehicle"):
+                # Apparently no vehicle positions in german data
+                v = entity.vehicle
+                self.vehicles.append({
+                    "trip_id": v.trip.trip_id,
+                    "route_id": v.trip.route_id,
+                    "lat": v.position.latitude,
+                    "lon": v.position.longitude,
+                    "bearing": v.position.bearing,
+                    "speed": v.position.speed,
+                    "timestamp": v.timestamp,
+                    "vehicle_id": v.vehicle.id
+                })
+
+            if entity.HasField("alert"):
+                a = entity.alert
+                self.alerts.append([
+                    a.header_text.translation[0].text if a.header_text.translation else None,
+                    a.description_text.translation[0].text if a.description_text.translation else None,
+                    a.cause,
+                    a.effect,
+                ])
 
-    return [vehicles, trip_updates, alerts]
+    def as_stream(self):
+        """
+        Ingestion input for update_live_data. The trip updates are a generator;
+        vehicles and alerts fill up while it is consumed.
+        :return: [[vehicles], trip_update_rows, [alerts], header_timestamp]
+        """
+        return [self.vehicles, self.trip_update_rows(), self.alerts, self.header_timestamp]
 
+    def as_list(self):
+        """
+        :return: [[vehicles], [trip_updates], [alerts], header_timestamp]
+        """
+        trip_updates = list(self.trip_update_rows())
+        return [self.vehicles, trip_updates, self.alerts, self.header_timestamp]
@@ -4,18 +4,9 @@ from io import StringIO
 import sqlite3
 from datetime import datetime, timedelta, timezone
 from zoneinfo import ZoneInfo
-from typing import Optional
-import os
 
-DB_FILE_NAME: str = "/database.db"
-def getDBPath() -> str:
-    db_env: Optional[str] = os.getenv("DB_DIR")
-    if db_env is None:
-        return "tomfoolery-rs-main/database.db"
-    else:
-        return db_env + DB_FILE_NAME
-
-DB_PATH: str = getDBPath()
+from db_pool import DB_PATH
+from spatial_index import create_spatial_tables, rebuild_vehicles_rtree
 
 def parse_timestamp(ts: str):
     if not ts:
@@ -29,7 +20,12 @@ def parse_timestamp(ts: str):
         return None
 
 
-def download_vehicle_data(url: str="https://api.mobidata-bw.de/geoserver/MobiData-BW/ows?service=WFS&version=1.0.0&request=GetFeature&typeName=MobiData-BW%3Asharing_vehicles&maxFeatures=100000&outputFormat=csv"):
+# Key of the vehicle data in feed_state
+VEHICLE_FEED_NAME: str = "other_vehicles"
+VEHICLE_DATA_URL: str = "https://api.mobidata-bw.de/geoserver/MobiData-BW/ows?service=WFS&version=1.0.0&request=GetFeature&typeName=MobiData-BW%3Asharing_vehicles&maxFeatures=100000&outputFormat=csv"
+
+
+def download_vehicle_data(url: str=VEHICLE_DATA_URL):
     """
     loads other vehicle data like scooters and car sharing
     :param url: url of data to be fetched
@@ -37,7 +33,16 @@ def download_vehicle_data(url: str="https://api.mobidata-bw.de/geoserver/MobiDat
     """
     response = requests.get(url)
     response.raise_for_status()
-    f = StringIO(response.text)
+    store_vehicle_data(DB_PATH, parse_vehicle_data(response.text))
+
+
+def parse_vehicle_data(text: str) -> list:
+    """
+    parses the sharing vehicle csv, dropping vehicles not reported in the last 90 minutes
+    :param text: csv body as returned by the MobiData-BW endpoint
+    :return: rows for other_vehicles
+    """
+    f = StringIO(text)
     reader = csv.DictReader(f)
 
 
@@ -66,7 +71,16 @@ def download_vehicle_data(url: str="https://api.mobidata-bw.de/geoserver/MobiDat
             row.get("last_reported"),
             row.get("rental_uris_web"),
         ])
-    con = sqlite3.connect(DB_PATH)
+    return vehicles
+
+
+def store_vehicle_data(db_path: str, vehicles: list):
+    """
+    replaces the contents of other_vehicles and its spatial index
+    :param db_path: database to write to
+    :param vehicles: rows from parse_vehicle_data
+    """
+    con = sqlite3.connect(db_path, timeout=30)
     cur = con.cursor()
 
     cur.execute("""
@@ -84,6 +98,7 @@ def download_vehicle_data(url: str="https://api.mobidata-bw.de/geoserver/MobiDat
                 rental_uris_web TEXT
                 )
         """)
+    create_spatial_tables(cur)
 
     cur.execute("DELETE FROM other_vehicles")
     cur.executemany("""
@@ -92,11 +107,28 @@ def download_vehicle_data(url: str="https://api.mobidata-bw.de/geoserver/MobiDat
             current_range_meters, last_reported, rental_uris_web
         ) VALUES (?,?,?,?,?,?,?)
     """, vehicles)
+    rebuild_vehicles_rtree(cur)
+
+    # Readers key cached /map_data responses on this version
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS feed_state(
+            feed TEXT PRIMARY KEY,
+            header_timestamp INTEGER,
+            version INTEGER NOT NULL DEFAULT 0,
+            updated_at INTEGER
+        )
+    """)
+    cur.execute("""
+        INSERT INTO feed_state(feed, version, updated_at)
+        VALUES (?, 1, strftime('%s', 'now'))
+        ON CONFLICT(feed) DO UPDATE SET
+            version = version + 1,
+            updated_at = excluded.updated_at
+    """, (VEHICLE_FEED_NAME,))
 
     con.commit()
     con.close()
 
 
-download_vehicle_data()
-
-
+if __name__ == "__main__":
+    download_vehicle_data()
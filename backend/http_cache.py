@@ -0,0 +1,101 @@
+import gzip
+import hashlib
+from typing import Callable, Dict, Optional
+
+import brotli
+from fastapi import Request, Response
+
+from db_pool import generation
+from response_cache import LRUCache
+from serialization import dumps
+from static_changes import static_changes
+
+# Bodies smaller than this are sent as they are; the headers would eat the gain
+MIN_COMPRESS_BYTES: int = 1024
+GZIP_LEVEL: int = 6
+BROTLI_QUALITY: int = 5
+
+# Encoded bodies keyed by (sha256 of the JSON body, encoding)
+compressed_body_cache = LRUCache("compressed_bodies", maxsize=1024)
+
+_ENCODERS: Dict[str, Callable[[bytes], bytes]] = {
+    "br": lambda body: brotli.compress(body, quality=BROTLI_QUALITY),
+    "gzip": lambda body: gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0),
+}
+
+
+def make_etag(*parts) -> str:
+    """
+    Weak ETag from the static DB generation and version and whatever else the
+    response depends on (realtime versions, request parameters, time bucket).
+    Weak, because the gzip, brotli and identity bodies of one response share it.
+    """
+    digest = hashlib.sha1(repr(parts).encode("utf-8")).hexdigest()[:20]
+    return f'W/"g{generation()}.{static_changes.version or 0}-{digest}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """
+    If-None-Match check with weak comparison, as RFC 9110 requires for GET.
+    """
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    wanted = etag.removeprefix("W/")
+    return any(tag.strip().removeprefix("W/") == wanted for tag in if_none_match.split(","))
+
+
+def choose_encoding(accept_encoding: Optional[str]) -> Optional[str]:
+    """
+    Picks br over gzip from an Accept-Encoding header, skipping codings sent with q=0.
+    """
+    if not accept_encoding:
+        return None
+    accepted = set()
+    for item in accept_encoding.split(","):
+        coding, _, params = item.strip().partition(";")
+        params = params.replace(" ", "")
+        if params.startswith("q="):
+            try:
+                if float(params[2:]) == 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(coding.strip().lower())
+    for coding in _ENCODERS:
+        if coding in accepted or "*" in accepted:
+            return coding
+    return None
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    """
+    Compresses a body once per content; identical bodies from different requests
+    (or different ETags) share the cached result.
+    """
+    key = (hashlib.sha256(body).digest(), encoding)
+    return compressed_body_cache.get_or_compute(key, lambda: _ENCODERS[encoding](body))
+
+
+def conditional_json_response(request: Request, etag: str, build: Callable[[], object],
+                              headers: Optional[Dict[str, str]] = None,
+                              cache_control: str = "no-cache") -> Response:
+    """
+    Answers If-None-Match with 304 before build() runs, so a revalidation costs no
+    query. Otherwise serializes build()'s result and compresses it for the client.
+    :param etag: from make_etag, covering everything the body depends on
+    :param build: returns the JSON-serializable content
+    :param cache_control: "no-cache" lets clients keep the body but revalidate each time
+    """
+    headers = dict(headers or {})
+    headers.update({"ETag": etag, "Cache-Control": cache_control, "Vary": "Accept-Encoding"})
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+
+    body = dumps(build())
+    encoding = choose_encoding(request.headers.get("accept-encoding"))
+    if encoding and len(body) >= MIN_COMPRESS_BYTES:
+        body = compress(body, encoding)
+        headers["Content-Encoding"] = encoding
+    return Response(content=body, media_type="application/json", headers=headers)
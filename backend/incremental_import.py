@@ -0,0 +1,483 @@
+"""
+Incremental static GTFS import. Instead of rebuilding the database from a new
+weekly feed, every stop, route, service and trip (including its stop times) is
+hashed and compared with the hashes stored for the live database, and only the
+rows that were added, changed or removed are written, in short transactions so
+the realtime ingest is never locked out for long.
+
+    python incremental_import.py --data "$DB_DIR/data" [--db "$DB_DIR/database.db"] [--dry-run]
+
+The changed ids are logged in static_changes, from where running backends drop
+just the affected cached stops (see static_changes.py). The first run against a
+database computes its hashes from the tables, later runs read them back from
+static_hashes. Each transaction stores the hashes of the rows it wrote, so an
+interrupted import is finished by the next run.
+"""
+import argparse
+import hashlib
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+from itertools import groupby
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from clustering import refresh_stop_clusters, stop_cells
+from database import GTFSFile, fill_stop_times, gtfs_real, gtfs_secs
+from db_pool import DB_PATH
+from route_patterns import refresh_route_patterns, routes_through_stops
+from search import index_stops as index_stops_fts, unindex_stops as unindex_stops_fts
+from spatial_index import index_stops as index_stops_rtree, unindex_stops as unindex_stops_rtree
+from static_changes import CHANGE_KINDS, create_static_change_tables, record_static_changes
+from timetable_snapshot import write_snapshot
+
+# Above this share of changed trips a full import and swap is cheaper
+MAX_CHANGED_SHARE: float = float(os.getenv("INCREMENTAL_MAX_CHANGED_SHARE", "0.5"))
+# Rows per executemany call when staging stop times, and per transaction when storing hashes
+CHUNK_SIZE: int = 50_000
+# Trips whose stop times are replaced, and routes whose patterns are recomputed,
+# per write transaction; the realtime ingest waits for at most one of them
+TRIPS_PER_TRANSACTION: int = int(os.getenv("INCREMENTAL_TRIPS_PER_TRANSACTION", "500"))
+ROUTES_PER_TRANSACTION: int = int(os.getenv("INCREMENTAL_ROUTES_PER_TRANSACTION", "50"))
+
+
+class TableSpec:
+    """
+    How one GTFS file maps onto its table: columns in table order, the key
+    column and the converters that give file rows the same Python types as rows
+    read back from the table, so both hash alike. Defaults fill empty file
+    fields and NULL table values the same way the importers do.
+    """
+
+    def __init__(self, kind: str, table: str, file_name: str, file_columns: List[str], table_columns: List[str],
+                 key: str, converters: Dict[str, Callable], defaults: Optional[Dict[str, str]] = None):
+        self.kind = kind
+        self.table = table
+        self.file_name = file_name
+        self.file_columns = file_columns
+        self.table_columns = table_columns
+        self.key = key
+        self.key_index = table_columns.index(key)
+        self.converters = converters
+        self.defaults = defaults or {}
+
+    def file_rows(self, data_dir: str) -> Iterator[tuple]:
+        return GTFSFile(os.path.join(data_dir, self.file_name), self.file_columns,
+                        self.defaults, self.converters).rows()
+
+    def table_rows(self, cur: sqlite3.Cursor) -> Iterator[tuple]:
+        # NULL reads as the file default, so a stop stored without location_type
+        # hashes like the empty field it came from instead of showing up as changed
+        columns, params = [], []
+        for file_column, table_column in zip(self.file_columns, self.table_columns):
+            default = self.defaults.get(file_column)
+            if default is None:
+                columns.append(table_column)
+            else:
+                columns.append(f"COALESCE({table_column}, ?)")
+                params.append(self.converters.get(file_column, str)(default))
+        return cur.execute(f"SELECT {', '.join(columns)} FROM {self.table}", params)
+
+
+_DAYS = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
+
+TABLE_SPECS: List[TableSpec] = [
+    TableSpec("stop", "stops", "stops.txt",
+              ["stop_name", "stop_lon", "stop_lat", "stop_id", "location_type"],
+              ["stop_name", "longitude", "latitude", "stop_id", "location_type"], "stop_id",
+              {"stop_lon": gtfs_real, "stop_lat": gtfs_real, "stop_id": int, "location_type": int},
+              {"location_type": "0"}),
+    TableSpec("route", "routes", "routes.txt",
+              ["route_short_name", "route_type", "route_id"],
+              ["route_short_name", "route_type", "route_id"], "route_id",
+              {"route_type": int, "route_id": int}, {"route_short_name": ""}),
+    TableSpec("service", "service", "calendar.txt",
+              _DAYS + ["start_date", "end_date", "service_id"],
+              ["mon", "tue", "wed", "thur", "fri", "sat", "sun", "start_date", "end_date", "service_id"], "service_id",
+              {column: int for column in _DAYS + ["start_date", "end_date", "service_id"]}),
+    TableSpec("trip", "trip", "trips.txt",
+              ["route_id", "service_id", "trip_id"],
+              ["route_id", "service_id", "trip_id"], "trip_id",
+              {"route_id": int, "service_id": int, "trip_id": int}),
+]
+STOP_TIME_FILE_COLUMNS = ["trip_id", "arrival_time", "departure_time", "stop_id", "stop_sequence"]
+STOP_TIME_COLUMNS = ["trip_id", "arrival_secs", "departure_secs", "stop_id", "stop_sequence"]
+STOP_TIME_CONVERTERS = {"trip_id": int, "arrival_time": gtfs_secs, "departure_time": gtfs_secs,
+                        "stop_id": int, "stop_sequence": int}
+# Hash kind of a trip's stop times, next to the table kinds above
+TRIP_STOPS_KIND = "trip_stops"
+# Pending kind of routes whose patterns are recomputed, next to CHANGE_KINDS
+PATTERN_ROUTES_KIND = "pattern_route"
+# Pending kind prefix marking a hash baseline that is still being stored
+BASELINE_PREFIX = "baseline:"
+
+
+def create_static_hash_table(cur: sqlite3.Cursor):
+    """
+    Creates the stored row hashes and static_pending, the ids a running import
+    still has to log or recompute. Pending ids are only cleared by the import's
+    last transaction, so an interrupted import hands them to the next run.
+    """
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS static_hashes(
+            kind TEXT,
+            id INTEGER,
+            hash INTEGER,
+            PRIMARY KEY (kind, id)
+        ) WITHOUT ROWID
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS static_pending(
+            kind TEXT,
+            id INTEGER,
+            PRIMARY KEY (kind, id)
+        ) WITHOUT ROWID
+    """)
+
+
+def row_hash(values) -> int:
+    """
+    64 bit hash of a row (or a trip's stop time rows) as a signed SQLite integer.
+    """
+    digest = hashlib.blake2b(repr(values).encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big", signed=True)
+
+
+def _trip_groups(rows: Iterator[tuple], source: str) -> Iterator[Tuple[int, list]]:
+    """
+    Groups stop time rows (trip_id first) into (trip_id, rows sorted by stop_sequence).
+    :raises ValueError: if the rows of one trip are not contiguous
+    """
+    seen: Set[int] = set()
+    for trip_id, group in groupby(rows, key=lambda row: row[0]):
+        if trip_id in seen:
+            raise ValueError(f"{source} is not grouped by trip_id (trip {trip_id}); use the full import")
+        seen.add(trip_id)
+        yield trip_id, sorted(group, key=lambda row: row[4])
+
+
+def _stop_times_hash(rows: list) -> int:
+    return row_hash(tuple(row[1:] for row in rows))
+
+
+class Diff:
+    """
+    Keys and rows that differ between the feed and the database for one kind.
+    """
+
+    def __init__(self, kind: str):
+        self.kind = kind
+        self.inserted: List[tuple] = []
+        self.updated: List[tuple] = []
+        self.deleted: List[int] = []
+        self.new_hashes: Dict[int, int] = {}
+        self.unchanged = 0
+
+    @property
+    def changed_keys(self) -> Set[int]:
+        return set(self.new_hashes) | set(self.deleted)
+
+    def __bool__(self) -> bool:
+        return bool(self.new_hashes or self.deleted)
+
+    def report(self) -> dict:
+        return {"inserted": len(self.inserted), "updated": len(self.updated),
+                "deleted": len(self.deleted), "unchanged": self.unchanged}
+
+
+def _stored_hashes(cur: sqlite3.Cursor, kind: str) -> Optional[Dict[int, int]]:
+    if cur.execute("SELECT 1 FROM static_pending WHERE kind = ?", (BASELINE_PREFIX + kind,)).fetchone():
+        return None  # partial baseline of an interrupted run, computed again
+    hashes = dict(cur.execute("SELECT id, hash FROM static_hashes WHERE kind = ?", (kind,)))
+    return hashes or None
+
+
+def _table_hashes(cur: sqlite3.Cursor, spec: TableSpec) -> Dict[int, int]:
+    return {row[spec.key_index]: row_hash(tuple(row)) for row in spec.table_rows(cur)}
+
+
+def _stop_times_hashes(cur: sqlite3.Cursor) -> Dict[int, int]:
+    rows = cur.execute(f"SELECT {', '.join(STOP_TIME_COLUMNS)} FROM stoptime ORDER BY trip_id, stop_sequence")
+    return {trip_id: _stop_times_hash(group) for trip_id, group in _trip_groups(rows, "stoptime")}
+
+
+def diff_table(spec: TableSpec, data_dir: str, old_hashes: Dict[int, int]) -> Diff:
+    """
+    Compares a GTFS file with the stored hashes. old_hashes is consumed.
+    """
+    diff = Diff(spec.kind)
+    for row in spec.file_rows(data_dir):
+        key = row[spec.key_index]
+        new_hash = row_hash(row)
+        old_hash = old_hashes.pop(key, None)
+        if old_hash == new_hash:
+            diff.unchanged += 1
+            continue
+        (diff.inserted if old_hash is None else diff.updated).append(row)
+        diff.new_hashes[key] = new_hash
+    diff.deleted = list(old_hashes)
+    return diff
+
+
+def diff_stop_times(cur: sqlite3.Cursor, data_dir: str, old_hashes: Dict[int, int]) -> Diff:
+    """
+    Compares stop_times.txt trip by trip with the stored hashes. Rows of changed
+    trips are staged in temp.delta_stoptime instead of memory; diff.inserted and
+    diff.updated hold the trip ids only.
+    """
+    cur.execute(f"CREATE TEMP TABLE IF NOT EXISTS delta_stoptime({', '.join(STOP_TIME_COLUMNS)})")
+    cur.execute("CREATE INDEX IF NOT EXISTS temp.idx_delta_stoptime_trip ON delta_stoptime(trip_id)")
+    cur.execute("DELETE FROM temp.delta_stoptime")
+    diff = Diff(TRIP_STOPS_KIND)
+    path = os.path.join(data_dir, "stop_times.txt")
+    rows = fill_stop_times(GTFSFile(path, STOP_TIME_FILE_COLUMNS, converters=STOP_TIME_CONVERTERS).rows())
+    pending: List[tuple] = []
+    for trip_id, group in _trip_groups(rows, path):
+        new_hash = _stop_times_hash(group)
+        old_hash = old_hashes.pop(trip_id, None)
+        if old_hash == new_hash:
+            diff.unchanged += 1
+            continue
+        (diff.inserted if old_hash is None else diff.updated).append((trip_id,))
+        diff.new_hashes[trip_id] = new_hash
+        pending.extend(group)
+        if len(pending) >= CHUNK_SIZE:
+            cur.executemany("INSERT INTO temp.delta_stoptime VALUES (?,?,?,?,?)", pending)
+            pending = []
+    cur.executemany("INSERT INTO temp.delta_stoptime VALUES (?,?,?,?,?)", pending)
+    diff.deleted = list(old_hashes)
+    return diff
+
+
+def _temp_ids(cur: sqlite3.Cursor, name: str, ids) -> str:
+    cur.execute(f"CREATE TEMP TABLE IF NOT EXISTS {name}(id INTEGER PRIMARY KEY)")
+    cur.execute(f"DELETE FROM temp.{name}")
+    cur.executemany(f"INSERT OR IGNORE INTO temp.{name} VALUES (?)", ((i,) for i in ids))
+    return f"temp.{name}"
+
+
+def _apply_table(cur: sqlite3.Cursor, spec: TableSpec, diff: Diff):
+    placeholders = ", ".join("?" * len(spec.table_columns))
+    cur.executemany(f"DELETE FROM {spec.table} WHERE {spec.key} = ?",
+                    ((key,) for key in diff.deleted))
+    if spec.table == "stops":
+        # Updated in place, so the rowids the spatial and search indexes use stay valid
+        assignments = ", ".join(f"{c} = ?" for c in spec.table_columns if c != spec.key)
+        cur.executemany(
+            f"UPDATE stops SET {assignments} WHERE stop_id = ?",
+            (tuple(v for i, v in enumerate(row) if i != spec.key_index) + (row[spec.key_index],)
+             for row in diff.updated),
+        )
+    else:
+        cur.executemany(f"DELETE FROM {spec.table} WHERE {spec.key} = ?",
+                        ((row[spec.key_index],) for row in diff.updated))
+        cur.executemany(f"INSERT INTO {spec.table}({', '.join(spec.table_columns)}) VALUES ({placeholders})",
+                        diff.updated)
+    cur.executemany(f"INSERT INTO {spec.table}({', '.join(spec.table_columns)}) VALUES ({placeholders})",
+                    diff.inserted)
+
+
+@contextmanager
+def _write_transaction(cur: sqlite3.Cursor):
+    cur.execute("BEGIN IMMEDIATE")
+    try:
+        yield
+    except BaseException:
+        cur.execute("ROLLBACK")
+        raise
+    cur.execute("COMMIT")
+
+
+def _chunks(items: list, size: int) -> Iterator[list]:
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def _store_hashes(cur: sqlite3.Cursor, kind: str, new_hashes: Dict[int, int], deleted: Iterable[int]):
+    cur.executemany("DELETE FROM static_hashes WHERE kind = ? AND id = ?", ((kind, k) for k in deleted))
+    cur.executemany("INSERT OR REPLACE INTO static_hashes VALUES (?,?,?)",
+                    ((kind, k, h) for k, h in new_hashes.items()))
+
+
+def _store_baseline(cur: sqlite3.Cursor, kind: str, hashes: Dict[int, int]):
+    """
+    Stores the hashes computed from the tables, CHUNK_SIZE rows per transaction.
+    Until the last chunk is in, a marker in static_pending makes _stored_hashes
+    ignore them.
+    """
+    marker = BASELINE_PREFIX + kind
+    with _write_transaction(cur):
+        cur.execute("DELETE FROM static_hashes WHERE kind = ?", (kind,))
+        cur.execute("INSERT OR IGNORE INTO static_pending VALUES (?, 0)", (marker,))
+    for chunk in _chunks(list(hashes.items()), CHUNK_SIZE):
+        with _write_transaction(cur):
+            cur.executemany("INSERT INTO static_hashes VALUES (?,?,?)", ((kind, k, h) for k, h in chunk))
+    with _write_transaction(cur):
+        cur.execute("DELETE FROM static_pending WHERE kind = ?", (marker,))
+
+
+def _stage(cur: sqlite3.Cursor, kind: str, ids: Iterable[int]):
+    cur.executemany("INSERT OR IGNORE INTO static_pending VALUES (?,?)",
+                    ((kind, i) for i in ids if i is not None))
+
+
+def _pending(cur: sqlite3.Cursor, kind: str) -> Set[int]:
+    return {i for (i,) in cur.execute("SELECT id FROM static_pending WHERE kind = ?", (kind,))}
+
+
+def _trip_routes(cur: sqlite3.Cursor, trips_table: str) -> Set[int]:
+    return {route_id for (route_id,) in cur.execute(
+        f"SELECT DISTINCT route_id FROM trip WHERE trip_id IN (SELECT id FROM {trips_table})"
+    )}
+
+
+def import_delta(data_dir: str, db_path: str = DB_PATH, dry_run: bool = False) -> dict:
+    """
+    Applies the difference between the GTFS files in data_dir and the database.
+    Each step is its own transaction: the stops (with their spatial and search
+    index and cluster cells), routes, services and trips; the stop times,
+    TRIPS_PER_TRANSACTION trips at a time; the route patterns; and last the
+    version bump that makes backends drop their cached data.
+    :param dry_run: only compute and report the difference
+    :return: per kind inserted/updated/deleted/unchanged counts, affected stops and the new static version
+    :raises ValueError: if the feed changed too much for an incremental import or is not grouped by trip
+    """
+    start = time.time()
+    conn = sqlite3.connect(db_path, timeout=60)
+    conn.isolation_level = None  # explicit transactions only
+    cur = conn.cursor()
+    cur.execute("PRAGMA temp_store = FILE")  # staged stop times can be large
+    create_static_hash_table(cur)
+    create_static_change_tables(cur)
+
+    diffs: Dict[str, Diff] = {}
+    baselines: Dict[str, Dict[int, int]] = {}
+    for spec in TABLE_SPECS:
+        old = _stored_hashes(cur, spec.kind)
+        if old is None:
+            old = _table_hashes(cur, spec)
+            baselines[spec.kind] = dict(old)
+        diffs[spec.kind] = diff_table(spec, data_dir, old)
+        print(f"🔍 {spec.kind}: {diffs[spec.kind].report()}")
+    old = _stored_hashes(cur, TRIP_STOPS_KIND)
+    if old is None:
+        old = _stop_times_hashes(cur)
+        baselines[TRIP_STOPS_KIND] = dict(old)
+    diffs[TRIP_STOPS_KIND] = diff_stop_times(cur, data_dir, old)
+    print(f"🔍 {TRIP_STOPS_KIND}: {diffs[TRIP_STOPS_KIND].report()}")
+
+    report = {kind: diff.report() for kind, diff in diffs.items()}
+    trip_diff, stops_diff = diffs["trip"], diffs[TRIP_STOPS_KIND]
+    total_trips = len(trip_diff.inserted) + len(trip_diff.updated) + trip_diff.unchanged
+    changed_trips = trip_diff.changed_keys | stops_diff.changed_keys
+    if total_trips and len(changed_trips) > MAX_CHANGED_SHARE * total_trips:
+        conn.close()
+        raise ValueError(f"{len(changed_trips)} of {total_trips} trips changed; use the full import")
+    # An interrupted run left ids to log even if its rows are all in by now
+    interrupted = cur.execute(
+        "SELECT 1 FROM static_pending WHERE kind NOT LIKE ? LIMIT 1", (BASELINE_PREFIX + "%",)
+    ).fetchone() is not None
+    if dry_run or not (any(diffs.values()) or interrupted):
+        conn.close()
+        report.update(version=None, affected_stops=0, seconds=round(time.time() - start, 1))
+        return report
+
+    try:
+        for kind, baseline in baselines.items():
+            _store_baseline(cur, kind, baseline)
+
+        # What the delta invalidates, read before it is applied: the old calls
+        # of changed trips and of trips of changed routes, and every stop on a
+        # trip through a changed stop, as their boards and route lists embed its
+        # name and position. Plus the routes whose lines change.
+        stop_diff = diffs["stop"]
+        key_index = TABLE_SPECS[0].key_index
+        updated_stops = [row[key_index] for row in stop_diff.updated]
+        trips_table = _temp_ids(cur, "delta_trip_ids", changed_trips)
+        routes_table = _temp_ids(cur, "delta_route_ids", diffs["route"].changed_keys)
+        stops_table = _temp_ids(cur, "delta_stop_ids", updated_stops + stop_diff.deleted)
+        departures = {stop_id for (stop_id,) in cur.execute(f"""
+            SELECT DISTINCT stop_id FROM stoptime WHERE trip_id IN (SELECT id FROM {trips_table})
+            UNION
+            SELECT DISTINCT st.stop_id FROM trip t JOIN stoptime st ON st.trip_id = t.trip_id
+            WHERE t.route_id IN (SELECT id FROM {routes_table})
+            UNION
+            SELECT DISTINCT other.stop_id FROM stoptime st
+            JOIN stoptime other ON other.trip_id = st.trip_id
+            WHERE st.stop_id IN (SELECT id FROM {stops_table})
+        """)}
+        pattern_routes = _trip_routes(cur, trips_table) | diffs["route"].changed_keys
+        pattern_routes |= routes_through_stops(cur, stop_diff.changed_keys)
+        with _write_transaction(cur):
+            _stage(cur, "stop", stop_diff.changed_keys)
+            _stage(cur, "departures", departures | stop_diff.changed_keys)
+            _stage(cur, "trip", changed_trips)
+            _stage(cur, "route", diffs["route"].changed_keys)
+            _stage(cur, "service", diffs["service"].changed_keys)
+            _stage(cur, PATTERN_ROUTES_KIND, pattern_routes)
+
+        # Cluster cells are recomputed where the changed stops were and are now,
+        # together with the stops, so the two never disagree
+        with _write_transaction(cur):
+            cells = stop_cells(cur, updated_stops + stop_diff.deleted)
+            unindex_stops_rtree(cur, updated_stops + stop_diff.deleted)
+            unindex_stops_fts(cur, updated_stops + stop_diff.deleted)
+            for spec in TABLE_SPECS:
+                diff = diffs[spec.kind]
+                _apply_table(cur, spec, diff)
+                _store_hashes(cur, spec.kind, diff.new_hashes, diff.deleted)
+            indexed_stops = updated_stops + [row[key_index] for row in stop_diff.inserted]
+            index_stops_rtree(cur, indexed_stops)
+            index_stops_fts(cur, indexed_stops)
+            refresh_stop_clusters(cur, cells | stop_cells(cur, indexed_stops))
+            _stage(cur, PATTERN_ROUTES_KIND, _trip_routes(cur, trips_table))
+
+        for chunk in _chunks(sorted(stops_diff.changed_keys), TRIPS_PER_TRANSACTION):
+            with _write_transaction(cur):
+                chunk_table = _temp_ids(cur, "delta_chunk_ids", chunk)
+                cur.executemany("DELETE FROM stoptime WHERE trip_id = ?", ((trip_id,) for trip_id in chunk))
+                cur.execute(f"INSERT OR REPLACE INTO stoptime({', '.join(STOP_TIME_COLUMNS)}) "
+                            f"SELECT {', '.join(STOP_TIME_COLUMNS)} FROM temp.delta_stoptime "
+                            f"WHERE trip_id IN (SELECT id FROM {chunk_table})")
+                # The new calls, next to the old ones staged above
+                cur.execute(f"""
+                    INSERT OR IGNORE INTO static_pending
+                    SELECT DISTINCT 'departures', stop_id FROM temp.delta_stoptime
+                    WHERE trip_id IN (SELECT id FROM {chunk_table})
+                """)
+                _store_hashes(cur, TRIP_STOPS_KIND,
+                              {trip_id: stops_diff.new_hashes[trip_id]
+                               for trip_id in chunk if trip_id in stops_diff.new_hashes},
+                              [trip_id for trip_id in chunk if trip_id not in stops_diff.new_hashes])
+
+        for chunk in _chunks(sorted(_pending(cur, PATTERN_ROUTES_KIND)), ROUTES_PER_TRANSACTION):
+            with _write_transaction(cur):
+                refresh_route_patterns(cur, chunk)
+
+        with _write_transaction(cur):
+            changes = {kind: _pending(cur, kind) for kind in CHANGE_KINDS}
+            version = record_static_changes(cur, changes)
+            cur.execute("DELETE FROM static_pending")
+    finally:
+        conn.close()
+
+    report.update(version=version, affected_stops=len(changes["departures"]),
+                  seconds=round(time.time() - start, 1))
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Apply only the changes of a new static GTFS feed")
+    parser.add_argument("--data", default=os.path.join(os.getenv("DB_DIR", "."), "data"),
+                        help="directory with the new GTFS text files")
+    parser.add_argument("--db", default=DB_PATH, help="live database to update")
+    parser.add_argument("--dry-run", action="store_true", help="only report what would change")
+    args = parser.parse_args()
+    report = import_delta(args.data, args.db, args.dry_run)
+    print(f"✅ {report}")
+    if report["version"] is not None:
+        write_snapshot(args.db)
+
+
+if __name__ == "__main__":
+    main()
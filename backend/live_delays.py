@@ -0,0 +1,107 @@
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+from db_pool import get_cursor
+from metrics import SQLTimer
+
+# How often every worker's background task re-checks feed_state for a newer realtime version
+VERSION_CHECK_INTERVAL: float = 2.0
+# Feed whose version the store follows (see update_live_data)
+FEED_NAME: str = "gtfs_rt"
+
+
+def _key(trip_id: int, stop_id: int) -> int:
+    # One int per key instead of a tuple keeps the dict small at nationwide scale
+    return (trip_id << 32) | (stop_id & 0xFFFFFFFF)
+
+
+class DelaySnapshot:
+    """
+    Immutable view of trip_updates at one realtime version, keyed by integer ids.
+    """
+    __slots__ = ("version", "delays", "last_stops", "built_at")
+
+    def __init__(self, version: int, delays: Dict[int, Tuple[int, int]], last_stops: Dict[int, int]):
+        self.version = version
+        self.delays = delays
+        self.last_stops = last_stops
+        self.built_at = time.time()
+
+    def delay(self, trip_id: int, stop_id: int) -> Optional[Tuple[int, int]]:
+        """
+        :return: (arrival_delay, departure_delay) in seconds, or None without an update
+        """
+        return self.delays.get(_key(trip_id, stop_id))
+
+    def last_known_stop(self, trip_id: int) -> Optional[int]:
+        return self.last_stops.get(trip_id)
+
+    def __len__(self) -> int:
+        return len(self.delays)
+
+
+class LiveDelayStore:
+    """
+    In-memory delays shared by all endpoints. A new snapshot is built off to the
+    side and swapped in with one reference assignment, so readers never see a
+    half-built store and never take a lock. Snapshots are only built by refresh(),
+    which the ingest job and a background task per worker call (see
+    _watch_live_delays in backend.py); requests never read trip_updates.
+    """
+
+    def __init__(self):
+        self._snapshot = DelaySnapshot(-1, {}, {})
+        self._feed_versions: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def _db_versions(self) -> Dict[str, int]:
+        return dict(get_cursor().execute("SELECT feed, version FROM feed_state").fetchall())
+
+    def _build(self, version: int) -> DelaySnapshot:
+        delays, last_stops = {}, {}
+        cur = get_cursor()
+        with SQLTimer("live_delays_snapshot", cur) as timer:
+            cur.execute("SELECT trip_id, stop_id, arrival_delay, departure_delay FROM trip_updates ORDER BY rowid")
+            for trip_id, stop_id, arrival_delay, departure_delay in cur:
+                try:
+                    trip_id, stop_id = int(trip_id), int(stop_id)
+                except (TypeError, ValueError):
+                    continue
+                delays[_key(trip_id, stop_id)] = (arrival_delay or 0, departure_delay or 0)
+                last_stops[trip_id] = stop_id
+            timer.rows = len(delays)
+        return DelaySnapshot(version, delays, last_stops)
+
+    def refresh(self, force: bool = False) -> DelaySnapshot:
+        """
+        Rebuilds the snapshot if the database holds a newer realtime version.
+        Called by the ingest job after each write and every VERSION_CHECK_INTERVAL
+        by each worker's background task. Blocking.
+        """
+        with self._lock:
+            self._feed_versions = self._db_versions()
+            version = self._feed_versions.get(FEED_NAME, 0)
+            if force or version != self._snapshot.version:
+                self._snapshot = self._build(version)
+            return self._snapshot
+
+    def current(self) -> DelaySnapshot:
+        """
+        The latest snapshot built by refresh(). Never queries.
+        """
+        return self._snapshot
+
+    def feed_version(self, feed: str) -> int:
+        """
+        Version of any feed in feed_state as of the last refresh(), e.g. "other_vehicles".
+        """
+        return self._feed_versions.get(feed, 0)
+
+    def clear(self):
+        with self._lock:
+            self._snapshot = DelaySnapshot(-1, {}, {})
+            self._feed_versions = {}
+
+
+live_delays = LiveDelayStore()
@@ -0,0 +1,358 @@
+"""
+Estimated positions of every running trip, for /live_vehicles. The German feed
+has trip updates but no vehicle positions, so they are interpolated from the
+timetable: on every tick the writer worker takes all trips running at that
+moment in one pass over the trip-ordered call arrays, shifts their scheduled
+times by the propagated delays and places each vehicle between the stop it
+last left and the one it is heading to. The positions replace live_vehicles
+and its R*Tree in one transaction; readers only run bbox queries on it.
+"""
+import math
+import os
+import sqlite3
+import threading
+import time
+from array import array
+from bisect import bisect_right
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from db_pool import DB_PATH, get_cursor
+from live_delays import DelaySnapshot, live_delays
+from metrics import SQLTimer
+from serialization import COLUMN_FORMAT, dicts_to_columns
+from service_calendar import SECONDS_PER_DAY, service_calendar
+from spatial_index import LIVE_VEHICLE_COLUMNS, create_spatial_tables, live_vehicles_in_bbox, rebuild_live_vehicles_rtree
+from timetable_snapshot import TimetableSnapshot, timetable_snapshots
+
+# Key of the estimated positions in feed_state, bumped on every pass
+LIVE_VEHICLES_FEED_NAME: str = "live_vehicles"
+# Vehicles returned per /live_vehicles request at most
+LIVE_VEHICLES_LIMIT: int = int(os.getenv("LIVE_VEHICLES_LIMIT", "5000"))
+# How late a trip may run past its scheduled end and still be looked at
+MAX_DELAY_SECONDS: int = int(os.getenv("LIVE_VEHICLES_MAX_DELAY", "3600"))
+# Trips are grouped by the spans of the service day they may be running in
+BUCKET_SECONDS: int = 1800
+
+# Row of live_vehicles as produced by a pass, in insert order
+_ROW_COLUMNS = (
+    "trip_id", "route_id", "route_short_name", "route_type", "lat", "lon", "bearing", "delay",
+    "stop_id", "next_stop_id", "next_lat", "next_lon", "next_arrival",
+)
+
+
+def create_live_vehicle_tables(cur: sqlite3.Cursor):
+    """
+    Creates live_vehicles if missing; its R*Tree comes with create_spatial_tables.
+    """
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS live_vehicles(
+            id INTEGER PRIMARY KEY,
+            trip_id INTEGER NOT NULL,
+            route_id INTEGER,
+            route_short_name TEXT,
+            route_type INTEGER,
+            lat REAL NOT NULL,
+            lon REAL NOT NULL,
+            bearing REAL,
+            delay INTEGER,
+            stop_id INTEGER,
+            next_stop_id INTEGER,
+            next_lat REAL,
+            next_lon REAL,
+            next_arrival INTEGER
+        )
+    """)
+
+
+class TripSchedule:
+    """
+    The calls of every trip in stop_sequence order as flat arrays, grouped by
+    trip through call_offsets (the layout of the snapshot's trip_call_* sections),
+    plus the trips that may be running in each BUCKET_SECONDS span of the service day.
+    """
+
+    def __init__(self, stop_ids: Sequence[int], stop_lats: Sequence[float], stop_lons: Sequence[float],
+                 route_ids: Sequence[int], route_types: Sequence[int], route_names: Sequence[Optional[str]],
+                 trip_ids: Sequence[int], trip_routes: Sequence[int], call_offsets: Sequence[int],
+                 call_stops: Sequence[int], arrivals: Sequence[int], departures: Sequence[int]):
+        self.stop_ids, self.stop_lats, self.stop_lons = stop_ids, stop_lats, stop_lons
+        self.route_ids, self.route_types, self.route_names = route_ids, route_types, route_names
+        self.trip_ids, self.trip_routes = trip_ids, trip_routes
+        self.call_offsets, self.call_stops = call_offsets, call_stops
+        self.arrivals, self.departures = arrivals, departures
+        self.buckets = self._bucket()
+
+    @classmethod
+    def from_snapshot(cls, snapshot: TimetableSnapshot) -> "TripSchedule":
+        """
+        Reads the trip-ordered calls in place from the mapped snapshot.
+        """
+        return cls(snapshot.stop_ids, snapshot.stop_lats, snapshot.stop_lons,
+                   snapshot.route_ids, snapshot.route_types, snapshot.route_name_list,
+                   snapshot.trip_ids, snapshot.trip_routes, snapshot.trip_call_offsets,
+                   snapshot.trip_call_stops, snapshot.trip_call_arrivals, snapshot.trip_call_departures)
+
+    @classmethod
+    def from_db(cls, cur: sqlite3.Cursor) -> "TripSchedule":
+        """
+        Loads the same arrays from the static tables, for databases without a snapshot.
+        """
+        stops = cur.execute("""
+            SELECT stop_id, MIN(latitude), MIN(longitude) FROM stops
+            WHERE stop_id IS NOT NULL GROUP BY stop_id ORDER BY stop_id
+        """).fetchall()
+        stop_index = {row[0]: i for i, row in enumerate(stops)}
+        routes = cur.execute("""
+            SELECT route_id, MIN(route_type), MIN(route_short_name) FROM routes
+            WHERE route_id IS NOT NULL GROUP BY route_id ORDER BY route_id
+        """).fetchall()
+        route_index = {row[0]: i for i, row in enumerate(routes)}
+        trips = cur.execute("""
+            SELECT trip_id, MIN(route_id) FROM trip
+            WHERE trip_id IS NOT NULL GROUP BY trip_id ORDER BY trip_id
+        """).fetchall()
+        trip_index = {row[0]: i for i, row in enumerate(trips)}
+
+        counts = [0] * (len(trips) + 1)
+        call_stops, arrivals, departures = array("i"), array("i"), array("i")
+        with SQLTimer("live_vehicles_schedule", cur) as timer:
+            # See write_snapshot: a sorted scan beats the non-covering trip index
+            cur.execute("""
+                WITH calls AS MATERIALIZED (
+                    SELECT trip_id, stop_id, stop_sequence, arrival_secs, departure_secs FROM stoptime
+                )
+                SELECT trip_id, stop_id, arrival_secs, departure_secs FROM calls ORDER BY trip_id, stop_sequence
+            """)
+            for trip_id, stop_id, arrival, departure in cur:
+                ti, si = trip_index.get(trip_id), stop_index.get(stop_id)
+                if ti is None or si is None:
+                    continue
+                counts[ti + 1] += 1
+                call_stops.append(si)
+                arrivals.append(arrival)
+                departures.append(departure)
+            timer.rows = len(call_stops)
+        for i in range(1, len(counts)):
+            counts[i] += counts[i - 1]
+
+        nan = float("nan")
+        return cls(
+            array("q", (row[0] for row in stops)),
+            array("d", (nan if row[1] is None else row[1] for row in stops)),
+            array("d", (nan if row[2] is None else row[2] for row in stops)),
+            array("q", (row[0] for row in routes)),
+            array("i", (row[1] or 0 for row in routes)),
+            [row[2] or None for row in routes] + [None],
+            array("q", (row[0] for row in trips)),
+            array("i", (route_index.get(row[1], -1) for row in trips)),
+            array("q", counts), call_stops, arrivals, departures,
+        )
+
+    def _bucket(self) -> Dict[int, array]:
+        buckets = defaultdict(lambda: array("i"))
+        offsets, arrivals, departures = self.call_offsets, self.arrivals, self.departures
+        for ti in range(len(self.trip_ids)):
+            start, stop = offsets[ti], offsets[ti + 1]
+            # A trip needs two calls to be somewhere between them
+            if stop - start < 2:
+                continue
+            first, last = departures[start], arrivals[stop - 1] + MAX_DELAY_SECONDS
+            for bucket in range(first // BUCKET_SECONDS, last // BUCKET_SECONDS + 1):
+                buckets[bucket].append(ti)
+        return dict(buckets)
+
+    def _delayed_times(self, ti: int, delays: DelaySnapshot) -> Tuple[List[int], List[int]]:
+        # A delay holds for the following calls until the next update; calls before
+        # the first update keep their schedule
+        trip_id = self.trip_ids[ti]
+        arrivals, departures = [], []
+        delay = 0
+        for call in range(self.call_offsets[ti], self.call_offsets[ti + 1]):
+            arrival_delay = delay
+            update = delays.delay(trip_id, self.stop_ids[self.call_stops[call]])
+            if update is not None:
+                arrival_delay, delay = update
+            arrival = self.arrivals[call] + arrival_delay
+            arrivals.append(arrival)
+            departures.append(max(arrival, self.departures[call] + delay))
+        return arrivals, departures
+
+    def positions(self, now: datetime, delays: DelaySnapshot) -> List[tuple]:
+        """
+        Estimated positions of all trips running at `now`: today's services, and
+        yesterday's for trips whose times run past midnight.
+        :return: rows in _ROW_COLUMNS order
+        """
+        rows = []
+        seconds = now.hour * 3600 + now.minute * 60 + now.second + now.microsecond / 1e6
+        today = now.date()
+        for day, t in ((today, seconds), (today - timedelta(days=1), seconds + SECONDS_PER_DAY)):
+            candidates = self.buckets.get(int(t) // BUCKET_SECONDS)
+            if not candidates:
+                continue
+            running = service_calendar.active_trips(day)
+            day_start = datetime.combine(day, datetime.min.time()).timestamp()
+            for ti in candidates:
+                trip_id = self.trip_ids[ti]
+                if trip_id not in running:
+                    continue
+                start, stop = self.call_offsets[ti], self.call_offsets[ti + 1]
+                if delays.last_known_stop(trip_id) is None:
+                    arrivals, departures, lo, hi, base = self.arrivals, self.departures, start, stop, 0
+                else:
+                    arrivals, departures = self._delayed_times(ti, delays)
+                    lo, hi, base = 0, stop - start, start
+                # First call still ahead; before it the trip has not started, after the last it is done
+                i = bisect_right(departures, t, lo, hi)
+                if i == lo or i == hi:
+                    continue
+                row = self._row(ti, base + i, t, arrivals[i], departures[i - 1], arrivals[i] - self.arrivals[base + i],
+                                day_start)
+                if row is not None:
+                    rows.append(row)
+        return rows
+
+    def _row(self, ti: int, call: int, t: float, arrival: int, previous_departure: int, delay: int,
+             day_start: float) -> Optional[tuple]:
+        previous, following = self.call_stops[call - 1], self.call_stops[call]
+        lat1, lon1 = self.stop_lats[previous], self.stop_lons[previous]
+        lat2, lon2 = self.stop_lats[following], self.stop_lons[following]
+        if math.isnan(lat1) or math.isnan(lon1) or math.isnan(lat2) or math.isnan(lon2):
+            return None
+        # Standing at the next stop once it is reached, until its departure
+        fraction = 1.0 if t >= arrival or arrival <= previous_departure else \
+            (t - previous_departure) / (arrival - previous_departure)
+        route = self.trip_routes[ti]
+        return (
+            self.trip_ids[ti],
+            self.route_ids[route] if route >= 0 else None,
+            self.route_names[route],
+            self.route_types[route] if route >= 0 else None,
+            round(lat1 + (lat2 - lat1) * fraction, 6),
+            round(lon1 + (lon2 - lon1) * fraction, 6),
+            _bearing(lat1, lon1, lat2, lon2),
+            delay,
+            self.stop_ids[previous],
+            self.stop_ids[following],
+            lat2,
+            lon2,
+            int(day_start + arrival),
+        )
+
+
+def _bearing(lat1: float, lon1: float, lat2: float, lon2: float) -> Optional[float]:
+    # Initial great circle bearing in degrees clockwise from north
+    if lat1 == lat2 and lon1 == lon2:
+        return None
+    phi1, phi2, dlon = math.radians(lat1), math.radians(lat2), math.radians(lon2 - lon1)
+    y = math.sin(dlon) * math.cos(phi2)
+    x = math.cos(phi1) * math.sin(phi2) - math.sin(phi1) * math.cos(phi2) * math.cos(dlon)
+    return round((math.degrees(math.atan2(y, x)) + 360) % 360, 1)
+
+
+def store_live_vehicles(db_path: str, rows: List[tuple], computed_at: int):
+    """
+    Replaces live_vehicles and its spatial index with one pass's positions and
+    bumps the live_vehicles version. Rows are staged before the write lock is taken.
+    :param rows: from TripSchedule.positions
+    :param computed_at: unix time the positions are for, kept as header_timestamp
+    """
+    conn = sqlite3.connect(db_path, timeout=30)
+    conn.isolation_level = None  # explicit transactions only
+    cur = conn.cursor()
+    cur.execute("PRAGMA synchronous = NORMAL")
+    try:
+        create_live_vehicle_tables(cur)
+        create_spatial_tables(cur)
+        cur.execute(f"CREATE TEMP TABLE IF NOT EXISTS live_vehicles_stage({', '.join(_ROW_COLUMNS)})")
+        cur.execute("DELETE FROM live_vehicles_stage")
+        cur.executemany(f"INSERT INTO live_vehicles_stage VALUES ({', '.join('?' * len(_ROW_COLUMNS))})", rows)
+
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            with SQLTimer("live_vehicles_store", cur) as timer:
+                cur.execute("DELETE FROM live_vehicles")
+                cur.execute(f"""
+                    INSERT INTO live_vehicles({', '.join(_ROW_COLUMNS)})
+                    SELECT {', '.join(_ROW_COLUMNS)} FROM live_vehicles_stage
+                """)
+                timer.rows = cur.rowcount
+                rebuild_live_vehicles_rtree(cur)
+            cur.execute("""
+                INSERT INTO feed_state(feed, header_timestamp, version, updated_at)
+                VALUES (?, ?, 1, strftime('%s', 'now'))
+                ON CONFLICT(feed) DO UPDATE SET
+                    header_timestamp = excluded.header_timestamp,
+                    version = version + 1,
+                    updated_at = excluded.updated_at
+            """, (LIVE_VEHICLES_FEED_NAME, computed_at))
+            cur.execute("COMMIT")
+        except Exception:
+            cur.execute("ROLLBACK")
+            raise
+    finally:
+        conn.close()
+
+
+class LiveVehicleTracker:
+    """
+    Runs the position passes in the writer worker. The trip schedule is taken
+    from the timetable snapshot when one is mapped and loaded from SQLite once
+    otherwise; clear() after a swap or a static change rebuilds it.
+    """
+
+    def __init__(self):
+        self._schedule: Optional[TripSchedule] = None
+        self._source: Optional[TimetableSnapshot] = None
+        self._lock = threading.Lock()
+
+    def clear(self):
+        with self._lock:
+            self._schedule = None
+            self._source = None
+
+    def schedule(self) -> TripSchedule:
+        snapshot = timetable_snapshots.current()
+        with self._lock:
+            if self._schedule is None or (snapshot is not None and snapshot is not self._source):
+                start = time.time()
+                if snapshot is not None:
+                    self._schedule = TripSchedule.from_snapshot(snapshot)
+                else:
+                    self._schedule = TripSchedule.from_db(get_cursor())
+                self._source = snapshot
+                print(f"🚆 Live vehicle schedule built from {'snapshot' if snapshot else 'SQLite'} "
+                      f"({len(self._schedule.trip_ids):,} trips) in {time.time() - start:.1f}s")
+            return self._schedule
+
+    def update(self, db_path: str = DB_PATH, now: Optional[datetime] = None) -> dict:
+        """
+        Computes and stores the positions of every running trip. Blocking.
+        :return: status fields for the scheduler
+        """
+        now = now or datetime.now()
+        rows = self.schedule().positions(now, live_delays.current())
+        computed_at = int(now.timestamp())
+        store_live_vehicles(db_path, rows, computed_at)
+        return {"vehicles": len(rows), "computed_at": computed_at}
+
+
+def get_live_vehicles(south: float, north: float, west: float, east: float,
+                      limit: int = LIVE_VEHICLES_LIMIT, fmt: Optional[str] = None) -> dict:
+    """
+    Estimated vehicle positions inside a bounding box. Each vehicle is where it
+    was at computed_at and heads for next_latitude/next_longitude, which it
+    reaches at next_arrival (unix time), so clients can animate it until the next pass.
+    :param fmt: COLUMN_FORMAT for one list per field instead of one object per vehicle
+    """
+    cur = get_cursor()
+    row = cur.execute("SELECT header_timestamp FROM feed_state WHERE feed = ?", (LIVE_VEHICLES_FEED_NAME,)).fetchone()
+    vehicles = live_vehicles_in_bbox(cur, south, north, west, east, limit)
+    if fmt == COLUMN_FORMAT:
+        vehicles = dicts_to_columns(LIVE_VEHICLE_COLUMNS, vehicles)
+    return {"computed_at": row[0] if row else None, "vehicles": vehicles}
+
+
+live_vehicle_tracker = LiveVehicleTracker()
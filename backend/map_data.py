@@ -1,5 +1,15 @@
 import sqlite3
-import time
+
+from database import create_static_indexes, create_static_tables, migrate_static_schema
+from db_pool import get_cursor
+from metrics import SQLTimer
+from search import create_search_index, rebuild_search_index
+from live_vehicles import create_live_vehicle_tables
+from clustering import CLUSTER_COLUMNS, clustered_stops, create_cluster_tables, rebuild_stop_clusters
+from route_patterns import create_route_pattern_tables, patterns_in_bbox, rebuild_route_patterns
+from serialization import COLUMN_FORMAT, ROW_FORMAT, dicts_to_columns
+from static_changes import create_static_change_tables
+from spatial_index import STOP_COLUMNS, VEHICLE_COLUMNS, create_spatial_tables, rebuild_stops_rtree, vehicles_in_bbox
 
 def initialize_db(db_path: str):
     """
@@ -10,38 +20,13 @@ def initialize_db(db_path: str):
     conn = sqlite3.connect(db_path)
     cur = conn.cursor()
 
+    # WAL lets the pooled readers keep serving while live data is written
+    cur.execute("PRAGMA journal_mode=WAL")
+
     # Create tables
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS stops(
-            stop_name TEXT,
-            longitude REAL,
-            latitude REAL,
-            stop_id INTEGER PRIMARY KEY,
-            location_type INTEGER
-        )
-    """)
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS trip(
-            route_id INTEGER,
-            service_id INTEGER,
-            trip_id INTEGER PRIMARY KEY
-        )
-    """)
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS stoptime(
-            trip_id INTEGER,
-            arrival_time TEXT,
-            departure_time TEXT,
-            stop_id INTEGER,
-            stop_sequence INTEGER
-        )
-    """)
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS service(
-            mon INTEGER, tue INTEGER, wed INTEGER, thur INTEGER, fri INTEGER,
-            sat INTEGER, sun INTEGER, start_date INTEGER, end_date INTEGER, service_id INTEGER PRIMARY KEY
-        )
-    """)
+    create_static_tables(cur)
+    # Databases of the text-time layout get the integer stoptime table
+    migrate_static_schema(cur)
     cur.execute("""
         CREATE TABLE IF NOT EXISTS trip_updates(
             schedule_status INTEGER,
@@ -56,57 +41,183 @@ def initialize_db(db_path: str):
             header TEXT, description TEXT, cause INTEGER, effect INTEGER
         )
     """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS feed_state(
+            feed TEXT PRIMARY KEY,
+            header_timestamp INTEGER,
+            version INTEGER NOT NULL DEFAULT 0,
+            updated_at INTEGER
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS other_vehicles(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            vehicle_id TEXT NOT NULL,
+            form_factor TEXT,
+            lat REAL,
+            lon REAL,
+            current_range_meters INTEGER,
+            last_reported TEXT,
+            rental_uris_web TEXT
+        )
+    """)
+    create_live_vehicle_tables(cur)
+    create_spatial_tables(cur)
+    create_cluster_tables(cur)
+    create_route_pattern_tables(cur)
+    create_search_index(cur)
+    create_static_change_tables(cur)
 
     # Create indexes
-    cur.execute("CREATE INDEX IF NOT EXISTS idx_stops_lat_lon ON stops(latitude, longitude)")
-    cur.execute("CREATE INDEX IF NOT EXISTS idx_stoptime_trip_id ON stoptime(trip_id)")
-    cur.execute("CREATE INDEX IF NOT EXISTS idx_stoptime_stop_id ON stoptime(stop_id)")
-    cur.execute("CREATE INDEX IF NOT EXISTS idx_stoptime_trip_sequence ON stoptime(trip_id, stop_sequence)")
-    cur.execute("CREATE INDEX IF NOT EXISTS idx_trip_trip_id ON trip(trip_id)")
-    cur.execute("CREATE INDEX IF NOT EXISTS idx_trip_route_id ON trip(route_id)")
+    create_static_indexes(cur)
     cur.execute("CREATE INDEX IF NOT EXISTS idx_trip_updates_trip ON trip_updates(trip_id)")
     cur.execute("CREATE INDEX IF NOT EXISTS idx_trip_updates_stop ON trip_updates(stop_id)")
 
+    # Realtime ingestion upserts by (trip_id, stop_id); drop duplicates left by the
+    # old delete-and-reinsert loader before adding the unique key
+    has_key = cur.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_trip_updates_key'"
+    ).fetchone()
+    if not has_key:
+        cur.execute("""
+            DELETE FROM trip_updates
+            WHERE rowid NOT IN (SELECT MAX(rowid) FROM trip_updates GROUP BY trip_id, stop_id)
+        """)
+        cur.execute("CREATE UNIQUE INDEX idx_trip_updates_key ON trip_updates(trip_id, stop_id)")
+
+    # Spatial index for /map_data, refilled only when the stops table changed
+    stops_changed = rebuild_stops_rtree(cur)
+    if stops_changed:
+        print("rebuilt stops_rtree")
+    # Per zoom band clusters for large /map_data viewports
+    if rebuild_stop_clusters(cur, force=stops_changed):
+        print("rebuilt stop_clusters")
+    # Distinct stop sequences per route for the /map_data lines
+    if rebuild_route_patterns(cur, force=stops_changed):
+        print("rebuilt route_patterns")
+    # Trigram index for /search_stations
+    if rebuild_search_index(cur):
+        print("rebuilt stops_fts")
+
     conn.commit()
     conn.close()
 
 
-def update_live_data(database_path: str, rt_updates):
+def update_live_data(database_path: str, rt_updates, feed: str = "gtfs_rt") -> dict:
     """
-    Inserts live GTFS updates into trip_updates and alerts tables.
-    Wraps in a transaction for speed.
+    Applies a realtime feed to trip_updates and alerts in one short WAL transaction.
+    Only (trip_id, stop_id) rows that are new, changed or gone are written, and
+    nothing is written if the feed header timestamp matches the last applied one.
+    :param rt_updates: [vehicles, trip_updates, alerts, header_timestamp] as returned by download_rt_gtfs_data,
+        or RealtimeFeed.as_stream(); trip_updates may be a generator and is consumed before alerts are read
+    :param feed: key of this feed in feed_state
+    :return: summary with skipped, upserted, deleted and version
     """
-    conn = sqlite3.connect(database_path)
+    header_timestamp = rt_updates[3] if len(rt_updates) > 3 else None
+
+    conn = sqlite3.connect(database_path, timeout=30)
+    conn.isolation_level = None  # explicit transactions only
     cur = conn.cursor()
+    cur.execute("PRAGMA synchronous = NORMAL")
 
-    cur.execute("DELETE FROM trip_updates")
-    cur.execute("DELETE FROM alerts")
+    summary = {"skipped": False, "upserted": 0, "deleted": 0, "version": None}
+    # Cheap check before decoding the rest of the feed
+    row = cur.execute("SELECT header_timestamp, version FROM feed_state WHERE feed = ?", (feed,)).fetchone()
+    if header_timestamp and row and row[0] == header_timestamp:
+        summary.update(skipped=True, version=row[1])
+        conn.close()
+        return summary
 
-    with conn:
+    # Staged outside the write lock; the primary key keeps the last row per key
+    cur.execute("""
+        CREATE TEMP TABLE IF NOT EXISTS trip_updates_stage(
+            trip_id TEXT, stop_id TEXT, arrival_delay INTEGER, departure_delay INTEGER,
+            PRIMARY KEY (trip_id, stop_id)
+        )
+    """)
+    cur.execute("DELETE FROM trip_updates_stage")
+    with SQLTimer("ingest_stage", cur) as timer:
         cur.executemany(
-            "INSERT INTO trip_updates(trip_id, stop_id, arrival_delay, departure_delay) VALUES (?,?,?,?)",
+            "INSERT OR REPLACE INTO trip_updates_stage(trip_id, stop_id, arrival_delay, departure_delay) VALUES (?,?,?,?)",
             rt_updates[1]
         )
+        timer.rows = cur.rowcount
+
+    cur.execute("BEGIN IMMEDIATE")
+    try:
+        row = cur.execute(
+            "SELECT header_timestamp, version FROM feed_state WHERE feed = ?", (feed,)
+        ).fetchone()
+        version = row[1] if row else 0
+        if header_timestamp and row and row[0] == header_timestamp:
+            cur.execute("ROLLBACK")
+            summary.update(skipped=True, version=version)
+            conn.close()
+            return summary
+
+        with SQLTimer("ingest_upsert", cur) as timer:
+            cur.execute("""
+                INSERT INTO trip_updates(trip_id, stop_id, arrival_delay, departure_delay)
+                SELECT trip_id, stop_id, arrival_delay, departure_delay FROM trip_updates_stage WHERE true
+                ON CONFLICT(trip_id, stop_id) DO UPDATE SET
+                    arrival_delay = excluded.arrival_delay,
+                    departure_delay = excluded.departure_delay
+                WHERE arrival_delay IS NOT excluded.arrival_delay
+                   OR departure_delay IS NOT excluded.departure_delay
+            """)
+            summary["upserted"] = timer.rows = cur.rowcount
+        with SQLTimer("ingest_delete", cur) as timer:
+            cur.execute("""
+                DELETE FROM trip_updates
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM trip_updates_stage s
+                    WHERE s.trip_id = trip_updates.trip_id AND s.stop_id = trip_updates.stop_id
+                )
+            """)
+            summary["deleted"] = timer.rows = cur.rowcount
+
+        # Alerts are a handful of rows without a key, replaced wholesale
+        cur.execute("DELETE FROM alerts")
         cur.executemany(
             "INSERT INTO alerts(header, description, cause, effect) VALUES (?,?,?,?)",
             rt_updates[2]
         )
 
+        version += 1
+        cur.execute("""
+            INSERT INTO feed_state(feed, header_timestamp, version, updated_at)
+            VALUES (?, ?, ?, strftime('%s', 'now'))
+            ON CONFLICT(feed) DO UPDATE SET
+                header_timestamp = excluded.header_timestamp,
+                version = excluded.version,
+                updated_at = excluded.updated_at
+        """, (feed, header_timestamp, version))
+        cur.execute("COMMIT")
+    except Exception:
+        cur.execute("ROLLBACK")
+        conn.close()
+        raise
+
+    summary["version"] = version
     conn.close()
+    return summary
 
 
-def handle_map_update_request(db_path, bounds, max_stops=100):
+def handle_map_update_request(bounds, max_stops=100, max_routes=100):
     """
-    Fetch stops and routes within a map area (with optional buffer), sample stops,
-    fetch representative trips per route, and return structured JSON response.
+    Fetch stops and route lines within a map area (with optional buffer), cluster
+    stops beyond max_stops, and return structured JSON response. Routes are the
+    precomputed route patterns serving a stop in the area, busiest first.
+    With bounds["format"] == COLUMN_FORMAT stops, clusters and escooters are sent
+    as one list per field instead of one object per item.
     """
-    t0 = time.time()
     north, south, east, west = bounds["north"], bounds["south"], bounds["east"], bounds["west"]
     buffer_meters = bounds.get("buffer_meters", 0)
-
-    if north-south > 0.1:
-        return {"type": "MapDataResponse", "payload": {"stops": [], "routes": []}}
-
+    # Clients that load stops from /tiles only ask for the e-scooters here
+    include_stops = bounds.get("include_stops", True)
+    # Lines are opt-in: the frontend does not draw them yet
+    include_routes = bounds.get("include_routes", False)
+    fmt = bounds.get("format") or ROW_FORMAT
 
     #print(f"North {north}, South {south}, West {west}, east {east}")
 
@@ -117,102 +228,26 @@ def handle_map_update_request(db_path, bounds, max_stops=100):
     east += deg_buf
     west -= deg_buf
 
-    conn = sqlite3.connect(db_path)
-    conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
-
-    # Fetch stops inside bounds
-    cur.execute("""
-        SELECT stop_id, stop_name, latitude, longitude
-        FROM stops
-        WHERE latitude BETWEEN ? AND ?
-          AND longitude BETWEEN ? AND ?
-    """, (south, north, west, east))
-    all_stops = [dict(row) for row in cur.fetchall()]
-    if not all_stops:
-        conn.close()
-        return {"type": "MapDataResponse", "payload": {"stops": [], "routes": []}}
-
-    # Randomly sample stops if too many
-    #stops = random.sample(all_stops, max_stops) if len(all_stops) > max_stops else all_stops
-    stops = all_stops
-    stop_ids_in_area = {s["stop_id"] for s in stops}
-    routes = []
+    cur = get_cursor()
 
-    cur.execute("""
-        SELECT vehicle_id, lat AS latitude, lon AS longitude, form_factor
-        FROM other_vehicles
-        WHERE lat BETWEEN ? AND ?
-          AND lon BETWEEN ? AND ?
-    """, (south, north, west, east))
-    escooters = [dict(row) for row in cur.fetchall()]
-    print(escooters)
-
-    return {"type": "MapDataResponse", "payload": {"stops": stops, "routes": routes, "escooters": escooters}}
+    # Stops inside bounds, or precomputed clusters when there are more than max_stops
+    if max_stops is None:
+        max_stops = 100
+    if include_stops:
+        stops, clusters = clustered_stops(cur, south, north, west, east, max_stops)
+    else:
+        stops, clusters = [], []
 
-    # Temp table for sampled stops
-    cur.execute("CREATE TEMP TABLE tmp_stops(stop_id INT)")
-    cur.executemany("INSERT INTO tmp_stops(stop_id) VALUES (?)", [(s,) for s in stop_ids_in_area])
+    # Lines through the area via stops_rtree -> route_pattern_stops -> route_patterns
+    if max_routes is None:
+        max_routes = 100
+    routes = patterns_in_bbox(cur, south, north, west, east, max_routes) if include_routes else []
 
-    # Fetch all trip_ids visiting these stops
-    cur.execute("""
-        SELECT DISTINCT st.trip_id
-        FROM stoptime st
-        JOIN tmp_stops ts ON st.stop_id = ts.stop_id
-        LIMIT 100
-    """)
-    trip_ids = [row["trip_id"] for row in cur.fetchall()]
-    if not trip_ids:
-        conn.close()
-        return {"type": "MapDataResponse", "payload": {"stops": stops, "routes": []}}
+    escooters = vehicles_in_bbox(cur, south, north, west, east)
 
-    # Temp table for trips
-    cur.execute("CREATE TEMP TABLE tmp_trips(trip_id INT)")
-    cur.executemany("INSERT INTO tmp_trips(trip_id) VALUES (?)", [(t,) for t in trip_ids])
-
-    # Fetch unique route_ids with one representative trip per route
-    cur.execute("""
-        SELECT route_id, MIN(trip_id) AS rep_trip_id
-        FROM trip
-        WHERE trip_id IN (SELECT trip_id FROM tmp_trips)
-        GROUP BY route_id
-        LIMIT 100
-    """)
-    rep_trips = {row["route_id"]: row["rep_trip_id"] for row in cur.fetchall()}
-
-    # Fetch all stop sequences for representative trips in bulk
-    rep_trip_ids = list(rep_trips.values())
-    if rep_trip_ids:
-        q_marks = ",".join("?" * len(rep_trip_ids))
-        cur.execute(f"""
-            SELECT st.trip_id, st.stop_id, s.latitude, s.longitude
-            FROM stoptime st
-            JOIN stops s ON st.stop_id = s.stop_id
-            WHERE st.trip_id IN ({q_marks})
-            ORDER BY st.trip_id, st.stop_sequence
-            LIMIT 100
-        """, tuple(rep_trip_ids))
-
-        stops_by_trip = {}
-        for row in cur.fetchall():
-            tid = row["trip_id"]
-            stops_by_trip.setdefault(tid, []).append({"stop_id": row["stop_id"]})
-    else:
-        stops_by_trip = {}
-
-    # Build route responses
-    routes = []
-    for route_id, rep_trip_id in rep_trips.items():
-        routes.append({
-            "route_id": route_id,
-            "trip_id": rep_trip_id,
-            "stops": stops_by_trip.get(rep_trip_id, [])
-        })
-
-    # Cleanup temp tables
-    cur.execute("DROP TABLE IF EXISTS tmp_stops")
-    cur.execute("DROP TABLE IF EXISTS tmp_trips")
-    conn.close()
+    if fmt == COLUMN_FORMAT:
+        stops = dicts_to_columns(STOP_COLUMNS, stops)
+        clusters = dicts_to_columns(CLUSTER_COLUMNS, clusters)
+        escooters = dicts_to_columns(VEHICLE_COLUMNS, escooters)
 
-    print(f"Map request handled in {time.time() - t0:.2f} seconds")
-    return {"type": "MapDataResponse", "payload": {"stops": stops, "routes": routes}}
+    return {"type": "MapDataResponse", "payload": {"stops": stops, "clusters": clusters, "routes": routes, "escooters": escooters}}
@@ -0,0 +1,110 @@
+import os
+import sqlite3
+import time
+from typing import Optional, Tuple
+
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+
+# With several uvicorn workers every process writes its samples to files in
+# PROMETHEUS_MULTIPROC_DIR and /metrics merges them; without it each process
+# reports its own in-memory registry.
+MULTIPROC_DIR: Optional[str] = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+# The SQLite progress handler fires every this many VM instructions
+VM_STEP_GRANULARITY: int = 1000
+
+LATENCY_BUCKETS: Tuple[float, ...] = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS: Tuple[float, ...] = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+REQUEST_LATENCY = Histogram(
+    "beep_request_duration_seconds", "HTTP request latency per endpoint",
+    ["endpoint", "method", "status"], buckets=LATENCY_BUCKETS,
+)
+RESPONSE_BYTES = Histogram(
+    "beep_response_bytes", "Response body size per endpoint, after compression",
+    ["endpoint"], buckets=SIZE_BUCKETS,
+)
+SQL_LATENCY = Histogram(
+    "beep_sql_duration_seconds", "Time to execute and fetch one SQL statement",
+    ["statement"], buckets=LATENCY_BUCKETS,
+)
+SQL_ROWS_RETURNED = Counter("beep_sql_rows_returned_total", "Rows fetched per SQL statement", ["statement"])
+SQL_VM_STEPS = Counter(
+    "beep_sql_vm_steps_total",
+    f"SQLite VM instructions per SQL statement (in steps of {VM_STEP_GRANULARITY}), a proxy for rows scanned",
+    ["statement"],
+)
+INGEST_DURATION = Histogram(
+    "beep_ingest_duration_seconds", "Duration of one realtime poll including the database write",
+    ["feed", "outcome"], buckets=LATENCY_BUCKETS,
+)
+INGEST_LAG = Gauge(
+    "beep_ingest_lag_seconds", "Age of the last applied feed, from its header timestamp",
+    ["feed"], multiprocess_mode="max",
+)
+INGEST_ROWS = Counter("beep_ingest_rows_total", "Realtime rows written per feed", ["feed", "change"])
+QUERY_QUEUE_DEPTH = Gauge(
+    "beep_query_queue_depth", "Requests waiting for a query slot per endpoint",
+    ["endpoint"], multiprocess_mode="livesum",
+)
+
+
+class SQLTimer:
+    """
+    Times one SQL statement, from execute until its rows are fetched, and counts
+    SQLite VM steps on the cursor's connection meanwhile. Set `rows` before the
+    block ends to record the rows returned:
+
+        with SQLTimer("stops_in_bbox", cur) as timer:
+            rows = cur.execute(...).fetchall()
+            timer.rows = len(rows)
+    """
+    __slots__ = ("statement", "conn", "rows", "_steps", "_start")
+
+    def __init__(self, statement: str, cur: Optional[sqlite3.Cursor] = None):
+        self.statement = statement
+        self.conn = cur.connection if cur is not None else None
+        self.rows = 0
+        self._steps = 0
+        self._start = 0.0
+
+    def _tick(self) -> int:
+        self._steps += 1
+        return 0  # non-zero would abort the statement
+
+    def __enter__(self):
+        if self.conn is not None:
+            self.conn.set_progress_handler(self._tick, VM_STEP_GRANULARITY)
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self._start
+        if self.conn is not None:
+            self.conn.set_progress_handler(None, 0)
+        SQL_LATENCY.labels(self.statement).observe(elapsed)
+        SQL_ROWS_RETURNED.labels(self.statement).inc(self.rows)
+        if self._steps:
+            SQL_VM_STEPS.labels(self.statement).inc(self._steps * VM_STEP_GRANULARITY)
+
+
+def render_metrics() -> Tuple[bytes, str]:
+    """
+    Prometheus text exposition of all metrics, merged across workers when
+    PROMETHEUS_MULTIPROC_DIR is set.
+    :return: (body, content type)
+    """
+    if MULTIPROC_DIR:
+        from prometheus_client import multiprocess
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(), CONTENT_TYPE_LATEST
+
+
+def mark_worker_exit():
+    """
+    Drops this process's live gauges from the merged view on shutdown.
+    """
+    if MULTIPROC_DIR:
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(os.getpid())
@@ -0,0 +1,125 @@
+import asyncio
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Optional
+
+from metrics import QUERY_QUEUE_DEPTH
+
+# Threads running SQLite work for the async handlers; each keeps its own pooled
+# read-only connection (see db_pool), so this also caps open connections
+QUERY_WORKERS: int = int(os.getenv("QUERY_WORKERS", str(min(32, (os.cpu_count() or 1) * 4))))
+# Requests allowed to wait for a slot per endpoint before new ones get a 503
+MAX_QUEUE_DEPTH: int = int(os.getenv("QUERY_MAX_QUEUE", "256"))
+# Concurrent queries per endpoint, so one heavy endpoint cannot take every thread
+DEFAULT_ENDPOINT_LIMIT: int = max(1, QUERY_WORKERS // 2)
+ENDPOINT_LIMITS: Dict[str, int] = {
+    "map_data": max(1, QUERY_WORKERS // 4),
+    "routes_for_stop": max(1, QUERY_WORKERS // 4),
+    "station_info": max(1, QUERY_WORKERS // 2),
+    "search_stations": max(1, QUERY_WORKERS // 2),
+    "tiles": max(1, QUERY_WORKERS // 2),
+}
+
+
+class QueueFull(Exception):
+    """
+    Raised when an endpoint already has MAX_QUEUE_DEPTH requests waiting.
+    """
+
+
+class EndpointGate:
+    """
+    Concurrency limit of one endpoint with counters for running and waiting calls.
+    """
+
+    def __init__(self, name: str, limit: int):
+        self.name = name
+        self.limit = limit
+        self.active = 0
+        self.waiting = 0
+        self.completed = 0
+        self.rejected = 0
+        self._semaphore = asyncio.Semaphore(limit)
+
+    def stats(self) -> dict:
+        return {
+            "limit": self.limit,
+            "active": self.active,
+            "waiting": self.waiting,
+            "completed": self.completed,
+            "rejected": self.rejected,
+        }
+
+
+class QueryExecutor:
+    """
+    Bounded thread pool for blocking SQLite work called from async handlers.
+    Calls beyond an endpoint's limit wait on the event loop, not in the pool, so
+    the pool's own queue stays short and the waiting count is the queue depth.
+    """
+
+    def __init__(self, workers: int = QUERY_WORKERS, max_queue: int = MAX_QUEUE_DEPTH):
+        self.workers = workers
+        self.max_queue = max_queue
+        self._pool: Optional[ThreadPoolExecutor] = None
+        self._gates: Dict[str, EndpointGate] = {}
+        self._lock = threading.Lock()
+
+    def _gate(self, endpoint: str) -> EndpointGate:
+        gate = self._gates.get(endpoint)
+        if gate is None:
+            gate = EndpointGate(endpoint, ENDPOINT_LIMITS.get(endpoint, DEFAULT_ENDPOINT_LIMIT))
+            self._gates[endpoint] = gate
+        return gate
+
+    def _executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="query")
+            return self._pool
+
+    async def run(self, endpoint: str, fn: Callable, *args):
+        """
+        Runs fn(*args) in the pool once the endpoint has a free slot.
+        :raises QueueFull: if max_queue calls are already waiting for this endpoint
+        """
+        gate = self._gate(endpoint)
+        if gate.waiting >= self.max_queue:
+            gate.rejected += 1
+            raise QueueFull(f"{endpoint}: {gate.waiting} requests queued")
+
+        gate.waiting += 1
+        QUERY_QUEUE_DEPTH.labels(endpoint).inc()
+        try:
+            await gate._semaphore.acquire()
+        finally:
+            gate.waiting -= 1
+            QUERY_QUEUE_DEPTH.labels(endpoint).dec()
+        gate.active += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor(), fn, *args)
+        finally:
+            gate.active -= 1
+            gate.completed += 1
+            gate._semaphore.release()
+
+    def queue_depth(self) -> int:
+        return sum(gate.waiting for gate in self._gates.values())
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "max_queue": self.max_queue,
+            "queue_depth": self.queue_depth(),
+            "endpoints": {name: gate.stats() for name, gate in self._gates.items()},
+        }
+
+    def shutdown(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=False, cancel_futures=True)
+                self._pool = None
+
+
+query_executor = QueryExecutor()
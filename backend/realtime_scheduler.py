@@ -0,0 +1,191 @@
+import asyncio
+import io
+import os
+import time
+from typing import Callable, Dict, List, Optional
+
+import requests
+
+from db_pool import DB_PATH
+from download_rt_gtfs_data import GTFS_RT_URL, RealtimeFeed
+from fetch_other_vehicle_data import VEHICLE_DATA_URL, parse_vehicle_data, store_vehicle_data
+from live_delays import live_delays
+from live_vehicles import LIVE_VEHICLES_FEED_NAME, live_vehicle_tracker
+from map_data import update_live_data
+from metrics import INGEST_DURATION, INGEST_LAG, INGEST_ROWS
+from service_calendar import service_calendar
+
+# Feed locations and poll intervals; override to point at a local stand-in server
+GTFS_RT_INTERVAL: float = float(os.getenv("GTFS_RT_INTERVAL", "10"))
+VEHICLE_DATA_INTERVAL: float = float(os.getenv("VEHICLE_DATA_INTERVAL", "600"))
+# Seconds between two passes over the running trips for /live_vehicles
+LIVE_VEHICLES_INTERVAL: float = float(os.getenv("LIVE_VEHICLES_INTERVAL", str(GTFS_RT_INTERVAL)))
+REQUEST_TIMEOUT: float = float(os.getenv("REALTIME_REQUEST_TIMEOUT", "30"))
+
+
+class PollingJob:
+    """
+    A feed polled with conditional GETs. `handler` receives the response of every
+    fetch that returned new content and may return a dict of extra status fields.
+    With `stream` set the body is not read up front; the handler reads response.raw.
+    Without a url nothing is fetched and the handler gets None on every tick.
+    """
+
+    def __init__(self, name: str, url: Optional[str], interval: float,
+                 handler: Callable[[Optional[requests.Response]], Optional[dict]],
+                 stream: bool = False):
+        self.name = name
+        self.url = url
+        self.interval = interval
+        self.handler = handler
+        self.stream = stream
+
+        self.etag: Optional[str] = None
+        self.last_modified: Optional[str] = None
+        self.last_attempt: Optional[float] = None
+        self.last_success: Optional[float] = None
+        self.last_change: Optional[float] = None
+        self.last_duration: Optional[float] = None
+        self.last_error: Optional[str] = None
+        self.not_modified_count = 0
+        self.result: dict = {}
+
+    def status(self, now: Optional[float] = None) -> dict:
+        now = now or time.time()
+        return {
+            "url": self.url,
+            "interval": self.interval,
+            "last_attempt": self.last_attempt,
+            "last_success": self.last_success,
+            "last_change": self.last_change,
+            "lag_seconds": None if self.last_success is None else round(now - self.last_success, 3),
+            "last_duration": self.last_duration,
+            "last_error": self.last_error,
+            "not_modified_count": self.not_modified_count,
+            **self.result,
+        }
+
+
+class RealtimeScheduler:
+    """
+    Runs polling jobs as asyncio tasks inside the API process. Network and SQLite
+    work happens in worker threads so the event loop keeps serving requests.
+    """
+
+    def __init__(self, jobs: List[PollingJob]):
+        self.jobs = jobs
+        self.session = requests.Session()
+        self._tasks: List[asyncio.Task] = []
+
+    def run_once(self, job: PollingJob):
+        """
+        Fetches a job's feed once and hands new content to its handler. Blocking.
+        """
+        headers = {}
+        if job.etag:
+            headers["If-None-Match"] = job.etag
+        if job.last_modified:
+            headers["If-Modified-Since"] = job.last_modified
+
+        job.last_attempt = time.time()
+        response = None
+        outcome = "error"
+        try:
+            if job.url is None:
+                job.result = job.handler(None) or {}
+                job.last_change = time.time()
+                outcome = "applied"
+            else:
+                response = self.session.get(job.url, headers=headers, timeout=REQUEST_TIMEOUT, stream=job.stream)
+                if response.status_code == 304:
+                    job.not_modified_count += 1
+                    outcome = "not_modified"
+                else:
+                    response.raise_for_status()
+                    job.result = job.handler(response) or {}
+                    job.etag = response.headers.get("ETag")
+                    job.last_modified = response.headers.get("Last-Modified")
+                    job.last_change = time.time()
+                    outcome = "skipped" if job.result.get("skipped") else "applied"
+            job.last_success = time.time()
+            job.last_error = None
+        except Exception as e:
+            job.last_error = f"{type(e).__name__}: {e}"
+            print(f"❌ Realtime job {job.name} failed: {job.last_error}")
+        finally:
+            if response is not None:
+                response.close()
+            job.last_duration = round(time.time() - job.last_attempt, 3)
+            INGEST_DURATION.labels(job.name, outcome).observe(time.time() - job.last_attempt)
+
+    async def _loop(self, job: PollingJob):
+        while True:
+            started = time.monotonic()
+            await asyncio.to_thread(self.run_once, job)
+            await asyncio.sleep(max(0.0, job.interval - (time.monotonic() - started)))
+
+    def start(self):
+        for job in self.jobs:
+            self._tasks.append(asyncio.create_task(self._loop(job), name=f"realtime-{job.name}"))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self.session.close()
+
+    def status(self) -> Dict[str, dict]:
+        now = time.time()
+        return {job.name: job.status(now) for job in self.jobs}
+
+
+def _apply_gtfs_rt(response: requests.Response) -> dict:
+    # Decoded entity by entity straight into the staging insert
+    response.raw.decode_content = True
+    response.raw.auto_close = False  # let BufferedReader see EOF instead of a closed file
+    rt_feed = RealtimeFeed(io.BufferedReader(response.raw), service_calendar.all_trips())
+    summary = update_live_data(DB_PATH, rt_feed.as_stream())
+    if not summary["skipped"]:
+        live_delays.refresh()
+    header_timestamp = rt_feed.header_timestamp or None
+    if header_timestamp is not None:
+        INGEST_LAG.labels("gtfs_rt").set(time.time() - header_timestamp)
+    INGEST_ROWS.labels("gtfs_rt", "upserted").inc(summary["upserted"])
+    INGEST_ROWS.labels("gtfs_rt", "deleted").inc(summary["deleted"])
+    return {
+        "feed_timestamp": header_timestamp,
+        "feed_lag_seconds": None if header_timestamp is None else round(time.time() - header_timestamp, 3),
+        "realtime_version": summary["version"],
+        "skipped": summary["skipped"],
+        "upserted": summary["upserted"],
+        "deleted": summary["deleted"],
+        "entities": rt_feed.entities,
+        "dropped_unknown_trips": rt_feed.dropped_trip_updates,
+    }
+
+
+def _apply_vehicle_data(response: requests.Response) -> dict:
+    vehicles = parse_vehicle_data(response.text)
+    store_vehicle_data(DB_PATH, vehicles)
+    INGEST_ROWS.labels("other_vehicles", "replaced").inc(len(vehicles))
+    return {"vehicles": len(vehicles)}
+
+
+def _update_live_vehicles(_: None) -> dict:
+    # Vehicles move between feed updates too, so this runs on every tick
+    summary = live_vehicle_tracker.update(DB_PATH)
+    INGEST_ROWS.labels(LIVE_VEHICLES_FEED_NAME, "replaced").inc(summary["vehicles"])
+    return summary
+
+
+def default_scheduler() -> RealtimeScheduler:
+    """
+    The scheduler the API runs: GTFS-RT trip updates, shared micromobility
+    vehicles and the estimated transit vehicle positions.
+    """
+    return RealtimeScheduler([
+        PollingJob("gtfs_rt", os.getenv("GTFS_RT_URL", GTFS_RT_URL), GTFS_RT_INTERVAL, _apply_gtfs_rt, stream=True),
+        PollingJob("other_vehicles", os.getenv("VEHICLE_DATA_URL", VEHICLE_DATA_URL), VEHICLE_DATA_INTERVAL, _apply_vehicle_data),
+        PollingJob(LIVE_VEHICLES_FEED_NAME, None, LIVE_VEHICLES_INTERVAL, _update_live_vehicles),
+    ])
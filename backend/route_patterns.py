@@ -0,0 +1,218 @@
+import json
+import os
+import sqlite3
+from typing import Dict, Iterable, List, Tuple
+
+from clustering import pick_band
+from metrics import SQLTimer
+
+# A route pattern is one distinct ordered stop sequence of a route. Trips that
+# serve the same stops in the same order share a pattern, so the map draws one
+# line per pattern instead of one per trip.
+
+# Coarsest zoom band (see clustering.CLUSTER_BANDS) at which lines are still
+# looked up; in larger viewports the stop scan would cover half the country
+ROUTES_MAX_BAND: int = int(os.getenv("ROUTES_MAX_BAND", "5"))
+# Cells per viewport the band is picked for, the default /map_data max_stops,
+# so lines appear at the same zoom as single stops and small clusters
+ROUTES_BAND_ITEMS: int = 150
+
+
+def create_route_pattern_tables(cur: sqlite3.Cursor):
+    """
+    Creates route_patterns and the stop -> pattern lookup table if missing.
+    """
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS route_patterns(
+            pattern_id INTEGER PRIMARY KEY,
+            route_id INTEGER,
+            route_short_name TEXT,
+            route_type INTEGER,
+            trip_count INTEGER,
+            rep_trip_id INTEGER,
+            stop_ids TEXT,
+            coordinates TEXT
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS route_pattern_stops(
+            stop_id INTEGER,
+            pattern_id INTEGER,
+            PRIMARY KEY (stop_id, pattern_id)
+        ) WITHOUT ROWID
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_route_patterns_route_id ON route_patterns(route_id)")
+
+
+def _iter_trip_stop_sequences(cur: sqlite3.Cursor, where: str = ""):
+    """
+    Yields (trip_id, route_id, stop_ids) per trip, streaming stoptime in
+    (trip_id, stop_sequence) order so only one trip is held at a time.
+    :param where: optional condition on the trip (alias t)
+    """
+    cur.execute(f"""
+        SELECT st.trip_id, t.route_id, st.stop_id
+        FROM stoptime st
+        JOIN trip t ON t.trip_id = st.trip_id
+        {f"WHERE {where}" if where else ""}
+        ORDER BY st.trip_id, st.stop_sequence
+    """)
+    trip_id, route_id, stop_ids = None, None, []
+    for row_trip_id, row_route_id, stop_id in cur:
+        if row_trip_id != trip_id:
+            if stop_ids:
+                yield trip_id, route_id, tuple(stop_ids)
+            trip_id, route_id, stop_ids = row_trip_id, row_route_id, []
+        stop_ids.append(stop_id)
+    if stop_ids:
+        yield trip_id, route_id, tuple(stop_ids)
+
+
+def _collect_patterns(trips) -> Dict[Tuple[int, tuple], list]:
+    # (route_id, stop_ids) -> [trip_count, rep_trip_id]
+    patterns: Dict[Tuple[int, tuple], list] = {}
+    for trip_id, route_id, stop_ids in trips:
+        entry = patterns.get((route_id, stop_ids))
+        if entry is None:
+            patterns[(route_id, stop_ids)] = [1, trip_id]
+        else:
+            entry[0] += 1
+            entry[1] = min(entry[1], trip_id)
+    return patterns
+
+
+def _insert_patterns(cur: sqlite3.Cursor, patterns: Dict[Tuple[int, tuple], list], coords: dict, names: dict,
+                     first_id: int):
+    pattern_rows, stop_rows = [], []
+    for pattern_id, ((route_id, stop_ids), (trip_count, rep_trip_id)) in enumerate(patterns.items(), start=first_id):
+        name, route_type = names.get(route_id, (None, None))
+        line = [coords[s] for s in stop_ids if coords.get(s, (None,))[0] is not None]
+        pattern_rows.append((
+            pattern_id, route_id, name, route_type, trip_count, rep_trip_id,
+            json.dumps(stop_ids, separators=(",", ":")),
+            json.dumps(line, separators=(",", ":")),
+        ))
+        stop_rows.extend((stop_id, pattern_id) for stop_id in set(stop_ids))
+
+    cur.executemany("INSERT INTO route_patterns VALUES (?,?,?,?,?,?,?,?)", pattern_rows)
+    cur.executemany("INSERT INTO route_pattern_stops(stop_id, pattern_id) VALUES (?,?)", stop_rows)
+
+
+def rebuild_route_patterns(cur: sqlite3.Cursor, force: bool = False) -> bool:
+    """
+    Collapses all trips into distinct (route, stop sequence) patterns and stores
+    each with its ordered coordinates, trip count and lowest trip_id. Skipped when
+    patterns exist, unless force is set.
+    :return: True if the patterns were rebuilt
+    """
+    if not force and cur.execute("SELECT 1 FROM route_patterns LIMIT 1").fetchone():
+        return False
+
+    patterns = _collect_patterns(_iter_trip_stop_sequences(cur))
+    coords = {
+        stop_id: (lat, lon)
+        for stop_id, lat, lon in cur.execute("SELECT stop_id, latitude, longitude FROM stops")
+    }
+    names = {
+        route_id: (name, route_type)
+        for route_id, name, route_type in cur.execute("SELECT route_id, route_short_name, route_type FROM routes")
+    }
+
+    cur.execute("DELETE FROM route_patterns")
+    cur.execute("DELETE FROM route_pattern_stops")
+    _insert_patterns(cur, patterns, coords, names, 1)
+    return True
+
+
+def routes_through_stops(cur: sqlite3.Cursor, stop_ids: Iterable[int]) -> set:
+    """
+    Routes with a pattern serving any of the stops, i.e. whose lines change when the stops move.
+    """
+    routes = set()
+    for stop_id in stop_ids:
+        routes.update(route_id for (route_id,) in cur.execute("""
+            SELECT p.route_id FROM route_pattern_stops rps
+            JOIN route_patterns p ON p.pattern_id = rps.pattern_id
+            WHERE rps.stop_id = ?
+        """, (stop_id,)))
+    return routes
+
+
+def refresh_route_patterns(cur: sqlite3.Cursor, route_ids: Iterable[int]):
+    """
+    Recomputes the patterns of some routes only, from their current trips, stop
+    times, stops and names. Patterns of other routes keep their ids; the new
+    ones are numbered after the highest pattern_id.
+    """
+    cur.execute("CREATE TEMP TABLE IF NOT EXISTS refresh_route_ids(id INTEGER PRIMARY KEY)")
+    cur.execute("DELETE FROM temp.refresh_route_ids")
+    cur.executemany("INSERT OR IGNORE INTO temp.refresh_route_ids VALUES (?)",
+                    ((route_id,) for route_id in route_ids if route_id is not None))
+
+    old = cur.execute("""
+        SELECT pattern_id, stop_ids FROM route_patterns
+        WHERE route_id IN (SELECT id FROM temp.refresh_route_ids)
+    """).fetchall()
+    # route_pattern_stops is keyed by stop, so its rows are deleted by full key
+    cur.executemany("DELETE FROM route_pattern_stops WHERE stop_id = ? AND pattern_id = ?",
+                    ((stop_id, pattern_id) for pattern_id, stop_ids in old for stop_id in set(json.loads(stop_ids))))
+    cur.executemany("DELETE FROM route_patterns WHERE pattern_id = ?", ((pattern_id,) for pattern_id, _ in old))
+
+    trips = _iter_trip_stop_sequences(cur, "t.route_id IN (SELECT id FROM temp.refresh_route_ids)")
+    patterns = _collect_patterns(list(trips))
+    coords = {}
+    for stop_id in {stop_id for _, stop_ids in patterns for stop_id in stop_ids}:
+        row = cur.execute("SELECT latitude, longitude FROM stops WHERE stop_id = ?", (stop_id,)).fetchone()
+        if row is not None:
+            coords[stop_id] = row
+    names = {
+        route_id: (name, route_type)
+        for route_id, name, route_type in cur.execute("""
+            SELECT route_id, route_short_name, route_type FROM routes
+            WHERE route_id IN (SELECT id FROM temp.refresh_route_ids)
+        """)
+    }
+    first_id = cur.execute("SELECT COALESCE(MAX(pattern_id), 0) + 1 FROM route_patterns").fetchone()[0]
+    _insert_patterns(cur, patterns, coords, names, first_id)
+
+
+def patterns_in_bbox(cur: sqlite3.Cursor, south: float, north: float, west: float, east: float,
+                     max_patterns: int) -> List[dict]:
+    """
+    Route patterns serving at least one stop inside a bounding box, busiest
+    first: stops_rtree finds the stops, route_pattern_stops maps them to patterns.
+    Empty for viewports coarser than ROUTES_MAX_BAND.
+    """
+    if pick_band(south, north, west, east, ROUTES_BAND_ITEMS) > ROUTES_MAX_BAND:
+        return []
+    with SQLTimer("patterns_in_bbox", cur) as timer:
+        cur.execute("""
+            SELECT p.pattern_id, p.route_id, p.route_short_name, p.route_type, p.trip_count,
+                   p.rep_trip_id, p.stop_ids, p.coordinates
+            FROM route_patterns p
+            WHERE p.pattern_id IN (
+                SELECT rps.pattern_id
+                FROM stops_rtree r
+                JOIN stops s ON s.rowid = r.id
+                JOIN route_pattern_stops rps ON rps.stop_id = s.stop_id
+                WHERE r.max_lat >= ? AND r.min_lat <= ?
+                  AND r.max_lon >= ? AND r.min_lon <= ?
+            )
+            ORDER BY p.trip_count DESC, p.pattern_id
+            LIMIT ?
+        """, (south, north, west, east, max_patterns))
+        rows = cur.fetchall()
+        timer.rows = len(rows)
+    return [
+        {
+            "route_id": route_id,
+            "route_short_name": name,
+            "route_type": route_type,
+            "pattern_id": pattern_id,
+            "trip_id": rep_trip_id,
+            "trip_count": trip_count,
+            "stops": json.loads(stop_ids),
+            "coordinates": json.loads(coordinates),
+        }
+        for pattern_id, route_id, name, route_type, trip_count, rep_trip_id, stop_ids, coordinates in rows
+    ]
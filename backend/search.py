@@ -1,29 +1,165 @@
+import re
 import sqlite3
-from typing import List
-from typing import Optional
-import os
-
-DB_FILE_NAME: str = "/database.db"
-def getDBPath() -> str:
-    db_env: Optional[str] = os.getenv("DB_DIR")
-    if db_env is None:
-        return "tomfoolery-rs-main/database.db"
-    else:
-        return db_env + DB_FILE_NAME
-
-DB_PATH = getDBPath()
-
-def search_stations(query: str, limit: int = 20) -> List[dict]:
-    con = sqlite3.connect(DB_PATH)
-    con.row_factory = sqlite3.Row
-    cur = con.cursor()
+import unicodedata
+from typing import Dict, Iterable, List, Union
+
+from db_pool import generation, get_cursor
+from metrics import SQLTimer
+from response_cache import LRUCache
+from serialization import COLUMN_FORMAT, ROW_FORMAT, rows_to_columns, rows_to_dicts
+from spatial_index import STOP_COLUMNS
+
+# Trigram tokens need at least three characters
+MIN_TRIGRAM_LENGTH: int = 3
+
+# Ranked rows of queries too short for the trigram index. Each is a scan of all
+# names, but there are only a few thousand distinct ones
+short_query_cache = LRUCache("search_short_queries", maxsize=4096)
+
+_UMLAUT_EXPANSIONS = str.maketrans({"ä": "ae", "ö": "oe", "ü": "ue"})
+_NON_WORD = re.compile(r"[^0-9a-z]+")
+
+
+def normalize_name(name: str, expand_umlauts: bool = False) -> str:
+    """
+    Folds a stop name or query for matching: lower case, ß -> ss, accents removed
+    and punctuation collapsed to single spaces.
+    :param expand_umlauts: spell umlauts out (ö -> oe) instead of dropping the dots (ö -> o)
+    """
+    text = name.casefold()
+    if expand_umlauts:
+        text = text.translate(_UMLAUT_EXPANSIONS)
+    text = "".join(c for c in unicodedata.normalize("NFKD", text) if not unicodedata.combining(c))
+    return _NON_WORD.sub(" ", text).strip()
+
+
+def create_search_index(cur: sqlite3.Cursor):
+    """
+    Creates the FTS5 trigram table over stop names. Each name is stored twice so
+    "Köln", "Koln" and "Koeln" all find the same stop.
+    """
     cur.execute("""
-        SELECT stop_id, stop_name, latitude, longitude
-        FROM stops
-        WHERE stop_name LIKE ?
-        ORDER BY stop_name
-        LIMIT ?
-    """, (f"%{query}%", limit))
-    results = [dict(row) for row in cur.fetchall()]
-    con.close()
-    return results
+        CREATE VIRTUAL TABLE IF NOT EXISTS stops_fts USING fts5(
+            name_folded, name_expanded, tokenize='trigram'
+        )
+    """)
+
+
+def rebuild_search_index(cur: sqlite3.Cursor, force: bool = False) -> bool:
+    """
+    Refills stops_fts from stops, keyed by the stops rowid. Skipped when the
+    index already holds one entry per stop, unless force is set.
+    :return: True if the index was rebuilt
+    """
+    if not force:
+        indexed = cur.execute("SELECT COUNT(*) FROM stops_fts").fetchone()[0]
+        total = cur.execute("SELECT COUNT(*) FROM stops WHERE stop_name IS NOT NULL").fetchone()[0]
+        if indexed == total:
+            return False
+
+    cur.execute("DELETE FROM stops_fts")
+    rows = cur.execute("SELECT rowid, stop_name FROM stops WHERE stop_name IS NOT NULL").fetchall()
+    cur.executemany(
+        "INSERT INTO stops_fts(rowid, name_folded, name_expanded) VALUES (?,?,?)",
+        ((rowid, normalize_name(name), normalize_name(name, expand_umlauts=True)) for rowid, name in rows)
+    )
+    cur.execute("INSERT INTO stops_fts(stops_fts) VALUES ('optimize')")
+    return True
+
+
+def unindex_stops(cur: sqlite3.Cursor, stop_ids: Iterable[int]):
+    """
+    Removes stops from stops_fts, before their rows change or go away.
+    """
+    cur.executemany(
+        "DELETE FROM stops_fts WHERE rowid IN (SELECT rowid FROM stops WHERE stop_id = ?)",
+        ((stop_id,) for stop_id in stop_ids),
+    )
+
+
+def index_stops(cur: sqlite3.Cursor, stop_ids: Iterable[int]):
+    """
+    Adds stops to stops_fts after they were inserted or updated.
+    """
+    rows = []
+    for stop_id in stop_ids:
+        rows.extend(cur.execute(
+            "SELECT rowid, stop_name FROM stops WHERE stop_id = ? AND stop_name IS NOT NULL", (stop_id,)
+        ).fetchall())
+    cur.executemany(
+        "INSERT INTO stops_fts(rowid, name_folded, name_expanded) VALUES (?,?,?)",
+        ((rowid, normalize_name(name), normalize_name(name, expand_umlauts=True)) for rowid, name in rows)
+    )
+
+
+def search_stations(query: str, limit: int = 20, fmt: str = ROW_FORMAT) -> Union[List[dict], Dict[str, list]]:
+    """
+    Finds stops whose name contains every word of the query, ranked by match
+    quality: exact name, name prefix, word prefix, anywhere; then FTS rank and
+    shorter names first.
+    :param fmt: ROW_FORMAT for a list of stops, COLUMN_FORMAT for one list per field
+    """
+    build = rows_to_columns if fmt == COLUMN_FORMAT else rows_to_dicts
+    folded = normalize_name(query)
+    words = folded.split()
+    long_words = [w for w in words if len(w) >= MIN_TRIGRAM_LENGTH]
+    short_words = [w for w in words if len(w) < MIN_TRIGRAM_LENGTH]
+
+    if not words:
+        return build(STOP_COLUMNS, [])
+    cur = get_cursor()
+    if not long_words:
+        rows = short_query_cache.get_or_compute(
+            (generation(), folded, limit), lambda: _short_query_rows(cur, folded, limit)
+        )
+        return build(STOP_COLUMNS, rows)
+
+    match = " AND ".join(f'"{w}"' for w in long_words)
+    short_filter = "".join(" AND instr(f.name_folded, ?) > 0" for _ in short_words)
+    with SQLTimer("search_stations_fts", cur) as timer:
+        cur.execute(f"""
+            SELECT s.stop_id, s.stop_name, s.latitude, s.longitude
+            FROM stops_fts f
+            JOIN stops s ON s.rowid = f.rowid
+            WHERE stops_fts MATCH ?{short_filter}
+            ORDER BY
+                CASE
+                    WHEN f.name_folded = ? OR f.name_expanded = ? THEN 0
+                    WHEN f.name_folded LIKE ? OR f.name_expanded LIKE ? THEN 1
+                    WHEN instr(' ' || f.name_folded, ?) > 0 OR instr(' ' || f.name_expanded, ?) > 0 THEN 2
+                    ELSE 3
+                END,
+                f.rank,
+                length(s.stop_name)
+            LIMIT ?
+        """, (match, *short_words,
+              folded, folded,
+              f"{folded}%", f"{folded}%",
+              f" {folded}", f" {folded}",
+              limit))
+        rows = cur.fetchall()
+        timer.rows = len(rows)
+    return build(STOP_COLUMNS, rows)
+
+
+def _short_query_rows(cur: sqlite3.Cursor, folded: str, limit: int) -> List[tuple]:
+    # Name and word prefixes of the folded names, ranked like the FTS matches
+    with SQLTimer("search_stations_prefix", cur) as timer:
+        cur.execute("""
+            SELECT s.stop_id, s.stop_name, s.latitude, s.longitude
+            FROM stops_fts f
+            JOIN stops s ON s.rowid = f.rowid
+            WHERE f.name_folded LIKE ?1 OR f.name_expanded LIKE ?1
+               OR instr(' ' || f.name_folded, ?2) > 0 OR instr(' ' || f.name_expanded, ?2) > 0
+            ORDER BY
+                CASE
+                    WHEN f.name_folded = ?3 OR f.name_expanded = ?3 THEN 0
+                    WHEN f.name_folded LIKE ?1 OR f.name_expanded LIKE ?1 THEN 1
+                    ELSE 2
+                END,
+                length(s.stop_name)
+            LIMIT ?4
+        """, (f"{folded}%", f" {folded}", folded, limit))
+        rows = cur.fetchall()
+        timer.rows = len(rows)
+    return rows
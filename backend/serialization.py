@@ -0,0 +1,54 @@
+from typing import Dict, Iterable, List, Optional, Sequence
+
+import orjson
+from fastapi import Response
+
+# Payload layouts for list endpoints: one object per item, or one array per field
+ROW_FORMAT: str = "rows"
+COLUMN_FORMAT: str = "columns"
+FORMATS = (ROW_FORMAT, COLUMN_FORMAT)
+
+
+def dumps(content) -> bytes:
+    """
+    Serializes to compact UTF-8 JSON with orjson.
+    """
+    return orjson.dumps(content)
+
+
+def json_response(content, headers: Optional[Dict[str, str]] = None, status_code: int = 200) -> Response:
+    """
+    Returns content as an already encoded JSON response. Returning a Response
+    skips FastAPI's jsonable_encoder pass, which walks every nested object.
+    """
+    return Response(content=dumps(content), media_type="application/json", headers=headers, status_code=status_code)
+
+
+def rows_to_dicts(columns: Sequence[str], rows: Iterable[tuple]) -> List[dict]:
+    return [dict(zip(columns, row)) for row in rows]
+
+
+def rows_to_columns(columns: Sequence[str], rows: Iterable[tuple]) -> Dict[str, list]:
+    """
+    Turns row tuples into one list per column, e.g. {"stop_id": [...], "latitude": [...]}.
+    """
+    rows = list(rows)
+    if not rows:
+        return {column: [] for column in columns}
+    return {column: list(values) for column, values in zip(columns, zip(*rows))}
+
+
+def dicts_to_columns(columns: Sequence[str], items: Iterable[dict]) -> Dict[str, list]:
+    """
+    Column layout of a list of dicts; missing keys become null.
+    """
+    return rows_to_columns(columns, (tuple(item.get(column) for column in columns) for item in items))
+
+
+def check_format(fmt: str) -> str:
+    """
+    :raises ValueError: for anything but ROW_FORMAT or COLUMN_FORMAT
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"unknown format {fmt!r}, expected one of {', '.join(FORMATS)}")
+    return fmt
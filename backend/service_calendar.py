@@ -0,0 +1,145 @@
+import threading
+from array import array
+from datetime import date, datetime, timedelta
+from typing import Dict, FrozenSet, Optional, Tuple
+
+from db_pool import get_cursor
+from timetable_snapshot import TimetableSnapshot, timetable_snapshots
+
+# Service days kept in memory (yesterday, today and tomorrow cover every lookup)
+MAX_CACHED_DAYS: int = 3
+# Column of the service table for each weekday, Monday first
+WEEKDAY_COLUMNS = ("mon", "tue", "wed", "thur", "fri", "sat", "sun")
+SECONDS_PER_DAY: int = 86400
+
+
+class TripBitmap:
+    """
+    One bit per trip id, set if the trip runs on the service day it was built for.
+    """
+    __slots__ = ("bits", "count")
+
+    def __init__(self, size: int):
+        self.bits = bytearray((size >> 3) + 1)
+        self.count = 0
+
+    def add(self, trip_id: int):
+        self.bits[trip_id >> 3] |= 1 << (trip_id & 7)
+        self.count += 1
+
+    def __contains__(self, trip_id) -> bool:
+        trip_id = int(trip_id)
+        index = trip_id >> 3
+        return 0 <= index < len(self.bits) and bool(self.bits[index] >> (trip_id & 7) & 1)
+
+    def __len__(self) -> int:
+        return self.count
+
+
+class ServiceCalendar:
+    """
+    Precomputes, once per service day, which service_ids and trips run that day.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._trip_ids: Optional[array] = None
+        self._trip_services: Optional[array] = None
+        self._days: Dict[date, Tuple[FrozenSet[int], TripBitmap]] = {}
+        self._all_trips: Optional[TripBitmap] = None
+
+    def clear(self):
+        with self._lock:
+            self._trip_ids = None
+            self._trip_services = None
+            self._days.clear()
+            self._all_trips = None
+
+    def _load_trips(self):
+        cur = get_cursor()
+        cur.execute("SELECT trip_id, service_id FROM trip")
+        trip_ids, services = array("q"), array("q")
+        for trip_id, service_id in cur:
+            trip_ids.append(trip_id)
+            services.append(service_id)
+        self._trip_ids, self._trip_services = trip_ids, services
+
+    @staticmethod
+    def _build_day_from_snapshot(snapshot: TimetableSnapshot, day: date) -> Tuple[FrozenSet[int], TripBitmap]:
+        ymd, weekday = int(day.strftime("%Y%m%d")), 1 << day.weekday()
+        active = {
+            i for i, days in enumerate(snapshot.service_weekdays)
+            if days & weekday and snapshot.service_starts[i] <= ymd <= snapshot.service_ends[i]
+        }
+        bitmap = TripBitmap(max(snapshot.trip_ids, default=0))
+        for trip_id, service in zip(snapshot.trip_ids, snapshot.trip_services):
+            if service in active:
+                bitmap.add(trip_id)
+        return frozenset(snapshot.service_ids[i] for i in active), bitmap
+
+    def _build_day(self, day: date) -> Tuple[FrozenSet[int], TripBitmap]:
+        snapshot = timetable_snapshots.current()
+        if snapshot is not None:
+            return self._build_day_from_snapshot(snapshot, day)
+
+        ymd = int(day.strftime("%Y%m%d"))
+        cur = get_cursor()
+        cur.execute(f"""
+            SELECT service_id
+            FROM service
+            WHERE {WEEKDAY_COLUMNS[day.weekday()]} = 1
+              AND start_date <= ? AND end_date >= ?
+        """, (ymd, ymd))
+        services = frozenset(row[0] for row in cur.fetchall())
+
+        if self._trip_ids is None:
+            self._load_trips()
+        bitmap = TripBitmap(max(self._trip_ids, default=0))
+        for trip_id, service_id in zip(self._trip_ids, self._trip_services):
+            if service_id in services:
+                bitmap.add(trip_id)
+        return services, bitmap
+
+    def _day(self, day: date) -> Tuple[FrozenSet[int], TripBitmap]:
+        with self._lock:
+            entry = self._days.get(day)
+            if entry is None:
+                entry = self._build_day(day)
+                self._days[day] = entry
+                for old in sorted(self._days)[:-MAX_CACHED_DAYS]:
+                    del self._days[old]
+            return entry
+
+    def all_trips(self) -> TripBitmap:
+        """
+        Every trip in the static feed, regardless of service day.
+        """
+        with self._lock:
+            if self._all_trips is None:
+                if self._trip_ids is None:
+                    self._load_trips()
+                bitmap = TripBitmap(max(self._trip_ids, default=0))
+                for trip_id in self._trip_ids:
+                    bitmap.add(trip_id)
+                self._all_trips = bitmap
+            return self._all_trips
+
+    def active_services(self, day: date) -> FrozenSet[int]:
+        return self._day(day)[0]
+
+    def active_trips(self, day: date) -> TripBitmap:
+        return self._day(day)[1]
+
+    def is_running(self, trip_id: int, departure_secs: int, now: Optional[datetime] = None) -> bool:
+        """
+        Whether a call at `departure_secs` (seconds since its service day started,
+        may exceed 24h) belongs to a trip running now: either today's service, or
+        yesterday's service for times past midnight such as 25:10:00.
+        """
+        today = (now or datetime.now()).date()
+        if trip_id in self.active_trips(today):
+            return True
+        return departure_secs >= SECONDS_PER_DAY and trip_id in self.active_trips(today - timedelta(days=1))
+
+
+service_calendar = ServiceCalendar()
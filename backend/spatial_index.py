@@ -0,0 +1,170 @@
+import sqlite3
+from typing import Iterable, List
+
+from metrics import SQLTimer
+
+# R*Tree virtual tables mirroring the point tables they index. The rtree id is the
+# rowid of the indexed row, so lookups join back to the base table by rowid.
+
+# Fields of a stop in map and search payloads
+STOP_COLUMNS = ("stop_id", "stop_name", "latitude", "longitude")
+VEHICLE_COLUMNS = ("vehicle_id", "latitude", "longitude", "form_factor")
+# Fields of an estimated transit vehicle position in /live_vehicles payloads
+LIVE_VEHICLE_COLUMNS = (
+    "trip_id", "route_id", "route_short_name", "route_type", "latitude", "longitude", "bearing", "delay",
+    "stop_id", "next_stop_id", "next_latitude", "next_longitude", "next_arrival",
+)
+
+
+def create_spatial_tables(cur: sqlite3.Cursor):
+    """
+    Creates the R*Tree tables for stops, micromobility and transit vehicles if missing.
+    """
+    cur.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS stops_rtree USING rtree(
+            id, min_lat, max_lat, min_lon, max_lon
+        )
+    """)
+    cur.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS other_vehicles_rtree USING rtree(
+            id, min_lat, max_lat, min_lon, max_lon
+        )
+    """)
+    cur.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS live_vehicles_rtree USING rtree(
+            id, min_lat, max_lat, min_lon, max_lon
+        )
+    """)
+
+
+def rebuild_stops_rtree(cur: sqlite3.Cursor, force: bool = False) -> bool:
+    """
+    Refills stops_rtree from stops. Skipped when the index already holds one
+    entry per stop, unless force is set.
+    :return: True if the index was rebuilt
+    """
+    if not force:
+        indexed = cur.execute("SELECT COUNT(*) FROM stops_rtree").fetchone()[0]
+        total = cur.execute("SELECT COUNT(*) FROM stops WHERE latitude IS NOT NULL").fetchone()[0]
+        if indexed == total:
+            return False
+
+    cur.execute("DELETE FROM stops_rtree")
+    cur.execute("""
+        INSERT INTO stops_rtree(id, min_lat, max_lat, min_lon, max_lon)
+        SELECT rowid, latitude, latitude, longitude, longitude
+        FROM stops
+        WHERE latitude IS NOT NULL AND longitude IS NOT NULL
+    """)
+    return True
+
+
+def unindex_stops(cur: sqlite3.Cursor, stop_ids: Iterable[int]):
+    """
+    Removes stops from stops_rtree. Call before their rows change or go away,
+    while the rowids can still be looked up.
+    """
+    cur.executemany(
+        "DELETE FROM stops_rtree WHERE id IN (SELECT rowid FROM stops WHERE stop_id = ?)",
+        ((stop_id,) for stop_id in stop_ids),
+    )
+
+
+def index_stops(cur: sqlite3.Cursor, stop_ids: Iterable[int]):
+    """
+    Adds stops to stops_rtree after they were inserted or updated.
+    """
+    cur.executemany("""
+        INSERT INTO stops_rtree(id, min_lat, max_lat, min_lon, max_lon)
+        SELECT rowid, latitude, latitude, longitude, longitude
+        FROM stops
+        WHERE stop_id = ? AND latitude IS NOT NULL AND longitude IS NOT NULL
+    """, ((stop_id,) for stop_id in stop_ids))
+
+
+def rebuild_vehicles_rtree(cur: sqlite3.Cursor):
+    """
+    Refills other_vehicles_rtree from other_vehicles. Run in the same transaction
+    as the vehicle refresh so readers never see the two out of step.
+    """
+    cur.execute("DELETE FROM other_vehicles_rtree")
+    cur.execute("""
+        INSERT INTO other_vehicles_rtree(id, min_lat, max_lat, min_lon, max_lon)
+        SELECT id, lat, lat, lon, lon
+        FROM other_vehicles
+        WHERE lat IS NOT NULL AND lon IS NOT NULL
+    """)
+
+
+def rebuild_live_vehicles_rtree(cur: sqlite3.Cursor):
+    """
+    Refills live_vehicles_rtree from live_vehicles, in the transaction that
+    replaced the positions.
+    """
+    cur.execute("DELETE FROM live_vehicles_rtree")
+    cur.execute("""
+        INSERT INTO live_vehicles_rtree(id, min_lat, max_lat, min_lon, max_lon)
+        SELECT id, lat, lat, lon, lon
+        FROM live_vehicles
+    """)
+
+
+def stops_in_bbox(cur: sqlite3.Cursor, south: float, north: float, west: float, east: float) -> List[dict]:
+    """
+    Stops inside a bounding box via stops_rtree. The exact coordinates are checked
+    again because rtree boxes are stored as 32-bit floats and rounded outwards.
+    """
+    with SQLTimer("stops_in_bbox", cur) as timer:
+        cur.execute("""
+            SELECT s.stop_id, s.stop_name, s.latitude, s.longitude
+            FROM stops_rtree r
+            JOIN stops s ON s.rowid = r.id
+            WHERE r.max_lat >= ? AND r.min_lat <= ?
+              AND r.max_lon >= ? AND r.min_lon <= ?
+              AND s.latitude BETWEEN ? AND ?
+              AND s.longitude BETWEEN ? AND ?
+        """, (south, north, west, east, south, north, west, east))
+        rows = cur.fetchall()
+        timer.rows = len(rows)
+    return [dict(zip(STOP_COLUMNS, row)) for row in rows]
+
+
+def vehicles_in_bbox(cur: sqlite3.Cursor, south: float, north: float, west: float, east: float) -> List[dict]:
+    """
+    Shared micromobility vehicles inside a bounding box via other_vehicles_rtree.
+    """
+    with SQLTimer("vehicles_in_bbox", cur) as timer:
+        cur.execute("""
+            SELECT v.vehicle_id, v.lat AS latitude, v.lon AS longitude, v.form_factor
+            FROM other_vehicles_rtree r
+            JOIN other_vehicles v ON v.id = r.id
+            WHERE r.max_lat >= ? AND r.min_lat <= ?
+              AND r.max_lon >= ? AND r.min_lon <= ?
+              AND v.lat BETWEEN ? AND ?
+              AND v.lon BETWEEN ? AND ?
+        """, (south, north, west, east, south, north, west, east))
+        rows = cur.fetchall()
+        timer.rows = len(rows)
+    return [dict(zip(VEHICLE_COLUMNS, row)) for row in rows]
+
+
+def live_vehicles_in_bbox(cur: sqlite3.Cursor, south: float, north: float, west: float, east: float,
+                          limit: int) -> List[dict]:
+    """
+    Estimated transit vehicle positions inside a bounding box via live_vehicles_rtree.
+    """
+    with SQLTimer("live_vehicles_in_bbox", cur) as timer:
+        cur.execute("""
+            SELECT v.trip_id, v.route_id, v.route_short_name, v.route_type, v.lat, v.lon, v.bearing, v.delay,
+                   v.stop_id, v.next_stop_id, v.next_lat, v.next_lon, v.next_arrival
+            FROM live_vehicles_rtree r
+            JOIN live_vehicles v ON v.id = r.id
+            WHERE r.max_lat >= ? AND r.min_lat <= ?
+              AND r.max_lon >= ? AND r.min_lon <= ?
+              AND v.lat BETWEEN ? AND ?
+              AND v.lon BETWEEN ? AND ?
+            LIMIT ?
+        """, (south, north, west, east, south, north, west, east, limit))
+        rows = cur.fetchall()
+        timer.rows = len(rows)
+    return [dict(zip(LIVE_VEHICLE_COLUMNS, row)) for row in rows]
@@ -0,0 +1,129 @@
+import logging
+import os
+import sqlite3
+import threading
+from typing import Callable, Dict, Iterable, List, Optional, Set
+
+from db_pool import get_cursor
+
+# Key of the static timetable in feed_state, bumped by every incremental import
+STATIC_FEED_NAME: str = "static"
+# Versions of change log kept; a process further behind drops all its caches instead
+CHANGE_LOG_VERSIONS: int = int(os.getenv("STATIC_CHANGE_LOG_VERSIONS", "10"))
+
+# Kinds of ids in the change log:
+#   stop        stops whose own row (name, position) changed
+#   departures  stops whose calls changed (changed, added or removed trips, renamed routes)
+#               or that share a trip with a changed stop
+#   trip, route, service  changed rows of those tables
+CHANGE_KINDS = ("stop", "departures", "trip", "route", "service")
+
+logger = logging.getLogger(__name__)
+
+
+def create_static_change_tables(cur: sqlite3.Cursor):
+    """
+    Creates the log of ids touched by each incremental static import.
+    """
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS static_changes(
+            version INTEGER,
+            kind TEXT,
+            id INTEGER,
+            PRIMARY KEY (version, kind, id)
+        ) WITHOUT ROWID
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS feed_state(
+            feed TEXT PRIMARY KEY,
+            header_timestamp INTEGER,
+            version INTEGER NOT NULL DEFAULT 0,
+            updated_at INTEGER
+        )
+    """)
+
+
+def record_static_changes(cur: sqlite3.Cursor, changes: Dict[str, Iterable[int]]) -> int:
+    """
+    Bumps the static feed version and logs the changed ids under it. Run once
+    the changes are written, and only if something changed: every version needs
+    log entries, or trackers treat it as lost and drop everything.
+    :param changes: ids per kind, see CHANGE_KINDS
+    :return: the new version
+    """
+    cur.execute("""
+        INSERT INTO feed_state(feed, version, updated_at)
+        VALUES (?, 1, strftime('%s', 'now'))
+        ON CONFLICT(feed) DO UPDATE SET
+            version = version + 1,
+            updated_at = excluded.updated_at
+    """, (STATIC_FEED_NAME,))
+    version = cur.execute("SELECT version FROM feed_state WHERE feed = ?", (STATIC_FEED_NAME,)).fetchone()[0]
+    for kind, ids in changes.items():
+        cur.executemany("INSERT OR IGNORE INTO static_changes VALUES (?,?,?)",
+                        ((version, kind, i) for i in ids))
+    cur.execute("DELETE FROM static_changes WHERE version <= ?", (version - CHANGE_LOG_VERSIONS,))
+    return version
+
+
+class StaticChangeTracker:
+    """
+    Follows the static feed version of the current database and hands the ids
+    changed since the last poll to the registered listeners, so each process
+    drops only the cached data of those stops and trips.
+    """
+
+    def __init__(self):
+        self.version: Optional[int] = None
+        self._listeners: List[Callable[[Dict[str, Set[int]]], None]] = []
+        self._lock = threading.Lock()
+
+    def on_change(self, listener: Callable[[Dict[str, Set[int]]], None]) -> Callable:
+        """
+        Registers listener(changes); changes is None when the log does not reach
+        back far enough and everything has to be dropped. Usable as a decorator.
+        """
+        self._listeners.append(listener)
+        return listener
+
+    def reset(self):
+        # After a database swap the next poll only records the version again
+        with self._lock:
+            self.version = None
+
+    def poll(self) -> bool:
+        """
+        :return: True if listeners were called
+        """
+        with self._lock:
+            cur = get_cursor()
+            row = cur.execute("SELECT version FROM feed_state WHERE feed = ?", (STATIC_FEED_NAME,)).fetchone()
+            version = row[0] if row else 0
+            if self.version is None or version == self.version:
+                self.version = version
+                return False
+
+            changes: Optional[Dict[str, Set[int]]] = {kind: set() for kind in CHANGE_KINDS}
+            logged = {v for (v,) in cur.execute(
+                "SELECT DISTINCT version FROM static_changes WHERE version > ? AND version <= ?",
+                (self.version, version))}
+            if version < self.version or len(logged) != version - self.version:
+                # Older than the kept log (or a different database): drop everything
+                changes = None
+            else:
+                for kind, i in cur.execute(
+                        "SELECT kind, id FROM static_changes WHERE version > ? AND version <= ?",
+                        (self.version, version)):
+                    changes.setdefault(kind, set()).add(i)
+            previous, self.version = self.version, version
+
+        logger.info("Static timetable changed (%s -> %s)", previous, version)
+        for listener in self._listeners:
+            try:
+                listener(changes)
+            except Exception as e:
+                logger.warning("Static change listener %s failed: %s", getattr(listener, "__name__", listener), e)
+        return True
+
+
+static_changes = StaticChangeTracker()
@@ -1,136 +1,108 @@
 import sqlite3
-from typing import Dict
+from typing import Dict, Optional
 from datetime import datetime, timedelta
 
-# DB_PATH = "tomfoolery-rs-main/database.db"
+from db_pool import generation, get_cursor
+from departure_board import departure_board, format_hhmmss
+from live_delays import DelaySnapshot, live_delays
+from metrics import SQLTimer
+from response_cache import LRUCache
+from service_calendar import service_calendar, SECONDS_PER_DAY
+
+# Number of upcoming trips returned per station
+NEXT_TRIPS_LIMIT = 100
+# Calls scheduled this long ago are still candidates, they may be running late
+DELAY_LOOKBACK_SECONDS = 30 * 60
+# Boards are shared by all requests for a stop within this many seconds
+RESPONSE_BUCKET_SECONDS = 15
+
+# Stop rows; only change with the static DB
+static_stop_cache = LRUCache("station_info_stop", maxsize=8192)
+# Finished boards per realtime version and time bucket
+station_response_cache = LRUCache("station_info_response", maxsize=2048, ttl=RESPONSE_BUCKET_SECONDS)
+
+
+def _load_stop(stop_id: int) -> Optional[Dict]:
+    cur = get_cursor(sqlite3.Row)
+    with SQLTimer("station_info_stop", cur) as timer:
+        cur.execute("""
+            SELECT stop_id, stop_name, latitude, longitude, location_type
+            FROM stops
+            WHERE stop_id = ?
+        """, (stop_id,))
+        stop_data = cur.fetchone()
+        timer.rows = 1 if stop_data else 0
+    return dict(stop_data) if stop_data else None
 
-def get_station_info(stop_id: int, db_path: str) -> Dict:
+
+def get_station_info(stop_id: int, limit: int = NEXT_TRIPS_LIMIT) -> Dict:
     """
-    Fetch stop info and the next 100 trips including scheduled/estimated times,
-    route short names, and trip headsigns.
+    Fetch stop info and the next 100 trips including scheduled/estimated times
+    and route short names.
     """
-    conn = sqlite3.connect(db_path)
-    print("Connected to database")
-    conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
-
     # Stop info
-    cur.execute("""
-        SELECT stop_id, stop_name, latitude, longitude, location_type
-        FROM stops
-        WHERE stop_id = ?
-    """, (stop_id,))
-    stop_data = cur.fetchone()
-    if not stop_data:
-        conn.close()
+    stop_info = static_stop_cache.get_or_compute((generation(), stop_id), lambda: _load_stop(stop_id))
+    if not stop_info:
         return {"error": "Stop not found"}
-    stop_info = dict(stop_data)
-
-    # Current time in HHMMSS
-    now_hhmmss = datetime.now().strftime("%H%M%S")
-
-    # Scheduled trips after current time
-    # NOTE: We assume 'route' table and 'trip_headsign' column exist in your DB.
-    # If your Rust importer didn't create them, this might need adjustment.
-
-    cur.execute("""
-        SELECT trip_id, arrival_time, departure_time
-        FROM stoptime
-        WHERE stop_id = ? AND arrival_time >= ?
-    """, (stop_id, now_hhmmss))
-    scheduled_trips_raw = [dict(row) for row in cur.fetchall()]
-
-    trip_ids = []
-    for trip in scheduled_trips_raw:
-        trip_ids.append(trip["trip_id"])
-
-    trip_ids_substitution_string = ",".join("?" for _ in trip_ids)
-    print(trip_ids_substitution_string)
-
-    cur.execute(f"""
-    SELECT t.trip_id, r.route_short_name
-    FROM trip t
-    JOIN routes r ON t.route_id = r.route_id
-    WHERE t.trip_id IN ({trip_ids_substitution_string});
-    """, trip_ids)
-    
-    trip_id_route_name_list = cur.fetchall()
-
-    trip_to_shortname_dict = { trip_id: short for trip_id, short in trip_id_route_name_list }
-
-    # Remove duplicate trips (keep first occurrence)
-
-    seen_trip_ids = set()
-    scheduled_trips = []
-    for trip in scheduled_trips_raw:
-        trip_id = trip["trip_id"]
-        if trip["trip_id"] not in seen_trip_ids:
-            # --- LOGIC FOR DISPLAY NAMES ---
-            # Route Name: Short > Long > ID
-            # route_name = trip.get("route_short_name") or trip.get("route_long_name") or str(trip["route_id"])
-
-            trip["display_route_name"] = trip_to_shortname_dict[trip_id]
-            scheduled_trips.append(trip)
-            seen_trip_ids.add(trip_id)
-
-
-
-    # Live updates
-    try:
-        cur.execute("""
-            SELECT trip_id, arrival_delay, departure_delay
-            FROM trip_updates
-            WHERE stop_id = ?
-        """, (stop_id,))
-        live_updates = {row["trip_id"]: dict(row) for row in cur.fetchall()}
-    except Exception:
-        live_updates = {}
 
+    # Current time in seconds since midnight
+    now = datetime.now()
+    now_secs = now.hour * 3600 + now.minute * 60 + now.second
+    delays = live_delays.current()
+
+    key = (generation(), stop_id, limit, delays.version, now.date(), now_secs // RESPONSE_BUCKET_SECONDS)
+    return station_response_cache.get_or_compute(
+        key, lambda: _next_trips(stop_id, stop_info, limit, delays, now, now_secs)
+    )
+
+
+def _next_trips(stop_id: int, stop_info: Dict, limit: int, delays: DelaySnapshot,
+                now: datetime, now_secs: int) -> Dict:
+
+    # Binary search into the stop's departure index: recent calls that may be
+    # delayed plus the next `limit` scheduled ones. Today's trips are searched at
+    # `now`, trips of yesterday's service day at `now + 24h` (times like 25:10:00).
+    board = departure_board.get(stop_id)
+    picked = []
+    for day_offset, trips in ((0, service_calendar.active_trips(now.date())),
+                              (SECONDS_PER_DAY, service_calendar.active_trips(now.date() - timedelta(days=1)))):
+        at = now_secs + day_offset
+        picked.extend(
+            (i, day_offset)
+            for i in departure_board.window(stop_id, at - DELAY_LOOKBACK_SECONDS, at, limit, trips)
+        )
+    if not picked:
+        return {"stop": stop_info, "next_trips": [], "realtime_version": delays.version}
+
+    # Live updates, looked up only for the calls we are about to return
     trips_with_estimates = []
-
-    for trip in scheduled_trips:
-        tid = trip["trip_id"]
-        scheduled_arrival = trip["arrival_time"]
-        scheduled_departure = trip["departure_time"]
-        
-        # Default estimates
-        estimated_arrival = scheduled_arrival
-        estimated_departure = scheduled_departure
-
-        # Apply live delays
-        if tid in live_updates:
-            delay_info = live_updates[tid]
-            arrival_delay = int(delay_info.get("arrival_delay", 0))
-            departure_delay = int(delay_info.get("departure_delay", 0))
-            
-            try:
-                # Simple HHMMSS parsing
-                h = int(scheduled_arrival[:2])
-                m = int(scheduled_arrival[2:4])
-                s = int(scheduled_arrival[4:6])
-                
-                dt = timedelta(hours=h, minutes=m, seconds=s) + timedelta(seconds=arrival_delay)
-                
-                total_seconds = int(dt.total_seconds()) % 86400
-                eh = total_seconds // 3600
-                em = (total_seconds % 3600) // 60
-                es = total_seconds % 60
-                estimated_arrival = f"{eh:02d}{em:02d}{es:02d}"
-            except ValueError:
-                pass
-
-        trip.update({
-            "estimated_arrival": estimated_arrival,
-            "estimated_departure": estimated_departure,
-        })
-        trips_with_estimates.append(trip)
+    for i, day_offset in picked:
+        tid = board.trip_ids[i]
+        # Shift yesterday's service day onto today's clock
+        arrival = board.arrival_secs[i] - day_offset
+        departure = board.departure_secs[i] - day_offset
+        arrival_delay, departure_delay = delays.delay(tid, stop_id) or (0, 0)
+
+        estimated_arrival = arrival + arrival_delay
+        estimated_departure = departure + departure_delay
+        # Calls from the lookback window only count if the delay makes them upcoming
+        if departure < now_secs and max(estimated_arrival, estimated_departure) < now_secs:
+            continue
+
+        trips_with_estimates.append((estimated_arrival, {
+            "trip_id": tid,
+            "arrival_time": format_hhmmss(arrival),
+            "departure_time": format_hhmmss(departure),
+            "display_route_name": board.route_names[i],
+            "estimated_arrival": format_hhmmss(estimated_arrival),
+            "estimated_departure": format_hhmmss(estimated_departure),
+        }))
 
     # Sort by time
-    trips_sorted = sorted(trips_with_estimates, key=lambda x: x["estimated_arrival"])[:100]
-
-    conn.close()
+    trips_sorted = [trip for _, trip in sorted(trips_with_estimates, key=lambda x: x[0])[:limit]]
 
     return {
         "stop": stop_info,
-        "next_trips": trips_sorted
+        "next_trips": trips_sorted,
+        "realtime_version": delays.version
     }
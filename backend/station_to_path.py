@@ -1,60 +1,218 @@
-import sqlite3
-import os
+from bisect import bisect_left
+from datetime import datetime
+from typing import List, Optional, Tuple
 
-DB_FILE_NAME = "/database.db"
+from db_pool import generation, get_cursor
+from departure_board import parse_hhmmss
+from live_delays import DelaySnapshot, live_delays
+from metrics import SQLTimer
+from response_cache import LRUCache
+from service_calendar import service_calendar
+from timetable_snapshot import TimetableSnapshot, timetable_snapshots
 
-def getDBPath() -> str:
-    db_env: str | None = os.getenv("DB_DIR")
-    if db_env is None:
-        print("Did not find ENV VAR")
-        return "tomfoolery-rs-main/database.db"
+# Trips through a stop with their full stop lists; only changes with the static DB
+static_routes_cache = LRUCache("routes_for_stop_static", maxsize=1024)
+# Trips through a stop grouped by stop pattern, sorted by departure at the stop
+static_patterns_cache = LRUCache("routes_for_stop_patterns", maxsize=1024)
+# Finished responses per realtime version and service day
+routes_response_cache = LRUCache("routes_for_stop_response", maxsize=1024, ttl=300)
+
+# Trips per page in pattern mode
+ROUTES_PAGE_SIZE: int = 200
+MAX_ROUTES_PAGE_SIZE: int = 2000
+
+
+def get_routes_for_stop(stop_id, snapshot: Optional[DelaySnapshot] = None):
+    """
+    All trips running today through a stop with their ordered stops and last
+    known realtime stop.
+    :param snapshot: live delay snapshot to read from, defaults to the current one
+    """
+    if snapshot is None:
+        snapshot = live_delays.current()
+    now = datetime.now()
+    key = (generation(), str(stop_id), snapshot.version, now.date())
+    return routes_response_cache.get_or_compute(key, lambda: _overlay_realtime(stop_id, snapshot, now))
+
+
+def get_routes_for_stop_page(stop_id, snapshot: Optional[DelaySnapshot] = None, cursor: Optional[str] = None,
+                             limit: int = ROUTES_PAGE_SIZE, start: Optional[str] = None,
+                             end: Optional[str] = None) -> dict:
+    """
+    Compact form of get_routes_for_stop: every distinct stop pattern is sent once
+    and trips only reference it by pattern_index. The index numbers the patterns
+    of this stop only; it is not a route_patterns.pattern_id and differs between
+    stops. Trips are ordered by departure at the stop and paginated with an
+    opaque cursor.
+    :param snapshot: live delay snapshot to read from, defaults to the current one
+    :param cursor: next_cursor of the previous page
+    :param limit: trips per page, capped at MAX_ROUTES_PAGE_SIZE
+    :param start: earliest departure at the stop as HH:MM:SS (hours past 23 allowed)
+    :param end: latest departure at the stop as HH:MM:SS
+    :raises ValueError: for a malformed cursor or time
+    """
+    if snapshot is None:
+        snapshot = live_delays.current()
+    now = datetime.now()
+    limit = max(1, min(limit, MAX_ROUTES_PAGE_SIZE))
+    start_secs = parse_hhmmss(start) if start else 0
+    end_secs = parse_hhmmss(end) if end else None
+    after = _parse_cursor(cursor) if cursor else None
+
+    key = (generation(), str(stop_id), snapshot.version, now.date(), after, limit, start_secs, end_secs)
+    return routes_response_cache.get_or_compute(
+        key, lambda: _build_page(stop_id, snapshot, now, after, limit, start_secs, end_secs)
+    )
+
+
+def _parse_cursor(cursor: str) -> Tuple[int, int]:
+    try:
+        departure_secs, trip_id = cursor.split(".")
+        return int(departure_secs), int(trip_id)
+    except ValueError:
+        raise ValueError(f"invalid cursor {cursor!r}")
+
+
+def _build_page(stop_id, snapshot: DelaySnapshot, now: datetime, after: Optional[Tuple[int, int]],
+                limit: int, start_secs: int, end_secs: Optional[int]) -> dict:
+    patterns, trips = static_patterns_cache.get_or_compute(
+        (generation(), str(stop_id)), lambda: load_stop_patterns(stop_id)
+    )
+
+    # trips is sorted by (departure_secs, trip_id), so both bounds are a bisect
+    if after is not None and after >= (start_secs,):
+        position = bisect_left(trips, (after[0], after[1] + 1))
     else:
-        print("Found ENV VAR")
-        return db_env + DB_FILE_NAME
+        position = bisect_left(trips, (start_secs,))
+
+    page, used_patterns, next_cursor = [], {}, None
+    for departure_secs, trip_id, route_id, stop_seq, pattern_index in trips[position:]:
+        if end_secs is not None and departure_secs > end_secs:
+            break
+        if not service_calendar.is_running(trip_id, departure_secs, now):
+            continue
+        if len(page) == limit:
+            last = page[-1]
+            next_cursor = f"{last['departure_secs']}.{last['trip_id']}"
+            break
+        used_patterns[pattern_index] = patterns[pattern_index]
+        page.append({
+            "trip_id": trip_id,
+            "route_id": route_id,
+            "pattern_index": pattern_index,
+            "departure_secs": departure_secs,
+            "current_stop_sequence": stop_seq,
+            "last_known_stop": snapshot.last_known_stop(trip_id),
+        })
+
+    return {
+        "stop_id": stop_id,
+        "realtime_version": snapshot.version,
+        "patterns": list(used_patterns.values()),
+        "trips": page,
+        "next_cursor": next_cursor,
+    }
+
 
-DB_PATH = getDBPath() # Path to the DB created by Rust
+def _overlay_realtime(stop_id, snapshot: DelaySnapshot, now: datetime) -> List[dict]:
+    static_trips = static_routes_cache.get_or_compute(
+        (generation(), str(stop_id)), lambda: load_static_routes(stop_id)
+    )
 
-def get_routes_for_stop(stop_id):
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
+    results = []
+    for trip_id, route_id, stop_seq, departure_secs, full_stops in static_trips:
+        # Drop trips not running today
+        if not service_calendar.is_running(trip_id, departure_secs, now):
+            continue
+
+        current_real_stop = snapshot.last_known_stop(trip_id)
+
+        results.append({
+            "trip_id": trip_id,
+            "route_id": route_id,
+            "current_stop_sequence": stop_seq,
+            "last_known_stop": current_real_stop,
+            "full_route_stops": full_stops
+        })
+
+    return results
+
+
+def load_stop_patterns(stop_id) -> Tuple[List[dict], List[tuple]]:
+    """
+    Groups the static trips through a stop by their ordered stop list.
+    :return: (patterns, trips) where patterns[pattern_index] is {"pattern_index", "stops"}
+        and trips are (departure_secs, trip_id, route_id, stop_sequence, pattern_index)
+        sorted by departure at this stop; the index is local to this stop
+    """
+    static_trips = static_routes_cache.get_or_compute(
+        (generation(), str(stop_id)), lambda: load_static_routes(stop_id)
+    )
+
+    pattern_indexes, patterns, trips = {}, [], []
+    for trip_id, route_id, stop_seq, departure_secs, full_stops in static_trips:
+        key = tuple((stop["stop_id"], stop["sequence"]) for stop in full_stops)
+        pattern_index = pattern_indexes.get(key)
+        if pattern_index is None:
+            pattern_index = pattern_indexes[key] = len(patterns)
+            patterns.append({"pattern_index": pattern_index, "stops": full_stops})
+        trips.append((departure_secs, trip_id, route_id, stop_seq, pattern_index))
+
+    trips.sort()
+    return patterns, trips
+
+
+def load_static_routes(stop_id) -> List[tuple]:
+    """
+    Loads every trip through a stop, whatever its service day.
+    :return: (trip_id, route_id, stop_sequence, departure_secs, full_route_stops) per trip
+    """
+    snapshot = timetable_snapshots.current()
+    if snapshot is not None:
+        return _snapshot_static_routes(snapshot, int(stop_id))
+
+    cur = get_cursor()
 
     # ------------------------------------
     # 1. Find all trips that pass through this stop
     # ------------------------------------
-    cur.execute("""
-        SELECT t.trip_id, t.route_id, st.stop_sequence
-        FROM stoptime st
-        JOIN trip t ON st.trip_id = t.trip_id
-        WHERE st.stop_id = ?
-        ORDER BY t.route_id, t.trip_id, st.stop_sequence
-    """, (stop_id,))
-
-    rows = cur.fetchall()
+    with SQLTimer("routes_for_stop_trips", cur) as timer:
+        cur.execute("""
+            SELECT t.trip_id, t.route_id, st.stop_sequence, st.departure_secs
+            FROM stoptime st
+            JOIN trip t ON st.trip_id = t.trip_id
+            WHERE st.stop_id = ?
+            ORDER BY t.route_id, t.trip_id, st.stop_sequence
+        """, (stop_id,))
+
+        rows = cur.fetchall()
+        timer.rows = len(rows)
     if not rows:
-        conn.close()
         return []
 
     # Remove duplicates (route_id + trip_id)
     seen = set()
     trips = []
-    for trip_id, route_id, stop_seq in rows:
+    for trip_id, route_id, stop_seq, departure_secs in rows:
         if trip_id not in seen:
             seen.add(trip_id)
-            trips.append((trip_id, route_id, stop_seq))
+            trips.append((trip_id, route_id, stop_seq, departure_secs))
 
     trip_ids = tuple(t[0] for t in trips)
 
     # ------------------------------------
     # 2. Load all stoptimes for all trips at once
     # ------------------------------------
-    cur.execute(f"""
-        SELECT st.trip_id, st.stop_id, st.stop_sequence
-        FROM stoptime st
-        WHERE st.trip_id IN ({",".join("?" * len(trip_ids))})
-        ORDER BY st.trip_id, st.stop_sequence
-    """, trip_ids)
+    with SQLTimer("routes_for_stop_stoptimes", cur) as timer:
+        cur.execute(f"""
+            SELECT st.trip_id, st.stop_id, st.stop_sequence
+            FROM stoptime st
+            WHERE st.trip_id IN ({",".join("?" * len(trip_ids))})
+            ORDER BY st.trip_id, st.stop_sequence
+        """, trip_ids)
 
-    stoptime_rows = cur.fetchall()
+        stoptime_rows = cur.fetchall()
+        timer.rows = len(stoptime_rows)
 
     # Group by trip_id
     trip_stops_map = {}
@@ -65,39 +223,26 @@ def get_routes_for_stop(stop_id):
     # 3. Load stop details only once
     # ------------------------------------
     all_stop_ids = list({sid for _, sid, _ in stoptime_rows})
-    cur.execute(f"""
-        SELECT stop_id, stop_name, latitude, longitude
-        FROM stops
-        WHERE stop_id IN ({",".join("?" * len(all_stop_ids))})
-    """, all_stop_ids)
+    with SQLTimer("routes_for_stop_stops", cur) as timer:
+        cur.execute(f"""
+            SELECT stop_id, stop_name, latitude, longitude
+            FROM stops
+            WHERE stop_id IN ({",".join("?" * len(all_stop_ids))})
+        """, all_stop_ids)
+        stop_rows = cur.fetchall()
+        timer.rows = len(stop_rows)
 
     stop_info_map = {
         sid: {"stop_id": sid, "name": name, "lat": lat, "lon": lon}
-        for sid, name, lat, lon in cur.fetchall()
+        for sid, name, lat, lon in stop_rows
     }
 
     # ------------------------------------
-    # 4. Load last known positions from trip_updates
-    # ------------------------------------
-    cur.execute(f"""
-        SELECT trip_id, stop_id
-        FROM trip_updates
-        WHERE trip_id IN ({",".join("?" * len(trip_ids))})
-        ORDER BY trip_id
-    """, trip_ids)
-
-    updates = {}
-    for trip_id, current_stop in cur.fetchall():
-        updates[trip_id] = current_stop
-
-    conn.close()
-
-    # ------------------------------------
-    # 5. Build final structured response
+    # 4. Build the static part of the response
     # ------------------------------------
     results = []
 
-    for trip_id, route_id, stop_seq in trips:
+    for trip_id, route_id, stop_seq, departure_secs in trips:
         stops_for_trip = trip_stops_map.get(trip_id, [])
 
         full_stops = []
@@ -112,15 +257,49 @@ def get_routes_for_stop(stop_id):
                     "lon": info["lon"]
                 })
 
-        current_real_stop = updates.get(trip_id)
-        print("Current: ", current_real_stop)
+        results.append((trip_id, route_id, stop_seq, departure_secs, full_stops))
 
-        results.append({
-            "trip_id": trip_id,
-            "route_id": route_id,
-            "current_stop_sequence": stop_seq,
-            "last_known_stop": current_real_stop,
-            "full_route_stops": full_stops
-        })
+    return results
+
+
+def _snapshot_static_routes(snapshot: TimetableSnapshot, stop_id: int) -> List[tuple]:
+    """
+    load_static_routes read from the timetable snapshot instead of SQLite.
+    """
+    stop_index = snapshot.stop_index(stop_id)
+    if stop_index is None:
+        return []
+
+    # First call of every trip at this stop: (trip index) -> (stop_sequence, departure_secs)
+    first_calls = {}
+    for i in snapshot.stop_calls(stop_index):
+        trip_index, sequence = snapshot.stop_call_trips[i], snapshot.stop_call_sequences[i]
+        if trip_index not in first_calls or sequence < first_calls[trip_index][0]:
+            first_calls[trip_index] = (sequence, snapshot.stop_call_departures[i])
+
+    stop_info_map = {}
+    results = []
+    for trip_index, (stop_seq, departure_secs) in first_calls.items():
+        full_stops = []
+        for i in snapshot.trip_calls(trip_index):
+            s = snapshot.trip_call_stops[i]
+            info = stop_info_map.get(s)
+            if info is None:
+                lat, lon = snapshot.stop_lats[s], snapshot.stop_lons[s]
+                # Missing coordinates are stored as NaN
+                info = stop_info_map[s] = (snapshot.stop_ids[s], snapshot.stop_name(s),
+                                           lat if lat == lat else None, lon if lon == lon else None)
+            full_stops.append({
+                "stop_id": info[0],
+                "sequence": snapshot.trip_call_sequences[i],
+                "name": info[1],
+                "lat": info[2],
+                "lon": info[3]
+            })
+        route_index = snapshot.trip_routes[trip_index]
+        route_id = snapshot.route_ids[route_index] if route_index >= 0 else None
+        results.append((snapshot.trip_ids[trip_index], route_id, stop_seq, departure_secs, full_stops))
 
+    # Same order as the SQL query: by route, then trip
+    results.sort(key=lambda trip: (trip[1] is not None, trip[1] or 0, trip[0]))
     return results
@@ -0,0 +1,233 @@
+"""
+Blue/green replacement of the static database. The weekly refresh builds the new
+feed into a side file instead of the live one; this script then validates it,
+builds the derived tables, carries over the realtime data and swaps it in:
+
+    python swap_database.py --new "$DB_DIR/database.20250105030000.db"
+
+DB_PATH becomes a symlink to the current generation file and is repointed with
+one atomic rename. SQLite resolves the symlink, so every generation keeps its
+own -wal/-shm files. Running backends notice the new target (db_pool.check_for_swap),
+reopen their connections and drop their caches; requests already reading the
+old file finish on it.
+"""
+import argparse
+import glob
+import os
+import sqlite3
+import time
+from datetime import date
+from typing import Dict, Optional
+
+from db_pool import DB_PATH
+from database import SCHEMA_VERSION
+from map_data import initialize_db
+from spatial_index import rebuild_vehicles_rtree
+from timetable_snapshot import SNAPSHOT_SUFFIX, write_snapshot
+from writer_lock import FileLock
+
+# Columns the backend reads from the static tables
+REQUIRED_COLUMNS: Dict[str, tuple] = {
+    "stops": ("stop_name", "longitude", "latitude", "stop_id", "location_type"),
+    "trip": ("route_id", "service_id", "trip_id"),
+    "stoptime": ("trip_id", "arrival_secs", "departure_secs", "stop_id", "stop_sequence"),
+    "routes": ("route_short_name", "route_type", "route_id"),
+    "service": ("mon", "tue", "wed", "thur", "fri", "sat", "sun", "start_date", "end_date", "service_id"),
+}
+# Realtime tables copied from the live database, written by the realtime scheduler
+REALTIME_TABLES = ("trip_updates", "alerts", "feed_state", "other_vehicles")
+# A new feed with fewer rows than this share of the live one is rejected as truncated
+MIN_ROW_RATIO: float = float(os.getenv("SWAP_MIN_ROW_RATIO", "0.5"))
+# Previous generation files kept next to the current one, for rolling back by hand
+KEEP_GENERATIONS: int = int(os.getenv("SWAP_KEEP_GENERATIONS", "1"))
+
+
+def _columns(cur: sqlite3.Cursor, table: str, schema: str = "main") -> list:
+    return [row[1] for row in cur.execute(f"PRAGMA {schema}.table_info({table})")]
+
+
+def _counts(db_path: str) -> Dict[str, int]:
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    try:
+        return {table: conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] for table in REQUIRED_COLUMNS}
+    finally:
+        conn.close()
+
+
+def validate_database(new_path: str, live_path: Optional[str] = None, integrity_check: bool = False) -> Dict[str, int]:
+    """
+    Checks a freshly imported database before it may replace the live one: the
+    static tables have the columns the backend reads, none is empty or much
+    smaller than in the live database, and a few typical lookups work.
+    :param live_path: current database to compare row counts with, if any
+    :param integrity_check: also run PRAGMA quick_check (reads the whole file)
+    :return: row counts per static table
+    :raises ValueError: describing the first failed check
+    """
+    if not os.path.exists(new_path):
+        raise ValueError(f"{new_path} does not exist")
+    conn = sqlite3.connect(f"file:{new_path}?mode=ro", uri=True)
+    cur = conn.cursor()
+    try:
+        version = cur.execute("PRAGMA user_version").fetchone()[0]
+        if version != SCHEMA_VERSION:
+            raise ValueError(f"schema version {version}, the backend reads {SCHEMA_VERSION}")
+        for table, required in REQUIRED_COLUMNS.items():
+            missing = set(required) - set(_columns(cur, table))
+            if missing:
+                raise ValueError(f"{table} lacks columns {', '.join(sorted(missing))}")
+
+        counts = {table: cur.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] for table in REQUIRED_COLUMNS}
+        empty = [table for table, count in counts.items() if not count]
+        if empty:
+            raise ValueError(f"empty tables: {', '.join(empty)}")
+        if live_path and os.path.exists(live_path):
+            try:
+                live_counts = _counts(live_path)
+            except sqlite3.Error:
+                live_counts = {}
+            for table, live_count in live_counts.items():
+                if counts[table] < live_count * MIN_ROW_RATIO:
+                    raise ValueError(f"{table} has {counts[table]} rows, live database has {live_count}")
+
+        # Spot checks along the paths the endpoints take
+        stop = cur.execute("""
+            SELECT stop_id FROM stops
+            WHERE latitude BETWEEN -90 AND 90 AND longitude BETWEEN -180 AND 180
+            LIMIT 1
+        """).fetchone()
+        if stop is None:
+            raise ValueError("no stop with valid coordinates")
+        call = cur.execute("""
+            SELECT st.stop_id, st.departure_secs, r.route_short_name
+            FROM stoptime st
+            JOIN trip t ON t.trip_id = st.trip_id
+            JOIN routes r ON r.route_id = t.route_id
+            LIMIT 1
+        """).fetchone()
+        if call is None:
+            raise ValueError("no stop time joins to a trip and route")
+        if not isinstance(call[1], int):
+            raise ValueError(f"departure_secs {call[1]!r} is not an integer")
+        if cur.execute("SELECT 1 FROM stops WHERE stop_id = ?", (call[0],)).fetchone() is None:
+            raise ValueError(f"stop {call[0]} of stoptime is missing from stops")
+        today = int(date.today().strftime("%Y%m%d"))
+        if cur.execute("SELECT 1 FROM service WHERE start_date <= ? AND end_date >= ? LIMIT 1",
+                       (today, today)).fetchone() is None:
+            raise ValueError(f"no service is valid on {today}")
+
+        if integrity_check:
+            result = cur.execute("PRAGMA quick_check").fetchone()[0]
+            if result != "ok":
+                raise ValueError(f"quick_check: {result}")
+        return counts
+    finally:
+        conn.close()
+
+
+def carry_over_realtime(new_path: str, live_path: str) -> Dict[str, int]:
+    """
+    Copies the realtime tables from the live database into the new one, so the
+    swap does not wait for the next feed poll. Written after the copy, live rows
+    are picked up by the scheduler's next changed feed.
+    :return: rows copied per table
+    """
+    copied = {}
+    conn = sqlite3.connect(f"file:{new_path}", uri=True, timeout=30)
+    cur = conn.cursor()
+    cur.execute("ATTACH DATABASE ? AS live", (f"file:{live_path}?mode=ro",))
+    for table in REALTIME_TABLES:
+        live_columns = set(_columns(cur, table, "live"))
+        columns = [c for c in _columns(cur, table) if c in live_columns]
+        if not columns:
+            continue
+        column_list = ", ".join(columns)
+        cur.execute(f"DELETE FROM main.{table}")
+        cur.execute(f"INSERT INTO main.{table}({column_list}) SELECT {column_list} FROM live.{table}")
+        copied[table] = cur.rowcount
+    rebuild_vehicles_rtree(cur)
+    conn.commit()
+    cur.execute("DETACH DATABASE live")
+    conn.close()
+    return copied
+
+
+def swap_in(new_path: str, db_path: str = DB_PATH):
+    """
+    Atomically points db_path at new_path. The first swap replaces a plain
+    database file by the symlink; readers holding the old file keep reading it.
+    """
+    target = os.path.relpath(os.path.abspath(new_path), os.path.dirname(os.path.abspath(db_path)))
+    link = db_path + ".swap"
+    if os.path.lexists(link):
+        os.remove(link)
+    os.symlink(target, link)
+    os.replace(link, db_path)
+
+
+def remove_old_generations(db_path: str = DB_PATH, keep: int = KEEP_GENERATIONS,
+                           previous: Optional[str] = None) -> list:
+    """
+    Deletes generation files (with their -wal/-shm and timetable snapshot) beyond
+    the current one and the `keep` newest others, and the journal the plain
+    database left behind before the first swap.
+    :param previous: realpath db_path had before the swap that just ran. Backends
+        may still have it open, so it and its journal are only removed by a later run
+    :return: removed paths
+    """
+    removed = []
+    current = os.path.realpath(db_path)
+    stem, ext = os.path.splitext(db_path)
+    generations = sorted(
+        (path for path in glob.glob(f"{stem}.*{ext}") if os.path.realpath(path) not in (current, previous)),
+        key=os.path.getmtime, reverse=True,
+    )
+    stale = generations[keep:]
+    plain = os.path.join(os.path.realpath(os.path.dirname(os.path.abspath(db_path))), os.path.basename(db_path))
+    if os.path.islink(db_path) and plain != previous:
+        stale.append(None)  # orphaned journal of the pre-symlink database
+    for path in stale:
+        base = path or db_path
+        for suffix in ("-wal", "-shm", SNAPSHOT_SUFFIX) if path is None else ("", "-wal", "-shm", SNAPSHOT_SUFFIX):
+            if os.path.exists(base + suffix):
+                os.remove(base + suffix)
+                removed.append(base + suffix)
+    return removed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Validate a newly imported database and swap it in")
+    parser.add_argument("--new", required=True, help="freshly imported database (e.g. database.<timestamp>.db)")
+    parser.add_argument("--db", default=DB_PATH, help="live database path the backend opens")
+    parser.add_argument("--integrity-check", action="store_true", help="also run PRAGMA quick_check")
+    parser.add_argument("--keep", type=int, default=KEEP_GENERATIONS, help="previous generations to keep")
+    args = parser.parse_args()
+
+    if os.path.realpath(args.new) == os.path.realpath(args.db):
+        parser.error("--new is already the live database")
+
+    start = time.time()
+    with FileLock(args.db + ".swap.lock"):
+        counts = validate_database(args.new, args.db, args.integrity_check)
+        print(f"✅ Validated {args.new}: {counts}")
+        # Derived tables (spatial index, clusters, patterns, search) are built
+        # here, before the swap, instead of by the backend at startup
+        initialize_db(args.new)
+        if os.path.exists(args.db):
+            copied = carry_over_realtime(args.new, args.db)
+            print(f"✅ Carried over realtime data: {copied}")
+        # After the carry-over, which brings the static feed version along.
+        # Without a snapshot the backends read from SQLite, so no reason to abort
+        try:
+            write_snapshot(args.new)
+        except Exception as e:
+            print(f"⚠️ Timetable snapshot not written: {e}")
+        previous = os.path.realpath(args.db) if os.path.exists(args.db) else None
+        swap_in(args.new, args.db)
+        print(f"🔄 {args.db} -> {os.path.realpath(args.db)} after {time.time() - start:.1f}s")
+        for path in remove_old_generations(args.db, args.keep, previous):
+            print(f"🗑️ Removed {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+import hashlib
+import math
+from typing import Tuple
+
+from db_pool import generation, get_cursor
+from response_cache import LRUCache
+from serialization import dumps
+from spatial_index import stops_in_bbox, vehicles_in_bbox
+
+# Below this zoom a tile covers too many stops to send them individually
+MIN_STOP_ZOOM: int = 13
+MAX_ZOOM: int = 22
+
+# Serialized stop tiles with their ETag; only change with the static DB
+stop_tile_cache = LRUCache("stop_tiles", maxsize=8192)
+
+
+def tile_bounds(z: int, x: int, y: int) -> Tuple[float, float, float, float]:
+    """
+    Web Mercator (slippy map) tile to (north, south, east, west) in degrees.
+    :raises ValueError: for tiles outside the zoom range or the tile grid
+    """
+    n = 1 << z
+    if not (0 <= z <= MAX_ZOOM and 0 <= x < n and 0 <= y < n):
+        raise ValueError(f"tile {z}/{x}/{y} does not exist")
+
+    def lat(tile_y: int) -> float:
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * tile_y / n))))
+
+    return lat(y), lat(y + 1), (x + 1) / n * 360.0 - 180.0, x / n * 360.0 - 180.0
+
+
+def _encode(payload: dict) -> Tuple[bytes, str]:
+    body = dumps(payload)
+    return body, '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+
+
+def _build_stop_tile(z: int, x: int, y: int) -> Tuple[bytes, str]:
+    north, south, east, west = tile_bounds(z, x, y)
+    stops = stops_in_bbox(get_cursor(), south, north, west, east) if z >= MIN_STOP_ZOOM else []
+    return _encode({"type": "StopTileResponse", "payload": {"z": z, "x": x, "y": y, "stops": stops}})
+
+
+def get_stop_tile(z: int, x: int, y: int) -> Tuple[bytes, str]:
+    """
+    Serialized stops of one tile and its strong ETag, memoized per DB generation.
+    Tiles below MIN_STOP_ZOOM are empty.
+    """
+    return stop_tile_cache.get_or_compute((generation(), z, x, y), lambda: _build_stop_tile(z, x, y))
+
+
+def get_vehicle_tile(z: int, x: int, y: int) -> Tuple[bytes, str]:
+    """
+    Serialized e-scooters and other shared vehicles of one tile. Not cached, the
+    vehicle data changes with every refresh.
+    """
+    north, south, east, west = tile_bounds(z, x, y)
+    escooters = vehicles_in_bbox(get_cursor(), south, north, west, east) if z >= MIN_STOP_ZOOM else []
+    return _encode({"type": "VehicleTileResponse", "payload": {"z": z, "x": x, "y": y, "escooters": escooters}})
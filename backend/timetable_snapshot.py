@@ -0,0 +1,493 @@
+"""
+Binary timetable snapshot shared by all worker processes. At import time the
+static tables are written as flat arrays into `<database file>.timetable`, next
+to the generation file DB_PATH points at:
+
+    python timetable_snapshot.py [--db "$DB_DIR/database.db"]
+
+Workers mmap the file read-only and read the arrays in place through
+memoryviews, so N workers share one copy of the pages in the OS page cache and
+start without loading stop times from SQLite. The snapshot is only used while it
+matches the database: same file (inode) and same static feed version, which
+incremental imports bump; otherwise readers fall back to SQLite until a
+matching snapshot is written.
+
+Layout: a 4 KiB header (magic, format and schema version, static version,
+inode, section directory) followed by 8 byte aligned sections, each one array
+of a single array typecode in native byte order. Stop times are stored twice,
+grouped by stop (in departure order) and by trip (in stop_sequence order), as
+offsets into the call arrays (CSR); calls refer to stops, trips and routes by
+their index in the sorted id arrays.
+"""
+import argparse
+import mmap
+import os
+import shutil
+import sqlite3
+import struct
+import tempfile
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from collections import Counter
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from database import SCHEMA_VERSION
+from db_pool import DB_PATH, get_cursor
+from static_changes import STATIC_FEED_NAME
+
+# Read the snapshot in the backend (the SQLite paths are used otherwise)
+SNAPSHOT_ENABLED: bool = os.getenv("TIMETABLE_SNAPSHOT", "1") == "1"
+# How long a process waits before looking again for a missing or stale snapshot
+SNAPSHOT_RETRY_SECONDS: float = float(os.getenv("TIMETABLE_SNAPSHOT_RETRY_SECONDS", "10"))
+SNAPSHOT_SUFFIX: str = ".timetable"
+SNAPSHOT_MAGIC: bytes = b"TTSNAP\x00\x01"
+# Bumped whenever sections are added, removed or change meaning
+SNAPSHOT_FORMAT: int = 1
+# Rows fetched per step while streaming stop times
+CHUNK_SIZE: int = 100_000
+
+# magic, format, schema version, static version, database inode, created at, section count
+_HEADER = struct.Struct("=8sIIqqqI4x")
+# name, array typecode, byte offset, item count
+_SECTION = struct.Struct("=24s4sqq")
+_DATA_START = 4096
+_MAX_SECTIONS = (_DATA_START - _HEADER.size) // _SECTION.size
+
+# Sections and their typecodes. Offsets arrays have one entry more than their
+# stops or trips; -1 in trip_routes / trip_services means not in the feed
+SECTIONS: Dict[str, str] = {
+    "stop_ids": "q", "stop_lats": "d", "stop_lons": "d", "stop_name_offsets": "q", "stop_names": "B",
+    "route_ids": "q", "route_types": "i", "route_name_offsets": "q", "route_names": "B",
+    "service_ids": "q", "service_weekdays": "B", "service_starts": "i", "service_ends": "i",
+    "trip_ids": "q", "trip_routes": "i", "trip_services": "i",
+    "stop_call_offsets": "q", "stop_call_trips": "i", "stop_call_sequences": "i",
+    "stop_call_arrivals": "i", "stop_call_departures": "i",
+    "trip_call_offsets": "q", "trip_call_stops": "i", "trip_call_sequences": "i",
+    "trip_call_arrivals": "i", "trip_call_departures": "i",
+}
+_WEEKDAY_COLUMNS = ("mon", "tue", "wed", "thur", "fri", "sat", "sun")
+
+
+def snapshot_path(db_path: str = DB_PATH) -> str:
+    # Next to the generation file, so every swapped-in database brings its own
+    return os.path.realpath(db_path) + SNAPSHOT_SUFFIX
+
+
+def _static_version(cur: sqlite3.Cursor) -> int:
+    # Freshly imported databases get feed_state from initialize_db later; version 0 either way
+    if cur.execute("SELECT 1 FROM sqlite_master WHERE name = 'feed_state'").fetchone() is None:
+        return 0
+    row = cur.execute("SELECT version FROM feed_state WHERE feed = ?", (STATIC_FEED_NAME,)).fetchone()
+    return row[0] if row else 0
+
+
+class _Spool:
+    """
+    One array written chunk by chunk into a temp file, so a column of millions
+    of stop times never has to be held in memory while the file is built.
+    """
+
+    def __init__(self, typecode: str, directory: str):
+        self.typecode = typecode
+        self.count = 0
+        self.file = tempfile.TemporaryFile(dir=directory)
+
+    def extend(self, values):
+        chunk = array(self.typecode, values)
+        chunk.tofile(self.file)
+        self.count += len(chunk)
+
+
+class _SnapshotWriter:
+    """
+    Appends sections to a temp file and writes the header last.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.tmp_path = f"{path}.tmp{os.getpid()}"
+        self.file = open(self.tmp_path, "wb")
+        self.file.write(b"\x00" * _DATA_START)
+        self.sections: List[Tuple[str, str, int, int]] = []
+
+    def _start(self, name: str, typecode: str, count: int) -> None:
+        if SECTIONS[name] != typecode:
+            raise ValueError(f"section {name} is {SECTIONS[name]}, not {typecode}")
+        offset = self.file.tell()
+        padding = -offset % 8
+        self.file.write(b"\x00" * padding)
+        self.sections.append((name, typecode, offset + padding, count))
+
+    def add(self, name: str, values: array):
+        self._start(name, values.typecode, len(values))
+        values.tofile(self.file)
+
+    def add_spool(self, name: str, spool: _Spool):
+        self._start(name, spool.typecode, spool.count)
+        spool.file.seek(0)
+        shutil.copyfileobj(spool.file, self.file, 1024 * 1024)
+        spool.file.close()
+
+    def finish(self, static_version: int, inode: int):
+        self.file.seek(0)
+        self.file.write(_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_FORMAT, SCHEMA_VERSION, static_version, inode,
+                                     int(time.time()), len(self.sections)))
+        for name, typecode, offset, count in self.sections:
+            self.file.write(_SECTION.pack(name.encode("ascii"), typecode.encode("ascii"), offset, count))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        # Processes that mapped the previous snapshot keep reading its (unlinked) pages
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        self.file.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+
+def _strings(values: Sequence[Optional[str]]) -> Tuple[array, array]:
+    """
+    :return: (offsets with one entry per string plus the end, utf-8 blob)
+    """
+    offsets, blob = array("q", [0]), bytearray()
+    for value in values:
+        blob += (value or "").encode("utf-8")
+        offsets.append(len(blob))
+    return offsets, array("B", bytes(blob))
+
+
+def _stream_calls(cur: sqlite3.Cursor, writer: _SnapshotWriter, prefix: str, groups: int, sql: str):
+    """
+    Writes one CSR call grouping: rows of (group index, other index, sequence,
+    arrival, departure) sorted by group become {prefix}_offsets and the four
+    call arrays.
+    """
+    directory = os.path.dirname(writer.path)
+    other = "trips" if prefix == "stop_call" else "stops"
+    spools = [_Spool("i", directory) for _ in range(4)]
+    counts = array("q", bytes(8 * groups))
+    cur.execute(sql)
+    while True:
+        rows = cur.fetchmany(CHUNK_SIZE)
+        if not rows:
+            break
+        columns = list(zip(*rows))
+        for group, count in Counter(columns[0]).items():
+            counts[group] += count
+        for column, spool in zip(columns[1:], spools):
+            spool.extend(column)
+
+    offsets, total = array("q", [0]), 0
+    for count in counts:
+        total += count
+        offsets.append(total)
+    writer.add(f"{prefix}_offsets", offsets)
+    for name, spool in zip((other, "sequences", "arrivals", "departures"), spools):
+        writer.add_spool(f"{prefix}_{name}", spool)
+
+
+def write_snapshot(db_path: str = DB_PATH, path: Optional[str] = None) -> str:
+    """
+    Writes the timetable snapshot of a database, replacing an older one
+    atomically. Reads everything in one read transaction, so the snapshot and
+    its static version always agree.
+    :param path: output file, defaults to snapshot_path(db_path)
+    :return: the snapshot path
+    """
+    start = time.time()
+    path = path or snapshot_path(db_path)
+    inode = os.stat(db_path).st_ino
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    conn.isolation_level = None  # explicit transactions only
+    cur = conn.cursor()
+    cur.execute("PRAGMA temp_store = FILE")
+    writer = _SnapshotWriter(path)
+    try:
+        cur.execute("BEGIN")
+        static_version = _static_version(cur)
+
+        # Index of every id in the sorted id arrays, joined to the stop times by SQLite
+        cur.execute("CREATE TEMP TABLE snapshot_stops(stop_id INTEGER PRIMARY KEY, idx INTEGER)")
+        cur.execute("""
+            INSERT INTO temp.snapshot_stops
+            SELECT stop_id, ROW_NUMBER() OVER (ORDER BY stop_id) - 1
+            FROM (SELECT DISTINCT stop_id FROM stops WHERE stop_id IS NOT NULL)
+        """)
+        cur.execute("CREATE TEMP TABLE snapshot_routes(route_id INTEGER PRIMARY KEY, idx INTEGER)")
+        cur.execute("""
+            INSERT INTO temp.snapshot_routes
+            SELECT route_id, ROW_NUMBER() OVER (ORDER BY route_id) - 1
+            FROM (SELECT DISTINCT route_id FROM routes WHERE route_id IS NOT NULL)
+        """)
+        cur.execute("CREATE TEMP TABLE snapshot_trips(trip_id INTEGER PRIMARY KEY, idx INTEGER)")
+        cur.execute("""
+            INSERT INTO temp.snapshot_trips
+            SELECT trip_id, ROW_NUMBER() OVER (ORDER BY trip_id) - 1
+            FROM (SELECT DISTINCT trip_id FROM trip WHERE trip_id IS NOT NULL)
+        """)
+
+        stops = cur.execute("""
+            SELECT s.stop_id, MIN(st.latitude), MIN(st.longitude), MIN(st.stop_name)
+            FROM temp.snapshot_stops s JOIN stops st ON st.stop_id = s.stop_id
+            GROUP BY s.stop_id ORDER BY s.stop_id
+        """).fetchall()
+        writer.add("stop_ids", array("q", (row[0] for row in stops)))
+        writer.add("stop_lats", array("d", (row[1] if row[1] is not None else float("nan") for row in stops)))
+        writer.add("stop_lons", array("d", (row[2] if row[2] is not None else float("nan") for row in stops)))
+        offsets, blob = _strings([row[3] for row in stops])
+        writer.add("stop_name_offsets", offsets)
+        writer.add("stop_names", blob)
+        stop_count = len(stops)
+        del stops
+
+        routes = cur.execute("""
+            SELECT r.route_id, MIN(rt.route_type), MIN(rt.route_short_name)
+            FROM temp.snapshot_routes r JOIN routes rt ON rt.route_id = r.route_id
+            GROUP BY r.route_id ORDER BY r.route_id
+        """).fetchall()
+        writer.add("route_ids", array("q", (row[0] for row in routes)))
+        writer.add("route_types", array("i", (row[1] or 0 for row in routes)))
+        offsets, blob = _strings([row[2] for row in routes])
+        writer.add("route_name_offsets", offsets)
+        writer.add("route_names", blob)
+
+        services = cur.execute(f"""
+            SELECT service_id, {", ".join(_WEEKDAY_COLUMNS)}, start_date, end_date
+            FROM service WHERE service_id IS NOT NULL GROUP BY service_id ORDER BY service_id
+        """).fetchall()
+        service_index = {row[0]: i for i, row in enumerate(services)}
+        writer.add("service_ids", array("q", (row[0] for row in services)))
+        writer.add("service_weekdays", array("B", (
+            sum(1 << day for day in range(7) if row[1 + day] == 1) for row in services)))
+        writer.add("service_starts", array("i", (row[8] or 0 for row in services)))
+        writer.add("service_ends", array("i", (row[9] or 0 for row in services)))
+
+        trip_ids, trip_routes, trip_services = array("q"), array("i"), array("i")
+        for trip_id, route_idx, service_id in cur.execute("""
+            SELECT t.trip_id, r.idx, MIN(tr.service_id)
+            FROM temp.snapshot_trips t
+            JOIN trip tr ON tr.trip_id = t.trip_id
+            LEFT JOIN temp.snapshot_routes r ON r.route_id = tr.route_id
+            GROUP BY t.trip_id ORDER BY t.trip_id
+        """):
+            trip_ids.append(trip_id)
+            trip_routes.append(-1 if route_idx is None else route_idx)
+            trip_services.append(service_index.get(service_id, -1))
+        writer.add("trip_ids", trip_ids)
+        writer.add("trip_routes", trip_routes)
+        writer.add("trip_services", trip_services)
+        trip_count = len(trip_ids)
+        del trip_ids, trip_routes, trip_services
+
+        # Calls of stops and trips missing from their tables are left out
+        _stream_calls(cur, writer, "stop_call", stop_count, """
+            SELECT s.idx, t.idx, st.stop_sequence, st.arrival_secs, st.departure_secs
+            FROM stoptime st
+            JOIN temp.snapshot_stops s ON s.stop_id = st.stop_id
+            JOIN temp.snapshot_trips t ON t.trip_id = st.trip_id
+            ORDER BY st.stop_id, st.departure_secs, st.trip_id, st.stop_sequence
+        """)
+        # Sorting one table scan beats walking idx_stoptime_trip_sequence, which
+        # lacks arrival_secs and would look up every row in the table; the planner
+        # only skips the index when the scan is materialized first
+        _stream_calls(cur, writer, "trip_call", trip_count, """
+            WITH calls AS MATERIALIZED (
+                SELECT trip_id, stop_id, stop_sequence, arrival_secs, departure_secs FROM stoptime
+            )
+            SELECT t.idx, s.idx, c.stop_sequence, c.arrival_secs, c.departure_secs
+            FROM calls c
+            JOIN temp.snapshot_stops s ON s.stop_id = c.stop_id
+            JOIN temp.snapshot_trips t ON t.trip_id = c.trip_id
+            ORDER BY c.trip_id, c.stop_sequence
+        """)
+        cur.execute("COMMIT")
+        writer.finish(static_version, inode)
+    except BaseException:
+        writer.abort()
+        raise
+    finally:
+        conn.close()
+    print(f"🗂️ wrote timetable snapshot {path} ({os.path.getsize(path) / 1e6:,.1f} MB, "
+          f"static version {static_version}) in {time.time() - start:.1f}s")
+    return path
+
+
+class IndexedView:
+    """
+    Read-only sequence of values[indexes[i]], so per stop slices of the call
+    arrays can hand out trip ids and route names without copying.
+    """
+    __slots__ = ("values", "indexes")
+
+    def __init__(self, values: Sequence, indexes: Sequence[int]):
+        self.values = values
+        self.indexes = indexes
+
+    def __len__(self) -> int:
+        return len(self.indexes)
+
+    def __getitem__(self, i):
+        return self.values[self.indexes[i]]
+
+
+class TimetableSnapshot:
+    """
+    A snapshot file mapped read-only. Every section is an attribute of the
+    same name holding a memoryview into the mapping; nothing is copied.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, self.format, self.schema_version, self.static_version, self.inode, self.created_at,
+         count) = _HEADER.unpack_from(self._mmap, 0)
+        if magic != SNAPSHOT_MAGIC or self.format != SNAPSHOT_FORMAT or count > _MAX_SECTIONS:
+            raise ValueError(f"{path} is not a timetable snapshot of format {SNAPSHOT_FORMAT}")
+        view = memoryview(self._mmap)
+        for i in range(count):
+            name, typecode, offset, items = _SECTION.unpack_from(self._mmap, _HEADER.size + i * _SECTION.size)
+            name, typecode = name.rstrip(b"\x00").decode("ascii"), typecode.rstrip(b"\x00").decode("ascii")
+            size = array(typecode).itemsize
+            setattr(self, name, view[offset:offset + items * size].cast(typecode))
+        missing = [name for name in SECTIONS if not hasattr(self, name)]
+        if missing:
+            raise ValueError(f"{path} lacks sections {', '.join(missing)}")
+        # Route names are few and read on every departure; the trailing None is
+        # what trip_routes == -1 resolves to
+        self.route_name_list: List[Optional[str]] = [
+            self._string(self.route_name_offsets, self.route_names, i) or None for i in range(len(self.route_ids))
+        ] + [None]
+
+    @staticmethod
+    def _string(offsets, blob, i: int) -> str:
+        return bytes(blob[offsets[i]:offsets[i + 1]]).decode("utf-8")
+
+    def matches(self, cur: sqlite3.Cursor, inode: int) -> bool:
+        """
+        Whether the snapshot was written from this database file at its current
+        static version.
+        """
+        return (self.schema_version == SCHEMA_VERSION and self.inode == inode
+                and self.static_version == _static_version(cur))
+
+    @staticmethod
+    def _find(ids, value: int) -> Optional[int]:
+        i = bisect_left(ids, value)
+        return i if i < len(ids) and ids[i] == value else None
+
+    def stop_index(self, stop_id: int) -> Optional[int]:
+        return self._find(self.stop_ids, stop_id)
+
+    def trip_index(self, trip_id: int) -> Optional[int]:
+        return self._find(self.trip_ids, trip_id)
+
+    def stop_name(self, stop_index: int) -> str:
+        return self._string(self.stop_name_offsets, self.stop_names, stop_index)
+
+    def stop_calls(self, stop_index: int) -> range:
+        """
+        Positions of a stop's calls in the stop_call_* arrays, in departure order.
+        """
+        return range(self.stop_call_offsets[stop_index], self.stop_call_offsets[stop_index + 1])
+
+    def trip_calls(self, trip_index: int) -> range:
+        """
+        Positions of a trip's calls in the trip_call_* arrays, in stop_sequence order.
+        """
+        return range(self.trip_call_offsets[trip_index], self.trip_call_offsets[trip_index + 1])
+
+    def departures(self, stop_id: int):
+        """
+        The calls at a stop as views in departure order.
+        :return: (trip_ids, arrival_secs, departure_secs, route_names), empty if the stop is unknown
+        """
+        stop_index = self.stop_index(stop_id)
+        calls = self.stop_calls(stop_index) if stop_index is not None else range(0)
+        trips = self.stop_call_trips[calls.start:calls.stop]
+        return (IndexedView(self.trip_ids, trips),
+                self.stop_call_arrivals[calls.start:calls.stop],
+                self.stop_call_departures[calls.start:calls.stop],
+                IndexedView(self.route_name_list, IndexedView(self.trip_routes, trips)))
+
+
+class SnapshotManager:
+    """
+    Hands out the snapshot matching the current database, opening it on first
+    use. clear() after a swap or an incremental import makes the next call look
+    again; a missing or stale snapshot is looked for again after
+    SNAPSHOT_RETRY_SECONDS.
+    """
+
+    def __init__(self):
+        self._snapshot: Optional[TimetableSnapshot] = None
+        self._missing_since: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def clear(self):
+        with self._lock:
+            # Not closed: requests still reading its views keep the mapping alive
+            self._snapshot = None
+            self._missing_since = None
+
+    def current(self) -> Optional[TimetableSnapshot]:
+        if not SNAPSHOT_ENABLED:
+            return None
+        with self._lock:
+            if self._snapshot is not None:
+                return self._snapshot
+            now = time.monotonic()
+            if self._missing_since is not None and now - self._missing_since < SNAPSHOT_RETRY_SECONDS:
+                return None
+            self._missing_since = now
+            path = snapshot_path(DB_PATH)
+            if not os.path.exists(path):
+                return None
+            try:
+                snapshot = TimetableSnapshot(path)
+                if not snapshot.matches(get_cursor(), os.stat(DB_PATH).st_ino):
+                    print(f"⚠️ Timetable snapshot {path} is stale, reading from SQLite")
+                    return None
+            except (OSError, ValueError, sqlite3.Error) as e:
+                print(f"⚠️ Timetable snapshot {path} unusable: {e}")
+                return None
+            self._snapshot, self._missing_since = snapshot, None
+        print(f"✅ Mapped timetable snapshot {path} (static version {snapshot.static_version})")
+        return snapshot
+
+
+def ensure_snapshot(db_path: str = DB_PATH) -> bool:
+    """
+    Writes the snapshot of db_path unless a matching one exists.
+    :return: True if a snapshot was written
+    """
+    path = snapshot_path(db_path)
+    if os.path.exists(path):
+        conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+        try:
+            if TimetableSnapshot(path).matches(conn.cursor(), os.stat(db_path).st_ino):
+                return False
+        except (OSError, ValueError):
+            pass
+        finally:
+            conn.close()
+    write_snapshot(db_path, path)
+    return True
+
+
+timetable_snapshots = SnapshotManager()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write the binary timetable snapshot of a database")
+    parser.add_argument("--db", default=DB_PATH, help="database to snapshot")
+    parser.add_argument("--out", help="output file, defaults to <database file>.timetable")
+    args = parser.parse_args()
+    write_snapshot(args.db, args.out)
+
+
+if __name__ == "__main__":
+    main()
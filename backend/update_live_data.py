@@ -1,19 +1,8 @@
 from download_rt_gtfs_data import download_rt_gtfs_data
 from map_data import update_live_data, initialize_db
-from typing import Optional
-import os
 import sqlite3
 
-DB_FILE_NAME = "/database.db"
-
-def getDBPath() -> str:
-    db_env: Optional[str] = os.getenv("DB_DIR")
-    if db_env is None:
-        return "tomfoolery-rs-main/database.db"
-    else:
-        return db_env + DB_FILE_NAME
-
-DB_PATH = getDBPath()  # Path to the DB created by Rust
+from db_pool import DB_PATH
 
 # --- Ensure necessary tables exist ---
 def create_tables_if_not_exist(db_path: str):
@@ -42,9 +31,10 @@ def create_tables_if_not_exist(db_path: str):
     con.commit()
     con.close()
 
-initialize_db(DB_PATH)
-# Create tables first
-create_tables_if_not_exist(DB_PATH)
+if __name__ == "__main__":
+    initialize_db(DB_PATH)
+    # Create tables first
+    create_tables_if_not_exist(DB_PATH)
 
-# Now update live data
-update_live_data(DB_PATH, download_rt_gtfs_data())
+    # Now update live data
+    update_live_data(DB_PATH, download_rt_gtfs_data())
@@ -0,0 +1,198 @@
+"""
+Load driver for the API. Requests are built from a database (usually the one the
+server runs on), so they hit real stops, names and populated viewports. Prints
+throughput and p50/p95/p99 latency per endpoint; --json writes the same numbers
+to a file so two runs can be compared.
+
+    python bench/load_test.py --db /tmp/bench/database.db --base-url http://127.0.0.1:8000 \
+        --duration 30 --concurrency 16 --json before.json
+    python bench/load_test.py ... --json after.json --compare before.json
+"""
+import argparse
+import json
+import random
+import sqlite3
+import threading
+import time
+from typing import Callable, Dict, List, Tuple
+
+import requests
+
+ENDPOINTS = ("map_data", "station_info", "routes_for_stop", "search_stations")
+# Relative request mix when --endpoints is not given, roughly what the frontend sends
+DEFAULT_WEIGHTS: Dict[str, int] = {"map_data": 5, "station_info": 2, "routes_for_stop": 1, "search_stations": 2}
+# Viewport heights in degrees: city block, district, city, region
+VIEWPORT_SIZES: Tuple[float, ...] = (0.005, 0.02, 0.08, 0.5)
+
+
+class Workload:
+    """
+    Deterministic request generator drawing stop ids, names and map centers
+    from the database.
+    """
+
+    def __init__(self, db_path: str, seed: int, sample: int = 20_000):
+        conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+        rows = conn.execute(
+            "SELECT stop_id, stop_name, latitude, longitude FROM stops WHERE latitude IS NOT NULL "
+            "ORDER BY stop_id"
+        ).fetchall()
+        conn.close()
+        if not rows:
+            raise SystemExit(f"no stops in {db_path}")
+        # Sampled in Python from a fixed order, so the seed alone picks the stops and the requests
+        if len(rows) > sample:
+            rows = sorted(random.Random(seed).sample(rows, sample))
+        self.stops = rows
+        self.seed = seed
+
+    def builder(self, endpoint: str) -> Callable[[random.Random], Tuple[str, str, dict]]:
+        """
+        :return: function rng -> (method, path, params or json body)
+        """
+        def map_data(rng):
+            _, _, lat, lon = rng.choice(self.stops)
+            height = rng.choice(VIEWPORT_SIZES)
+            return "POST", "/map_data", {
+                "north": lat + height / 2, "south": lat - height / 2,
+                "east": lon + height, "west": lon - height,
+                "max_stops": 150, "include_routes": rng.random() < 0.3,
+            }
+
+        def station_info(rng):
+            return "GET", "/station_info", {"stop_id": rng.choice(self.stops)[0]}
+
+        def routes_for_stop(rng):
+            params = {"stop_id": rng.choice(self.stops)[0]}
+            if rng.random() < 0.5:
+                params["mode"] = "patterns"
+            return "GET", "/routes_for_stop", params
+
+        def search_stations(rng):
+            name = rng.choice(self.stops)[1] or "a"
+            # Typing prefixes, like the autocomplete in the frontend
+            return "GET", "/search_stations", {"query": name[: rng.randint(2, max(2, min(8, len(name))))]}
+
+        return {"map_data": map_data, "station_info": station_info,
+                "routes_for_stop": routes_for_stop, "search_stations": search_stations}[endpoint]
+
+
+def _percentile(sorted_values: List[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(q * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def run(base_url: str, workload: Workload, endpoints: List[str], concurrency: int,
+        duration: float, max_requests: int, timeout: float) -> dict:
+    """
+    Runs concurrency threads, each with its own session and seeded rng, until
+    duration passes or max_requests have been sent.
+    :return: per endpoint stats plus a "total" entry
+    """
+    builders = [(e, workload.builder(e)) for e in endpoints]
+    weights = [DEFAULT_WEIGHTS.get(e, 1) for e in endpoints]
+    latencies: Dict[str, List[float]] = {e: [] for e in endpoints}
+    errors: Dict[str, int] = {e: 0 for e in endpoints}
+    sent = [0]
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def worker(n: int):
+        rng = random.Random(workload.seed * 1000 + n)
+        session = requests.Session()
+        session.headers["Accept-Encoding"] = "br, gzip"
+        while time.perf_counter() < deadline:
+            with lock:
+                if max_requests and sent[0] >= max_requests:
+                    return
+                sent[0] += 1
+            endpoint, build = rng.choices(builders, weights=weights)[0]
+            method, path, payload = build(rng)
+            start = time.perf_counter()
+            try:
+                if method == "POST":
+                    response = session.post(base_url + path, json=payload, timeout=timeout)
+                else:
+                    response = session.get(base_url + path, params=payload, timeout=timeout)
+                _ = response.content
+                ok = response.status_code < 400
+            except requests.RequestException:
+                ok = False
+            elapsed = time.perf_counter() - start
+            with lock:
+                if ok:
+                    latencies[endpoint].append(elapsed)
+                else:
+                    errors[endpoint] += 1
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(n,), daemon=True) for n in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - started
+
+    def summarize(values: List[float], failed: int) -> dict:
+        values = sorted(values)
+        return {
+            "requests": len(values) + failed,
+            "errors": failed,
+            "rps": round(len(values) / wall, 1) if wall else 0.0,
+            "p50_ms": round(_percentile(values, 0.50) * 1000, 2),
+            "p95_ms": round(_percentile(values, 0.95) * 1000, 2),
+            "p99_ms": round(_percentile(values, 0.99) * 1000, 2),
+        }
+
+    results = {e: summarize(latencies[e], errors[e]) for e in endpoints}
+    results["total"] = summarize([v for vals in latencies.values() for v in vals], sum(errors.values()))
+    results["total"]["seconds"] = round(wall, 2)
+    return results
+
+
+def print_table(results: dict, baseline: dict = None):
+    columns = ("requests", "errors", "rps", "p50_ms", "p95_ms", "p99_ms")
+    print(f"{'endpoint':<18}" + "".join(f"{c:>12}" for c in columns))
+    for endpoint, stats in results.items():
+        line = f"{endpoint:<18}" + "".join(f"{stats[c]:>12}" for c in columns)
+        if baseline and endpoint in baseline and baseline[endpoint]["p95_ms"]:
+            change = stats["p95_ms"] / baseline[endpoint]["p95_ms"] - 1
+            line += f"   p95 {change:+.0%}"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", required=True, help="database to draw stops and viewports from")
+    parser.add_argument("--base-url", default="http://127.0.0.1:8000")
+    parser.add_argument("--endpoints", default=",".join(ENDPOINTS), help="comma separated subset of " + ", ".join(ENDPOINTS))
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds to run")
+    parser.add_argument("--requests", type=int, default=0, help="stop after this many requests (0: no limit)")
+    parser.add_argument("--timeout", type=float, default=30.0)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--compare", help="results file of an earlier run to compare p95 against")
+    args = parser.parse_args()
+
+    endpoints = [e.strip() for e in args.endpoints.split(",") if e.strip()]
+    unknown = set(endpoints) - set(ENDPOINTS)
+    if unknown:
+        parser.error(f"unknown endpoints: {', '.join(sorted(unknown))}")
+
+    results = run(args.base_url.rstrip("/"), Workload(args.db, args.seed), endpoints,
+                  args.concurrency, args.duration, args.requests, args.timeout)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+    print_table(results, baseline)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"args": vars(args), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
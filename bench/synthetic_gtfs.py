@@ -0,0 +1,314 @@
+"""
+Deterministic synthetic GTFS data at configurable scale, so the backend can be
+benchmarked without downloading the real Germany feed. The same arguments always
+produce the same data.
+
+Writes either a SQLite database with the schema rust/src/main.rs creates, or the
+GTFS text files the Rust importer reads:
+
+    python bench/synthetic_gtfs.py --db /tmp/bench/database.db --preset city
+    python bench/synthetic_gtfs.py --csv /tmp/bench/data --preset germany
+
+Stops are scattered around towns of Zipf-distributed size inside the German
+bounding box. Routes are lines through one town (bus, tram) or across several
+(regional and long-distance rail). Every route has up to three stop patterns
+(main line, reverse, short turn) that its trips share, as in real feeds.
+"""
+import argparse
+import csv
+import math
+import os
+import random
+import sqlite3
+import time
+from typing import Dict, Iterator, List, Tuple
+
+# Germany, roughly
+BBOX = (47.3, 55.0, 5.9, 15.0)  # south, north, west, east
+# Service days are valid for a decade, so a generated database keeps working
+SERVICE_START, SERVICE_END = 20240101, 20351231
+
+PRESETS: Dict[str, Dict[str, int]] = {
+    "small": {"stops": 5_000, "routes": 400, "trips": 10_000},
+    "city": {"stops": 50_000, "routes": 4_000, "trips": 150_000},
+    "germany": {"stops": 500_000, "routes": 25_000, "trips": 1_600_000},
+}
+
+# (service_id, mon, tue, wed, thu, fri, sat, sun, start_date, end_date, share of trips)
+SERVICES = (
+    (1, 1, 1, 1, 1, 1, 0, 0, SERVICE_START, SERVICE_END, 0.45),  # weekdays
+    (2, 0, 0, 0, 0, 0, 1, 0, SERVICE_START, SERVICE_END, 0.15),  # saturdays
+    (3, 0, 0, 0, 0, 0, 0, 1, SERVICE_START, SERVICE_END, 0.10),  # sundays
+    (4, 1, 1, 1, 1, 1, 1, 1, SERVICE_START, SERVICE_END, 0.25),  # daily
+    (5, 1, 1, 1, 1, 1, 0, 0, 20200101, 20201231, 0.05),          # expired
+)
+
+# route_type, share of routes, stops per pattern, seconds between stops
+ROUTE_KINDS = (
+    (3, 0.70, (8, 30), (60, 150)),       # bus
+    (0, 0.12, (12, 35), (60, 120)),      # tram
+    (2, 0.15, (6, 25), (300, 900)),      # regional rail
+    (101, 0.03, (4, 12), (1200, 3600)),  # long distance rail
+)
+
+_SYLLABLES = ("ber", "lin", "mün", "chen", "köl", "ham", "burg", "dorf", "stadt", "furt", "bach",
+              "hau", "sen", "wei", "ler", "ßen", "gar", "ten", "hei", "del", "brü", "cken", "fel", "den")
+_STOP_SUFFIXES = ("Hbf", "Bahnhof", "Markt", "Rathaus", "Schule", "Kirche", "Friedhof", "Post",
+                  "Hauptstraße", "Bahnhofstraße", "Schloßplatz", "Brücke", "Mühle", "Süd", "Nord", "West", "Ost")
+
+
+class SyntheticGTFS:
+    """
+    Generates one synthetic feed. Rows come out of generators, so even the
+    germany preset is written without holding the stop times in memory.
+    """
+
+    def __init__(self, stops: int, routes: int, trips: int, seed: int = 42):
+        self.n_stops = stops
+        self.n_routes = routes
+        self.n_trips = trips
+        self.seed = seed
+        rng = random.Random(seed)
+
+        # Towns with Zipf sizes; big towns get more stops and more routes
+        n_towns = max(1, stops // 250)
+        weights = [1.0 / (rank + 1) for rank in range(n_towns)]
+        total = sum(weights)
+        self.towns: List[Tuple[str, float, float, float]] = []
+        for rank, weight in enumerate(weights):
+            lat = rng.uniform(BBOX[0] + 0.3, BBOX[1] - 0.3)
+            lon = rng.uniform(BBOX[2] + 0.3, BBOX[3] - 0.3)
+            radius = 0.02 + 0.25 * math.sqrt(weight / weights[0])
+            self.towns.append((self._town_name(rng, rank), lat, lon, radius))
+        self.town_weights = [w / total for w in weights]
+
+        # stop_id -> (town, lat, lon); ids are 1-based like most feeds
+        self.stop_town: List[int] = []
+        self.stop_coords: List[Tuple[float, float]] = []
+        self.town_stops: List[List[int]] = [[] for _ in range(n_towns)]
+        towns = rng.choices(range(n_towns), weights=self.town_weights, k=stops)
+        for stop_id, town in enumerate(towns, start=1):
+            _, lat, lon, radius = self.towns[town]
+            self.stop_town.append(town)
+            self.stop_coords.append((rng.gauss(lat, radius / 2), rng.gauss(lon, radius / 2 / math.cos(math.radians(lat)))))
+            self.town_stops[town].append(stop_id)
+
+    @staticmethod
+    def _town_name(rng: random.Random, rank: int) -> str:
+        name = "".join(rng.choice(_SYLLABLES) for _ in range(rng.randint(2, 3)))
+        return f"{name.capitalize()}{'' if rank < 500 else f' {rank}'}"
+
+    def stops(self) -> Iterator[tuple]:
+        """
+        :return: (stop_name, longitude, latitude, stop_id, location_type) like the stops table
+        """
+        rng = random.Random(self.seed + 1)
+        for stop_id, (town, (lat, lon)) in enumerate(zip(self.stop_town, self.stop_coords), start=1):
+            name = f"{self.towns[town][0]} {rng.choice(_STOP_SUFFIXES)}"
+            if rng.random() < 0.5:
+                name += f" {stop_id}"
+            yield name, lon, lat, stop_id, 0
+
+    def services(self) -> Iterator[tuple]:
+        """
+        :return: (mon, tue, wed, thur, fri, sat, sun, start_date, end_date, service_id) like the service table
+        """
+        for service_id, *days, start, end, _ in SERVICES:
+            yield (*days, start, end, service_id)
+
+    def _patterns(self) -> Iterator[Tuple[int, str, int, int, List[List[int]]]]:
+        """
+        :return: (route_id, short_name, route_type, seconds_between_stops, patterns) per route
+        """
+        rng = random.Random(self.seed + 2)
+        kinds = [k[1] for k in ROUTE_KINDS]
+        for route_id in range(1, self.n_routes + 1):
+            route_type, _, (min_len, max_len), (min_gap, max_gap) = rng.choices(ROUTE_KINDS, weights=kinds)[0]
+            length = rng.randint(min_len, max_len)
+            if route_type in (3, 0):
+                town = rng.choices(range(len(self.towns)), weights=self.town_weights)[0]
+                candidates = self.town_stops[town] or [rng.randint(1, self.n_stops)]
+                picked = rng.sample(candidates, min(length, len(candidates)))
+                # Order along a random direction so the line does not zigzag
+                angle = rng.uniform(0, math.pi)
+                dx, dy = math.cos(angle), math.sin(angle)
+                picked.sort(key=lambda s: self.stop_coords[s - 1][0] * dy + self.stop_coords[s - 1][1] * dx)
+                name = f"{'Bus' if route_type == 3 else 'Tram'} {rng.randint(1, 199)}"
+            else:
+                towns = rng.choices(range(len(self.towns)), weights=self.town_weights, k=length)
+                picked = []
+                for town in towns:
+                    if self.town_stops[town]:
+                        picked.append(rng.choice(self.town_stops[town]))
+                picked = list(dict.fromkeys(picked)) or [rng.randint(1, self.n_stops)]
+                picked.sort(key=lambda s: self.stop_coords[s - 1][1])
+                name = f"{'RE' if route_type == 2 else 'ICE'} {rng.randint(1, 999)}"
+
+            patterns = [picked, picked[::-1]]
+            if len(picked) > 6:
+                patterns.append(picked[: len(picked) * 2 // 3])
+            yield route_id, name, route_type, rng.randint(min_gap, max_gap), patterns
+
+    def routes_and_trips(self) -> Tuple[List[tuple], List[tuple], List[tuple]]:
+        """
+        Routes, trips and the per-trip stop pattern, kept in memory (they are small).
+        :return: (routes rows, trip rows, (trip_id, pattern, start_secs, gap) per trip)
+        """
+        rng = random.Random(self.seed + 3)
+        routes, trips, schedule = [], [], []
+        route_list = list(self._patterns())
+        service_ids = [s[0] for s in SERVICES]
+        service_weights = [s[-1] for s in SERVICES]
+        for route_id, name, route_type, _, _ in route_list:
+            routes.append((name, route_type, route_id))
+        for trip_id in range(1, self.n_trips + 1):
+            route_id, _, _, gap, patterns = route_list[rng.randrange(len(route_list))]
+            pattern = patterns[rng.randrange(len(patterns))]
+            duration = gap * (len(pattern) - 1)
+            # Trips end before midnight, which importers before schema 2 required
+            latest_start = max(4 * 3600, 23 * 3600 + 59 * 60 - duration)
+            start = rng.randint(4 * 3600 + 30 * 60, latest_start) if latest_start > 4 * 3600 + 30 * 60 else 4 * 3600
+            service_id = rng.choices(service_ids, weights=service_weights)[0]
+            trips.append((route_id, service_id, trip_id))
+            schedule.append((trip_id, pattern, start, gap))
+        return routes, trips, schedule
+
+    @staticmethod
+    def stop_times(schedule: List[tuple]) -> Iterator[tuple]:
+        """
+        :return: (trip_id, arrival_secs, departure_secs, stop_id, stop_sequence) with seconds since service day start
+        """
+        for trip_id, pattern, start, gap in schedule:
+            at = start
+            for sequence, stop_id in enumerate(pattern, start=1):
+                # Deterministic dwell of 0-40 s, no extra random state per row
+                dwell = (trip_id * 31 + sequence * 17) % 41
+                arrival, departure = at, min(at + dwell, 86399)
+                yield trip_id, arrival, departure, stop_id, sequence
+                at = min(departure + gap, 86399)
+
+
+def _gtfs_time(seconds: int) -> str:
+    return f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+
+def _chunks(rows: Iterator[tuple], size: int = 50_000) -> Iterator[List[tuple]]:
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def write_sqlite(feed: SyntheticGTFS, db_path: str):
+    """
+    Writes the feed into a fresh database with the Rust importer's schema.
+    """
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(db_path + suffix):
+            os.remove(db_path + suffix)
+    os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+    conn = sqlite3.connect(db_path)
+    cur = conn.cursor()
+    cur.execute("PRAGMA journal_mode = OFF")
+    cur.execute("PRAGMA synchronous = OFF")
+    # Same statements as create_tables in rust/src/main.rs
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS service(
+            mon int, tue int, wed int, thur int, fri int,
+            sat int, sun int, start_date int, end_date int, service_id int
+        )""")
+    cur.execute("CREATE TABLE IF NOT EXISTS trip(route_id int, service_id int, trip_id int)")
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS stoptime(
+            stop_id integer not null,
+            departure_secs integer not null,
+            trip_id integer not null,
+            stop_sequence integer not null,
+            arrival_secs integer,
+            primary key (stop_id, departure_secs, trip_id, stop_sequence)
+        ) without rowid""")
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS stops(
+            stop_name text,
+            longitude real,
+            latitude real,
+            stop_id int,
+            location_type int
+        )""")
+    cur.execute("CREATE TABLE IF NOT EXISTS routes(route_short_name text, route_type int, route_id int)")
+
+    routes, trips, schedule = feed.routes_and_trips()
+    cur.executemany("INSERT INTO routes VALUES (?,?,?)", routes)
+    cur.executemany("INSERT INTO service VALUES (?,?,?,?,?,?,?,?,?,?)", feed.services())
+    cur.executemany("INSERT INTO trip VALUES (?,?,?)", trips)
+    written = 0
+    for chunk in _chunks(feed.stop_times(schedule)):
+        cur.executemany("INSERT OR REPLACE INTO stoptime(trip_id, arrival_secs, departure_secs, stop_id, stop_sequence) "
+                        "VALUES (?,?,?,?,?)", chunk)
+        written += len(chunk)
+        print(f"\rstop times: {written}", end="", flush=True)
+    print()
+    cur.executemany("INSERT INTO stops VALUES (?,?,?,?,?)", feed.stops())
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_stoptime_trip_sequence ON stoptime(trip_id, stop_sequence)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_routes_route_id ON routes(route_id, route_short_name)")
+    cur.execute("PRAGMA user_version = 2")
+    conn.commit()
+    conn.close()
+
+
+def write_csv(feed: SyntheticGTFS, out_dir: str):
+    """
+    Writes GTFS text files with the columns rust/src/main.rs deserializes.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+
+    def write(name: str, header: List[str], rows):
+        with open(os.path.join(out_dir, name), "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            writer.writerows(rows)
+
+    routes, trips, schedule = feed.routes_and_trips()
+    write("routes.txt", ["route_short_name", "route_type", "route_id"], routes)
+    write("calendar.txt", ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday",
+                           "start_date", "end_date", "service_id"], feed.services())
+    write("trips.txt", ["route_id", "service_id", "trip_id"], trips)
+    write("stop_times.txt", ["trip_id", "arrival_time", "departure_time", "stop_id", "stop_sequence"],
+          ((t, _gtfs_time(a), _gtfs_time(d), s, q)
+           for t, a, d, s, q in feed.stop_times(schedule)))
+    write("stops.txt", ["stop_id", "stop_name", "stop_lat", "stop_lon", "location_type"],
+          ((stop_id, name, lat, lon, location_type) for name, lon, lat, stop_id, location_type in feed.stops()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    out = parser.add_mutually_exclusive_group(required=True)
+    out.add_argument("--db", help="write a SQLite database with the Rust schema")
+    out.add_argument("--csv", help="write GTFS text files into this directory")
+    parser.add_argument("--preset", choices=sorted(PRESETS), default="small")
+    parser.add_argument("--stops", type=int, help="override the preset's stop count")
+    parser.add_argument("--routes", type=int, help="override the preset's route count")
+    parser.add_argument("--trips", type=int, help="override the preset's trip count")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    scale = dict(PRESETS[args.preset])
+    for key in scale:
+        if getattr(args, key) is not None:
+            scale[key] = getattr(args, key)
+
+    started = time.time()
+    feed = SyntheticGTFS(seed=args.seed, **scale)
+    if args.db:
+        write_sqlite(feed, args.db)
+    else:
+        write_csv(feed, args.csv)
+    print(f"generated {scale} in {time.time() - started:.1f}s -> {args.db or args.csv}")
+
+
+if __name__ == "__main__":
+    main()
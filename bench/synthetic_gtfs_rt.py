@@ -0,0 +1,174 @@
+"""
+Synthetic GTFS-RT trip update feed for a (synthetic or real) database, so the
+realtime ingest path can be exercised offline.
+
+Trips running around the current Berlin time get delays on their remaining
+stops; a share of the feed refers to unknown trips, like the real feed does.
+
+    python bench/synthetic_gtfs_rt.py --db /tmp/bench/database.db --out /tmp/bench/rt.pb
+    python bench/synthetic_gtfs_rt.py --db /tmp/bench/database.db --serve 8765 --interval 30
+
+With --serve, point the backend at it with GTFS_RT_URL=http://127.0.0.1:8765/rt.pb.
+Each regeneration gets a new ETag, unchanged polls get a 304.
+"""
+import argparse
+import http.server
+import random
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+from google.transit import gtfs_realtime_pb2
+
+# Share of trip updates for trip ids that are not in the database
+UNKNOWN_TRIP_SHARE: float = 0.1
+
+
+def active_trips(db_path: str, now_secs: int, window: int = 3600) -> dict:
+    """
+    Remaining stop times of trips departing within window seconds before now.
+    :return: {trip_id: [(stop_sequence, stop_id), ...]}
+    """
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    earliest = max(0, now_secs - window)
+    trips: dict = {}
+    for trip_id, stop_id, stop_sequence in conn.execute(
+            "SELECT trip_id, stop_id, stop_sequence FROM stoptime WHERE departure_secs BETWEEN ? AND ?",
+            (earliest, now_secs + window)):
+        trips.setdefault(trip_id, []).append((stop_sequence, stop_id))
+    conn.close()
+    for stops in trips.values():
+        stops.sort()
+    return trips
+
+
+def build_feed(trips: dict, max_trips: int, seed: int, timestamp: int) -> bytes:
+    """
+    :param trips: active_trips() result
+    :param max_trips: upper bound on trip updates in the feed
+    :return: serialized FeedMessage
+    """
+    rng = random.Random(seed)
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.header.gtfs_realtime_version = "2.0"
+    feed.header.incrementality = gtfs_realtime_pb2.FeedHeader.FULL_DATASET
+    feed.header.timestamp = timestamp
+
+    trip_ids = sorted(trips)
+    picked = rng.sample(trip_ids, min(max_trips, len(trip_ids)))
+    for trip_id in picked:
+        entity = feed.entity.add()
+        entity.id = f"tu-{trip_id}"
+        tu = entity.trip_update
+        tu.trip.trip_id = str(trip_id)
+        delay = max(0, int(rng.expovariate(1 / 180)))  # mostly small, sometimes large delays
+        for _, stop_id in trips[trip_id]:
+            update = tu.stop_time_update.add()
+            update.stop_id = str(stop_id)
+            update.arrival.delay = delay
+            delay = max(0, delay + rng.randint(-30, 45))
+            update.departure.delay = delay
+
+    for n in range(int(len(picked) * UNKNOWN_TRIP_SHARE)):
+        entity = feed.entity.add()
+        entity.id = f"unknown-{n}"
+        entity.trip_update.trip.trip_id = f"unknown-{n}"
+        update = entity.trip_update.stop_time_update.add()
+        update.stop_id = "0"
+        update.arrival.delay = 60
+
+    for n in range(max(1, len(picked) // 1000)):
+        entity = feed.entity.add()
+        entity.id = f"alert-{n}"
+        alert = entity.alert
+        alert.cause = gtfs_realtime_pb2.Alert.CONSTRUCTION
+        alert.effect = gtfs_realtime_pb2.Alert.DETOUR
+        alert.header_text.translation.add(text=f"Baustelle {n}", language="de")
+        alert.description_text.translation.add(text="Umleitung über die Hauptstraße", language="de")
+    return feed.SerializeToString()
+
+
+class FeedServer:
+    """
+    Serves the latest generated feed and rebuilds it every interval seconds.
+    """
+
+    def __init__(self, db_path: str, max_trips: int, seed: int, interval: float):
+        self.db_path = db_path
+        self.max_trips = max_trips
+        self.seed = seed
+        self.interval = interval
+        self.body = b""
+        self.etag = ""
+        self.generation = 0
+        self.regenerate()
+
+    def regenerate(self):
+        now = datetime.now(ZoneInfo("Europe/Berlin"))
+        trips = active_trips(self.db_path, now.hour * 3600 + now.minute * 60 + now.second)
+        self.body = build_feed(trips, self.max_trips, self.seed + self.generation, int(time.time()))
+        self.generation += 1
+        self.etag = f'"{self.generation}"'
+        print(f"generation {self.generation}: {len(self.body)} bytes, {min(len(trips), self.max_trips)} trips")
+
+    def _loop(self):
+        while True:
+            time.sleep(self.interval)
+            self.regenerate()
+
+    def http_server(self, port: int) -> http.server.ThreadingHTTPServer:
+        """
+        The feed's HTTP server, not serving yet. Port 0 picks a free port.
+        """
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body, etag = server.body, server.etag
+                if self.headers.get("If-None-Match") == etag:
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "application/x-protobuf")
+                self.send_header("Content-Length", str(len(body)))
+                self.send_header("ETag", etag)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return http.server.ThreadingHTTPServer(("127.0.0.1", port), Handler)
+
+    def serve(self, port: int):
+        httpd = self.http_server(port)
+        threading.Thread(target=self._loop, daemon=True).start()
+        print(f"serving on http://127.0.0.1:{httpd.server_port}/rt.pb")
+        httpd.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", required=True, help="database to take trips and stops from")
+    out = parser.add_mutually_exclusive_group(required=True)
+    out.add_argument("--out", help="write one feed to this file")
+    out.add_argument("--serve", type=int, metavar="PORT", help="serve the feed over http")
+    parser.add_argument("--max-trips", type=int, default=20_000, help="trip updates per feed")
+    parser.add_argument("--interval", type=float, default=30.0, help="seconds between regenerations with --serve")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    server = FeedServer(args.db, args.max_trips, args.seed, args.interval)
+    if args.serve:
+        server.serve(args.serve)
+    else:
+        with open(args.out, "wb") as f:
+            f.write(server.body)
+        print(f"wrote {args.out}")
+
+
+if __name__ == "__main__":
+    main()
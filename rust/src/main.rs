@@ -1,4 +1,3 @@
-use chrono;
 use csv::Reader;
 use rusqlite::{Connection, Transaction};
 use serde::Deserialize;
@@ -11,6 +10,9 @@ const STOP_TIMES: &str = "data/stop_times.txt";
 const STOPS: &str = "data/stops.txt";
 const ROUTES: &str = "data/routes.txt";
 
+// PRAGMA user_version of the tables below, SCHEMA_VERSION in backend/database.py
+const SCHEMA_VERSION: i32 = 2;
+
 // Data structures
 #[derive(Debug, Deserialize)]
 struct Service {
@@ -43,8 +45,8 @@ struct Trip {
 #[derive(Deserialize, Debug)]
 struct StopTime {
     trip_id: i32,
-    arrival_time: chrono::NaiveTime,
-    departure_time: chrono::NaiveTime,
+    arrival_time: String,
+    departure_time: String,
     stop_id: i32,
     stop_sequence: i32,
 }
@@ -85,14 +87,16 @@ fn create_tables(db: &Connection) {
     )
     .unwrap();
 
+    // Clustered by stop and departure, so the calls of a stop are one range of the key
     db.execute(
         "CREATE TABLE IF NOT EXISTS stoptime(
-            trip_id int,
-            arrival_time text,
-            departure_time text,
-            stop_id int,
-            stop_sequence int
-        )",
+            stop_id integer not null,
+            departure_secs integer not null,
+            trip_id integer not null,
+            stop_sequence integer not null,
+            arrival_secs integer,
+            primary key (stop_id, departure_secs, trip_id, stop_sequence)
+        ) without rowid",
         (),
     )
     .unwrap();
@@ -112,6 +116,29 @@ fn create_tables(db: &Connection) {
     db.execute("CREATE TABLE IF NOT EXISTS routes(route_short_name text, route_type int, route_id int)", ()).unwrap();
 }
 
+// Created after loading, which is much faster than updating them row by row
+fn create_indexes(db: &Connection) {
+    db.execute_batch(
+        "CREATE INDEX IF NOT EXISTS idx_stoptime_trip_sequence ON stoptime(trip_id, stop_sequence);
+         CREATE INDEX IF NOT EXISTS idx_routes_route_id ON routes(route_id, route_short_name);",
+    )
+    .unwrap();
+    db.pragma_update(None, "user_version", SCHEMA_VERSION).unwrap();
+}
+
+// GTFS H:MM:SS to seconds since the start of the service day, hours past 23 included
+fn gtfs_secs(value: &str) -> Result<Option<i32>, Box<dyn Error>> {
+    let value = value.trim();
+    if value.is_empty() {
+        return Ok(None);
+    }
+    let mut parts = value.split(':').map(|part| part.parse::<i32>());
+    match (parts.next(), parts.next(), parts.next(), parts.next()) {
+        (Some(h), Some(m), Some(s), None) => Ok(Some(h? * 3600 + m? * 60 + s?)),
+        _ => Err(format!("invalid time {value:?}").into()),
+    }
+}
+
 // Loaders
 fn load_service(tx: &Transaction) -> Result<(), Box<dyn Error>> {
     let mut stmt =
@@ -150,22 +177,46 @@ fn load_trips(tx: &Transaction) -> Result<(), Box<dyn Error>> {
     Ok(())
 }
 
+// Staged in file order and then inserted sorted by the stoptime key, which
+// appends to the clustered table instead of inserting at random positions
 fn load_stoptimes(tx: &Transaction) -> Result<(), Box<dyn Error>> {
-    let mut stmt = tx.prepare("INSERT INTO stoptime VALUES(?1, ?2, ?3, ?4, ?5)")?;
+    tx.execute(
+        "CREATE TEMP TABLE stoptime_load(trip_id, arrival_secs, departure_secs, stop_id, stop_sequence)",
+        (),
+    )?;
+    let mut stmt = tx.prepare("INSERT INTO stoptime_load VALUES(?1, ?2, ?3, ?4, ?5)")?;
 
     let file = fs::File::open(STOP_TIMES)?;
     let mut reader = Reader::from_reader(file);
 
+    // A non-timepoint call without any time takes the previous departure of its trip
+    let mut previous: Option<(i32, i32)> = None;
     for result in reader.deserialize() {
         let st: StopTime = result?;
+        let arrival = gtfs_secs(&st.arrival_time)?;
+        let departure = match (gtfs_secs(&st.departure_time)?.or(arrival), previous) {
+            (Some(departure), _) => departure,
+            (None, Some((trip_id, departure))) if trip_id == st.trip_id => departure,
+            (None, _) => continue,
+        };
+        previous = Some((st.trip_id, departure));
         stmt.execute((
             st.trip_id,
-            st.arrival_time.format("%H%M%S").to_string(),
-            st.departure_time.format("%H%M%S").to_string(),
+            arrival.unwrap_or(departure),
+            departure,
             st.stop_id,
             st.stop_sequence,
         ))?;
     }
+    drop(stmt);
+
+    tx.execute(
+        "INSERT OR REPLACE INTO stoptime(stop_id, departure_secs, trip_id, stop_sequence, arrival_secs)
+         SELECT stop_id, departure_secs, trip_id, stop_sequence, arrival_secs FROM stoptime_load
+         ORDER BY stop_id, departure_secs, trip_id, stop_sequence",
+        (),
+    )?;
+    tx.execute("DROP TABLE stoptime_load", ())?;
     Ok(())
 }
 
@@ -214,8 +265,16 @@ fn load_routes(tx: &Transaction) -> Result<(), Box<dyn Error>> {
 // Main
 fn main() {
     const DB_FILE: &str = "/database.db";
-    let mut base_path = std::env::var("DB_DIR").unwrap().to_string();
-    base_path.push_str(DB_FILE);
+    // DB_FILE builds a side file that swap_database.py swaps in, instead of
+    // writing into the database the backend is serving from
+    let base_path = match std::env::var("DB_FILE") {
+        Ok(path) => path,
+        Err(_) => {
+            let mut path = std::env::var("DB_DIR").unwrap().to_string();
+            path.push_str(DB_FILE);
+            path
+        }
+    };
 
     let mut db = Connection::open(&base_path).unwrap();
 
@@ -228,6 +287,7 @@ fn main() {
     load_stoptimes(&tx).unwrap();
     load_stops(&tx).unwrap();
     tx.commit().unwrap();
+    create_indexes(&db);
 
     println!("Database created successfully.");
 }
@@ -5,10 +5,34 @@ set -e
 
 OUT_DIR="$DB_DIR/data"
 TMP_DATA=/tmp/data.zip
+# Next to this script, wherever the checkout lives (start_backend.sh creates its .venv)
+BACKEND_DIR="$(cd "$(dirname "${BASH_SOURCE[0]}")/../backend" && pwd)"
+# "incremental" applies only the changed trips, stops, routes and services to the
+# live database; "full" (or a failed incremental run) rebuilds and swaps it
+STATIC_IMPORT="${STATIC_IMPORT:-incremental}"
+# The new feed is built next to the live database and swapped in once it is
+# complete, so the running backend keeps serving the old one meanwhile
+NEW_DB="$DB_DIR/database.$(date +%Y%m%d%H%M%S).db"
 
 cd "$DB_DIR"
 
 curl "https://download.gtfs.de/germany/free/latest.zip" -o "$TMP_DATA"
 unzip -of "$TMP_DATA" -d "$OUT_DIR"
 
-./tomfoolery
+if [[ "$STATIC_IMPORT" == "incremental" && -e "$DB_DIR/database.db" ]]; then
+    if (cd "$BACKEND_DIR" && .venv/bin/python3 incremental_import.py --data "$OUT_DIR"); then
+        exit 0
+    fi
+    echo "incremental import failed, doing a full rebuild"
+fi
+
+rm -f "$NEW_DB" "$NEW_DB-wal" "$NEW_DB-shm"
+DB_FILE="$NEW_DB" ./tomfoolery
+
+# Validates, builds the derived tables, copies the realtime data and swaps
+cd "$BACKEND_DIR"
+if ! .venv/bin/python3 swap_database.py --new "$NEW_DB"; then
+    echo "new database rejected, keeping the live one"
+    rm -f "$NEW_DB" "$NEW_DB-wal" "$NEW_DB-shm"
+    exit 1
+fi
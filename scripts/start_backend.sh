@@ -6,6 +6,11 @@ env -i
 export DB_DIR="$HOME/gits/TOMFoolery_BeepBeep/rust" 
 
 PORT=8000
+# One uvicorn worker per core; the first becomes the writer (DB init + realtime feeds)
+WORKERS="${WORKERS:-$(nproc)}"
+# Shared by all workers so /metrics reports every process; stale files are dropped
+export PROMETHEUS_MULTIPROC_DIR="${PROMETHEUS_MULTIPROC_DIR:-/tmp/beepbeep-metrics}"
+rm -rf "$PROMETHEUS_MULTIPROC_DIR" && mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
 # cd "$HOME/TOMFoolery_BeepBeep/backend"
 cd "$HOME/gits/TOMFoolery_BeepBeep/backend" # TODO: Remove this line!
 
@@ -14,21 +19,5 @@ source .venv/bin/activate
 
 pip3 install -r requirements.txt
 
-function update_live_data() {
-    while [ true ]; do
-        python3 update_live_data.py
-        sleep 10
-    done
-}
-
-function fetch_other_vehicle_data() {
-    while [ true ]; do
-        python3 fetch_other_vehicle_data.py
-        sleep 600
-    done
-}
-
-update_live_data &
-fetch_other_vehicle_data &
-
-uvicorn backend:app --port "$PORT" --host "0.0.0.0"
+# Realtime feeds are polled by the backend itself (see realtime_scheduler.py)
+uvicorn backend:app --port "$PORT" --host "0.0.0.0" --workers "$WORKERS"
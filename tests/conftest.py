@@ -0,0 +1,78 @@
+"""
+Shared fixtures. The backend and bench scripts import each other as top-level
+modules and read their configuration from the environment at import time, so
+both directories go on sys.path and the environment is set before any import.
+"""
+import csv
+import os
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List, Optional
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(ROOT, "backend"), os.path.join(ROOT, "bench")]
+os.environ["DB_DIR"] = tempfile.mkdtemp(prefix="gtfs-backend-tests-")
+os.environ["TIMETABLE_SNAPSHOT"] = "0"
+os.environ["REALTIME_SCHEDULER"] = "0"
+os.environ.pop("PROMETHEUS_MULTIPROC_DIR", None)
+
+from database import import_gtfs  # noqa: E402
+from db_pool import DB_PATH, check_for_swap  # noqa: E402
+from map_data import initialize_db  # noqa: E402
+from swap_database import swap_in  # noqa: E402
+from synthetic_gtfs import SyntheticGTFS, write_csv  # noqa: E402
+
+# Big enough for shared stops, several patterns per route and every service
+SMALL_FEED: Dict[str, int] = {"stops": 300, "routes": 30, "trips": 600}
+
+
+def read_gtfs(data_dir: str, name: str) -> List[dict]:
+    with open(os.path.join(data_dir, name), newline="", encoding="utf-8") as f:
+        return list(csv.DictReader(f))
+
+
+def write_gtfs(data_dir: str, name: str, rows: List[dict]):
+    with open(os.path.join(data_dir, name), "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def edit_gtfs(data_dir: str, name: str, edit: Callable[[dict], Optional[dict]]):
+    """
+    Rewrites one GTFS file row by row; edit returns the new row or None to drop it.
+    """
+    rows = [row for row in (edit(dict(row)) for row in read_gtfs(data_dir, name)) if row is not None]
+    write_gtfs(data_dir, name, rows)
+
+
+def build_db(data_dir: str, db_path: str) -> str:
+    """
+    Imports a feed the way a full refresh does: text files, then the derived tables.
+    """
+    import_gtfs(data_dir, db_path)
+    initialize_db(db_path)
+    return db_path
+
+
+@pytest.fixture
+def feed_dir(tmp_path) -> str:
+    data_dir = str(tmp_path / "data")
+    write_csv(SyntheticGTFS(**SMALL_FEED), data_dir)
+    return data_dir
+
+
+@pytest.fixture
+def live_db(feed_dir) -> str:
+    """
+    A fresh database swapped in at DB_PATH, which the backend modules read from.
+    Each test gets its own generation file, so the backend sees a new database.
+    """
+    new_path = os.path.join(os.path.dirname(DB_PATH), f"database.{time.time_ns()}.db")
+    build_db(feed_dir, new_path)
+    swap_in(new_path, DB_PATH)
+    check_for_swap(force=True)
+    return DB_PATH
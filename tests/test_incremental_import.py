@@ -0,0 +1,199 @@
+import sqlite3
+
+import pytest
+from fastapi.testclient import TestClient
+
+import incremental_import
+from conftest import build_db, edit_gtfs, read_gtfs, write_gtfs
+from incremental_import import TRIP_STOPS_KIND, import_delta
+from static_changes import STATIC_FEED_NAME, static_changes
+
+
+@pytest.fixture
+def db_path(feed_dir, tmp_path) -> str:
+    return build_db(feed_dir, str(tmp_path / "database.db"))
+
+
+def _edit_feed(data_dir: str):
+    # A bit of everything: renamed, moved and new stops, a renamed route, a
+    # deleted, a re-routed and a re-assigned trip
+    edit_gtfs(data_dir, "stops.txt", lambda row: (
+        {**row, "stop_name": "Renamed"} if row["stop_id"] == "5"
+        else {**row, "stop_lat": str(float(row["stop_lat"]) + 0.3)} if row["stop_id"] == "7"
+        else row
+    ))
+    stops = read_gtfs(data_dir, "stops.txt")
+    write_gtfs(data_dir, "stops.txt", stops + [{**stops[0], "stop_id": "9001", "stop_name": "New stop"}])
+    edit_gtfs(data_dir, "routes.txt", lambda row: {**row, "route_short_name": "X1"} if row["route_id"] == "3" else row)
+    edit_gtfs(data_dir, "trips.txt", lambda row: (
+        None if row["trip_id"] == "10"
+        else {**row, "route_id": "4"} if row["trip_id"] == "12"
+        else row
+    ))
+    edit_gtfs(data_dir, "stop_times.txt", lambda row: (
+        None if row["trip_id"] == "10"
+        else {**row, "stop_id": "9001"} if row["trip_id"] == "11" and row["stop_sequence"] == "2"
+        else row
+    ))
+
+
+def _contents(db_path: str) -> dict:
+    # Everything the import writes, without rowids and pattern ids, which
+    # legitimately differ between an incremental and a full import
+    conn = sqlite3.connect(db_path)
+    queries = {
+        "stops": "SELECT stop_id, stop_name, latitude, longitude, location_type FROM stops",
+        "trip": "SELECT route_id, service_id, trip_id FROM trip",
+        "routes": "SELECT route_short_name, route_type, route_id FROM routes",
+        "service": "SELECT * FROM service",
+        "stoptime": "SELECT trip_id, arrival_secs, departure_secs, stop_id, stop_sequence FROM stoptime",
+        "stop_clusters": "SELECT band, cell_x, cell_y, stop_count, round(latitude, 9), round(longitude, 9), stop_id, "
+                         "min_lat, max_lat, min_lon, max_lon FROM stop_clusters",
+        "stop_clusters_rtree": "SELECT r.min_band, c.band, c.cell_x, c.cell_y "
+                               "FROM stop_clusters_rtree r JOIN stop_clusters c ON c.rowid = r.id",
+        "route_patterns": "SELECT route_id, route_short_name, route_type, trip_count, rep_trip_id, stop_ids, "
+                          "coordinates FROM route_patterns",
+        "route_pattern_stops": "SELECT rps.stop_id, p.route_id, p.stop_ids "
+                               "FROM route_pattern_stops rps JOIN route_patterns p USING (pattern_id)",
+        "stops_rtree": "SELECT s.stop_id, r.min_lat, r.min_lon FROM stops_rtree r JOIN stops s ON s.rowid = r.id",
+        "stops_fts": "SELECT s.stop_id, f.name_folded FROM stops_fts f JOIN stops s ON s.rowid = f.rowid",
+    }
+    contents = {name: sorted(conn.execute(sql).fetchall(), key=repr) for name, sql in queries.items()}
+    conn.close()
+    return contents
+
+
+def _static_version(db_path: str):
+    conn = sqlite3.connect(db_path)
+    row = conn.execute("SELECT version FROM feed_state WHERE feed = ?", (STATIC_FEED_NAME,)).fetchone()
+    conn.close()
+    return row[0] if row else None
+
+
+def test_unchanged_feed_writes_nothing(db_path, feed_dir):
+    report = import_delta(feed_dir, db_path)
+    assert report["version"] is None
+    assert all(report[kind]["inserted"] + report[kind]["updated"] + report[kind]["deleted"] == 0
+               for kind in ("stop", "route", "service", "trip", TRIP_STOPS_KIND))
+    assert report[TRIP_STOPS_KIND]["unchanged"] == 600
+
+
+def test_baseline_hashes_are_stored_and_read_back(db_path, feed_dir):
+    edit_gtfs(feed_dir, "stops.txt", lambda row: {**row, "stop_name": "Renamed"} if row["stop_id"] == "5" else row)
+    assert import_delta(feed_dir, db_path)["version"] == 1
+
+    conn = sqlite3.connect(db_path)
+    stored = dict(conn.execute("SELECT kind, COUNT(*) FROM static_hashes GROUP BY kind"))
+    assert stored == {"stop": 300, "route": 30, "service": 5, "trip": 600, TRIP_STOPS_KIND: 600}
+    assert conn.execute("SELECT COUNT(*) FROM static_pending").fetchone()[0] == 0
+    # The second run compares against the stored hashes: an unchanged table
+    # would show up as all changed if they did not match the first run's
+    conn.execute("DELETE FROM stops")
+    conn.commit()
+    conn.close()
+    report = import_delta(feed_dir, db_path, dry_run=True)
+    assert report["stop"] == {"inserted": 0, "updated": 0, "deleted": 0, "unchanged": 300}
+
+
+def test_null_location_type_hashes_like_empty_field(db_path, feed_dir):
+    # Stops stored without location_type, next to a feed leaving the field empty
+    conn = sqlite3.connect(db_path)
+    conn.execute("UPDATE stops SET location_type = NULL")
+    conn.commit()
+    conn.close()
+    edit_gtfs(feed_dir, "stops.txt", lambda row: {**row, "location_type": ""})
+
+    report = import_delta(feed_dir, db_path, dry_run=True)
+    assert report["stop"] == {"inserted": 0, "updated": 0, "deleted": 0, "unchanged": 300}
+
+
+def test_too_large_delta_is_rejected(db_path, feed_dir):
+    edit_gtfs(feed_dir, "stop_times.txt",
+              lambda row: {**row, "stop_sequence": str(int(row["stop_sequence"]) + 1)}
+              if int(row["trip_id"]) % 3 else row)
+    before = _contents(db_path)
+
+    with pytest.raises(ValueError, match="use the full import"):
+        import_delta(feed_dir, db_path)
+    assert _contents(db_path) == before
+    assert _static_version(db_path) is None
+
+
+def test_delta_matches_full_import(db_path, feed_dir, tmp_path, monkeypatch):
+    # One trip and one route per transaction, so every chunk boundary is crossed
+    monkeypatch.setattr(incremental_import, "TRIPS_PER_TRANSACTION", 1)
+    monkeypatch.setattr(incremental_import, "ROUTES_PER_TRANSACTION", 1)
+    _edit_feed(feed_dir)
+
+    report = import_delta(feed_dir, db_path)
+    assert report["version"] == 1
+    assert report["stop"] == {"inserted": 1, "updated": 2, "deleted": 0, "unchanged": 298}
+    assert report[TRIP_STOPS_KIND] == {"inserted": 0, "updated": 1, "deleted": 1, "unchanged": 598}
+    assert _contents(db_path) == _contents(build_db(feed_dir, str(tmp_path / "full.db")))
+    assert import_delta(feed_dir, db_path, dry_run=True)[TRIP_STOPS_KIND]["unchanged"] == 599
+
+
+def test_interrupted_import_is_finished_by_next_run(db_path, feed_dir, tmp_path, monkeypatch):
+    monkeypatch.setattr(incremental_import, "ROUTES_PER_TRANSACTION", 1)
+    _edit_feed(feed_dir)
+    refresh_route_patterns = incremental_import.refresh_route_patterns
+    calls = []
+
+    def fail_once(cur, route_ids):
+        calls.append(route_ids)
+        if len(calls) == 2:
+            raise RuntimeError("interrupted")
+        refresh_route_patterns(cur, route_ids)
+
+    monkeypatch.setattr(incremental_import, "refresh_route_patterns", fail_once)
+    with pytest.raises(RuntimeError):
+        import_delta(feed_dir, db_path)
+    assert _static_version(db_path) is None
+
+    report = import_delta(feed_dir, db_path)
+    # Rows are all in by now; the staged ids are logged all the same
+    assert report[TRIP_STOPS_KIND]["updated"] == 0
+    assert report["version"] == 1
+    conn = sqlite3.connect(db_path)
+    logged = {stop_id for (stop_id,) in conn.execute(
+        "SELECT id FROM static_changes WHERE version = 1 AND kind = 'departures'")}
+    conn.close()
+    assert {5, 7, 9001} <= logged
+    assert _contents(db_path) == _contents(build_db(feed_dir, str(tmp_path / "full.db")))
+
+
+def _shared_trip_stops(db_path: str):
+    # Two different stops on one trip of the daily service, so it runs today
+    conn = sqlite3.connect(db_path)
+    trip_id, = conn.execute("""
+        SELECT t.trip_id FROM trip t JOIN stoptime st ON st.trip_id = t.trip_id
+        WHERE t.service_id = 4 GROUP BY t.trip_id HAVING COUNT(DISTINCT st.stop_id) >= 2
+        ORDER BY t.trip_id LIMIT 1
+    """).fetchone()
+    stop_ids = [s for (s,) in conn.execute(
+        "SELECT stop_id FROM stoptime WHERE trip_id = ? ORDER BY stop_sequence", (trip_id,))]
+    conn.close()
+    return trip_id, stop_ids[0], stop_ids[-1]
+
+
+def _stop_names(client: TestClient, stop_id: int, trip_id: int) -> dict:
+    trips = client.get("/routes_for_stop", params={"stop_id": stop_id}).json()
+    trip = next(t for t in trips if t["trip_id"] == trip_id)
+    return {stop["stop_id"]: stop["name"] for stop in trip["full_route_stops"]}
+
+
+def test_renamed_stop_reaches_routes_of_other_stops(live_db, feed_dir):
+    import backend
+
+    client = TestClient(backend.app)
+    trip_id, renamed, other = _shared_trip_stops(live_db)
+    static_changes.poll()
+    assert _stop_names(client, other, trip_id)[renamed] != "Renamed"
+
+    edit_gtfs(feed_dir, "stops.txt",
+              lambda row: {**row, "stop_name": "Renamed"} if int(row["stop_id"]) == renamed else row)
+    report = import_delta(feed_dir, live_db)
+    assert report["stop"]["updated"] == 1
+    assert static_changes.poll()
+
+    assert _stop_names(client, other, trip_id)[renamed] == "Renamed"
@@ -0,0 +1,34 @@
+import sqlite3
+
+from fastapi.testclient import TestClient
+
+from clustering import CLUSTER_BANDS
+from route_patterns import ROUTES_MAX_BAND
+
+
+def _busiest_stop(db_path: str):
+    conn = sqlite3.connect(db_path)
+    row = conn.execute("""
+        SELECT s.latitude, s.longitude FROM route_pattern_stops rps JOIN stops s ON s.stop_id = rps.stop_id
+        GROUP BY rps.stop_id ORDER BY COUNT(*) DESC LIMIT 1
+    """).fetchone()
+    conn.close()
+    return row
+
+
+def _map_data(client: TestClient, lat: float, lon: float, half_height: float, **params) -> dict:
+    bounds = {"north": lat + half_height, "south": lat - half_height,
+              "east": lon + 2 * half_height, "west": lon - 2 * half_height}
+    return client.post("/map_data", json={**bounds, **params}).json()["payload"]
+
+
+def test_routes_are_opt_in_and_limited_to_fine_zoom(live_db):
+    import backend
+
+    client = TestClient(backend.app)
+    lat, lon = _busiest_stop(live_db)
+    assert _map_data(client, lat, lon, 0.01)["routes"] == []
+    assert _map_data(client, lat, lon, 0.01, include_routes=True)["routes"]
+    # A viewport of a few hundred cells of the coarsest band that still gets lines
+    country = 200 * CLUSTER_BANDS[ROUTES_MAX_BAND]
+    assert _map_data(client, lat, lon, country, include_routes=True)["routes"] == []
@@ -0,0 +1,75 @@
+import sqlite3
+import threading
+
+import pytest
+from fastapi.testclient import TestClient
+
+from realtime_scheduler import PollingJob, RealtimeScheduler, _apply_gtfs_rt
+from synthetic_gtfs_rt import FeedServer
+
+
+@pytest.fixture
+def feed_server(live_db):
+    # Regenerated by hand only, so the ETag changes exactly when a test says so
+    server = FeedServer(live_db, max_trips=200, seed=42, interval=3600)
+    httpd = server.http_server(0)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield server, f"http://127.0.0.1:{httpd.server_port}/rt.pb", httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def _feed_state(db_path: str):
+    conn = sqlite3.connect(db_path)
+    row = conn.execute("SELECT version, updated_at FROM feed_state WHERE feed = 'gtfs_rt'").fetchone()
+    conn.close()
+    return row
+
+
+def test_unchanged_feed_is_not_written_again(live_db, feed_server):
+    server, url, _ = feed_server
+    job = PollingJob("gtfs_rt", url, 10, _apply_gtfs_rt, stream=True)
+    scheduler = RealtimeScheduler([job])
+
+    scheduler.run_once(job)
+    assert job.last_error is None
+    assert job.result["realtime_version"] == 1
+    assert job.etag == server.etag
+    state = _feed_state(live_db)
+
+    scheduler.run_once(job)
+    assert job.last_error is None
+    assert job.not_modified_count == 1
+    assert job.last_success >= job.last_attempt
+    assert _feed_state(live_db) == state
+
+    # A new ETag is fetched again (the ingest itself skips a repeated header timestamp)
+    last_change = job.last_change
+    server.regenerate()
+    scheduler.run_once(job)
+    assert job.not_modified_count == 1
+    assert job.etag == server.etag
+    assert job.last_change > last_change
+    scheduler.session.close()
+
+
+def test_failed_poll_shows_in_realtime_status(live_db, feed_server, monkeypatch):
+    import backend
+
+    _, url, httpd = feed_server
+    job = PollingJob("gtfs_rt", url, 10, _apply_gtfs_rt, stream=True)
+    scheduler = RealtimeScheduler([job])
+    monkeypatch.setattr(backend, "realtime_scheduler", scheduler)
+    scheduler.run_once(job)
+    httpd.shutdown()
+    httpd.server_close()
+
+    scheduler.run_once(job)
+    status = TestClient(backend.app).get("/realtime_status").json()["jobs"]["gtfs_rt"]
+    assert status["last_error"].startswith("ConnectionError")
+    # The last good fetch stays the reference for the lag
+    assert status["last_success"] < status["last_attempt"]
+    assert status["lag_seconds"] >= status["last_attempt"] - status["last_success"] - 0.01
+    assert _feed_state(live_db)[0] == 1
+    scheduler.session.close()
@@ -0,0 +1,12 @@
+from fastapi.testclient import TestClient
+
+
+def test_pattern_mode_references_patterns_by_local_index(live_db):
+    import backend
+
+    client = TestClient(backend.app)
+    page = client.get("/routes_for_stop", params={"stop_id": 1, "mode": "patterns", "limit": 2000}).json()
+    assert page["trips"]
+    indexes = {pattern["pattern_index"] for pattern in page["patterns"]}
+    assert {trip["pattern_index"] for trip in page["trips"]} == indexes
+    assert all("pattern_id" not in trip for trip in page["trips"])
@@ -0,0 +1,25 @@
+import sqlite3
+
+from search import rebuild_search_index, search_stations, short_query_cache
+
+
+def _rename_stops(db_path: str, names: dict):
+    conn = sqlite3.connect(db_path)
+    conn.executemany("UPDATE stops SET stop_name = ? WHERE stop_id = ?", [(n, i) for i, n in names.items()])
+    rebuild_search_index(conn.cursor(), force=True)
+    conn.commit()
+    conn.close()
+    short_query_cache.clear()
+
+
+def test_short_queries_are_folded_and_ranked(live_db):
+    # Synthetic names have no word starting with o other than "Ost"
+    _rename_stops(live_db, {1: "Öhringen Bahnhof", 2: "Ö", 3: "Bad Oeynhausen", 4: "Ober Olm"})
+
+    names = [stop["stop_name"] for stop in search_stations("ö", limit=4)]
+    # Exact, then name prefixes by length, then word prefixes
+    assert names[:3] == ["Ö", "Ober Olm", "Öhringen Bahnhof"]
+    assert names[3] == "Bad Oeynhausen" or names[3].endswith(" Ost")
+
+    names = [stop["stop_name"] for stop in search_stations("Oe", limit=3)]
+    assert names == ["Ö", "Öhringen Bahnhof", "Bad Oeynhausen"]
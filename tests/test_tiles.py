@@ -0,0 +1,43 @@
+import math
+import sqlite3
+
+from fastapi.testclient import TestClient
+
+from conftest import edit_gtfs
+from incremental_import import import_delta
+from static_changes import static_changes
+
+ZOOM = 15
+
+
+def _tile_of_stop(db_path: str, stop_id: int):
+    conn = sqlite3.connect(db_path)
+    lat, lon = conn.execute("SELECT latitude, longitude FROM stops WHERE stop_id = ?", (stop_id,)).fetchone()
+    conn.close()
+    n = 2 ** ZOOM
+    x = int((lon + 180.0) / 360.0 * n)
+    y = int((1.0 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2.0 * n)
+    return x, y
+
+
+def test_stop_tiles_are_revalidated_after_an_incremental_import(live_db, feed_dir):
+    import backend
+
+    client = TestClient(backend.app)
+    x, y = _tile_of_stop(live_db, 5)
+    url = f"/tiles/{ZOOM}/{x}/{y}"
+    static_changes.poll()
+    first = client.get(url)
+    assert "no-cache" in first.headers["Cache-Control"]
+    etag = first.headers["ETag"]
+    assert client.get(url, headers={"If-None-Match": etag}).status_code == 304
+
+    edit_gtfs(feed_dir, "stops.txt", lambda row: {**row, "stop_name": "Renamed"} if row["stop_id"] == "5" else row)
+    import_delta(feed_dir, live_db)
+    assert static_changes.poll()
+
+    # Same URL, so only revalidation gets the browser the renamed stop
+    second = client.get(url, headers={"If-None-Match": etag})
+    assert second.status_code == 200
+    assert second.headers["ETag"] != etag
+    assert b"Renamed" in second.content